@@ -5,80 +5,49 @@ import torchvision.transforms.functional as TF
 import numpy as np
 import random
 import os
-import sys
 
-from diffusers.utils import load_image
-from diffusers import EulerDiscreteScheduler, T2IAdapter
-
-from huggingface_hub import hf_hub_download
 import gradio as gr
 
-from pipeline_t2i_adapter import PhotoMakerStableDiffusionXLAdapterPipeline
-from face_utils import FaceAnalysis2, analyze_faces
+from identity_cache import load_identity
+from request_queue import GenerationJob, MicroBatchScheduler
+from runtime import get_runtime, warmup_enabled
+from sampling_presets import SAMPLING_PRESETS, DEFAULT_SAMPLING_PRESET, adapter_factor, merge_step
 
-from style_template import styles
+from style_template import styles, apply_style, DEFAULT_STYLE_NAME, DEFAULT_NEGATIVE_PROMPT
 from aspect_ratio_template import aspect_ratios
 
 
 # global variable
-base_model_path = 'SG161222/RealVisXL_V4.0'
-face_detector = FaceAnalysis2(providers=['CPUExecutionProvider', 'CUDAExecutionProvider'], allowed_modules=['detection', 'recognition'])
-face_detector.prepare(ctx_id=0, det_size=(640, 640))
-
-try:
-    if torch.cuda.is_available():
-        device = "cuda"
-    elif sys.platform == "darwin" and torch.backends.mps.is_available():
-        device = "mps"
-    else:
-        device = "cpu"
-except:
-    device = "cpu"
+# NOTE: the models are loaded by the runtime on the first request, importing this module has no side effects
+runtime = get_runtime()
 
 MAX_SEED = np.iinfo(np.int32).max
 STYLE_NAMES = list(styles.keys())
-DEFAULT_STYLE_NAME = "Photographic (Default)"
 ASPECT_RATIO_LABELS = list(aspect_ratios)
 DEFAULT_ASPECT_RATIO = ASPECT_RATIO_LABELS[0]
 
 enable_doodle_arg = False
-photomaker_ckpt = hf_hub_download(repo_id="TencentARC/PhotoMaker-V2", filename="photomaker-v2.bin", repo_type="model")
 
-if device == "mps":
-    torch_dtype = torch.float16
-else:
-    torch_dtype = torch.float16
-    
-# load adapter
-adapter = T2IAdapter.from_pretrained(
-    "TencentARC/t2i-adapter-sketch-sdxl-1.0", torch_dtype=torch_dtype, variant="fp16"
-).to(device)
-
-pipe = PhotoMakerStableDiffusionXLAdapterPipeline.from_pretrained(
-    base_model_path, 
-    adapter=adapter, 
-    torch_dtype=torch_dtype,
-    use_safetensors=True, 
-    variant="fp16",
-).to(device)
-pipe.enable_vae_slicing()
-
-pipe.load_photomaker_adapter(
-    os.path.dirname(photomaker_ckpt),
-    subfolder="",
-    weight_name=os.path.basename(photomaker_ckpt),
-    trigger_word="img",
-    pm_version="v2",
-)
-pipe.id_encoder.to(device)
 
-pipe.scheduler = EulerDiscreteScheduler.from_config(pipe.scheduler.config)
-# pipe.set_adapters(["photomaker"], adapter_weights=[1.0])
-pipe.fuse_lora()
-pipe.to(device)
+@spaces.GPU(enable_queue=True)
+def encode_identity(upload_images):
+    return load_identity(runtime.pipe, runtime.face_detector, upload_images, runtime.identity_cache)
 
 
 @spaces.GPU(enable_queue=True)
+def run_batch(jobs):
+    return runtime.run_batch(jobs)
+
+
+# NOTE: concurrent clicks are grouped into micro-batches, the GPU is requested once per batch
+request_scheduler = MicroBatchScheduler(
+    run_batch,
+    max_batch_size=runtime.max_batch_size,
+    batch_window=runtime.batch_window,
+    max_batch_pixels=runtime.max_batch_pixels,
+)
+
+
 def generate_image(
     upload_images, 
     prompt, 
@@ -94,8 +63,11 @@ def generate_image(
     sketch_image,
     adapter_conditioning_scale,
     adapter_conditioning_factor,
+    sampling_preset=DEFAULT_SAMPLING_PRESET,
     progress=gr.Progress(track_tqdm=True)
 ):
+    pipe = runtime.pipe
+
     if use_doodle:
         sketch_image = sketch_image["composite"]
         r, g, b, a = sketch_image.split()
@@ -103,7 +75,8 @@ def generate_image(
         sketch_image = TF.to_tensor(sketch_image) > 0.5 # Inversion 
         sketch_image = TF.to_pil_image(sketch_image.to(torch.float32))
         adapter_conditioning_scale = adapter_conditioning_scale
-        adapter_conditioning_factor = adapter_conditioning_factor
+        # the same fraction of the steps, at least one step, whatever the number of steps
+        adapter_conditioning_factor = adapter_factor(adapter_conditioning_factor, num_steps)
     else:
         adapter_conditioning_scale = 0.
         adapter_conditioning_factor = 0.
@@ -128,50 +101,40 @@ def generate_image(
     if upload_images is None:
         raise gr.Error(f"Cannot find any input face image! Please refer to step 1️⃣")
 
-    input_id_images = []
-    for img in upload_images:
-        input_id_images.append(load_image(img))
-    
-    id_embed_list = []
-
-    for img in input_id_images:
-        img = np.array(img)
-        img = img[:, :, ::-1]
-        faces = analyze_faces(face_detector, img)
-        if len(faces) > 0:
-            id_embed_list.append(torch.from_numpy((faces[0]['embedding'])))
-
-    if len(id_embed_list) == 0:
+    try:
+        identity = encode_identity(upload_images)
+    except ValueError:
         raise gr.Error(f"No face detected, please update the input face image(s)")
-    
-    id_embeds = torch.stack(id_embed_list)
-
-    generator = torch.Generator(device=device).manual_seed(seed)
+    print(f"[Debug] Identity cache: {runtime.identity_cache.stats()}")
 
     print("Start inference...")
     print(f"[Debug] Seed: {seed}")
     print(f"[Debug] Prompt: {prompt}, \n[Debug] Neg Prompt: {negative_prompt}")
-    start_merge_step = int(float(style_strength_ratio) / 100 * num_steps)
-    if start_merge_step > 30:
-        start_merge_step = 30
-    print(start_merge_step)
-    images = pipe(
+    start_merge_step = merge_step(style_strength_ratio, num_steps, sampling_preset)
+    print(f"[Debug] Sampler: {sampling_preset}, {num_steps} steps, start merge step: {start_merge_step}")
+    job = GenerationJob(
         prompt=prompt,
+        negative_prompt=negative_prompt,
+        identity=identity,
         width=output_w,
         height=output_h,
-        input_id_images=input_id_images,
-        negative_prompt=negative_prompt,
-        num_images_per_prompt=num_outputs,
-        num_inference_steps=num_steps,
+        num_steps=num_steps,
         start_merge_step=start_merge_step,
-        generator=generator,
         guidance_scale=guidance_scale,
-        id_embeds=id_embeds,
-        image=sketch_image,
+        seed=seed,
+        num_outputs=num_outputs,
+        sketch_image=sketch_image,
         adapter_conditioning_scale=adapter_conditioning_scale,
         adapter_conditioning_factor=adapter_conditioning_factor,
-    ).images
-    return images, gr.update(visible=True)
+        # a scheduler of its own for this batch, the shared `pipe.scheduler` is left alone
+        sampling_preset=sampling_preset,
+    )
+    # show the cheap previews while denoising, the gallery gets the decoded images at the end
+    for images, done in request_scheduler.stream(job):
+        if not done:
+            yield images, gr.update()
+    print(f"[Debug] Request scheduler: {request_scheduler.stats()}")
+    yield images, gr.update(visible=True)
 
 def swap_to_gallery(images):
     return gr.update(value=images, visible=True), gr.update(visible=True), gr.update(visible=False)
@@ -191,15 +154,15 @@ def change_doodle_space(use_doodle):
 def remove_tips():
     return gr.update(visible=False)
 
+def change_sampling_preset(sampling_preset):
+    # every preset comes with the number of steps it is meant for
+    return gr.update(value=SAMPLING_PRESETS[sampling_preset].num_steps)
+
 def randomize_seed_fn(seed: int, randomize_seed: bool) -> int:
     if randomize_seed:
         seed = random.randint(0, MAX_SEED)
     return seed
 
-def apply_style(style_name: str, positive: str, negative: str = "") -> tuple[str, str]:
-    p, n = styles.get(style_name, styles[DEFAULT_STYLE_NAME])
-    return p.replace("{prompt}", positive), n + ' ' + negative
-
 def get_image_path_list(folder_name):
     image_basename_list = os.listdir(folder_name)
     image_path_list = sorted([os.path.join(folder_name, basename) for basename in image_basename_list])
@@ -282,151 +245,169 @@ If you have any issues, leave the issue in the discussion page of the space. For
 css = '''
 .gradio-container {width: 85% !important}
 '''
-with gr.Blocks(css=css) as demo:
-    gr.Markdown(logo)
-    gr.Markdown(title)
-    gr.Markdown(description)
-    # gr.DuplicateButton(
-    #     value="Duplicate Space for private use ",
-    #     elem_id="duplicate-button",
-    #     visible=os.getenv("SHOW_DUPLICATE_BUTTON") == "1",
-    # )
-    with gr.Row():
-        with gr.Column():
-            files = gr.Files(
-                        label="Drag (Select) 1 or more photos of your face",
-                        file_types=["image"]
-                    )
-            uploaded_files = gr.Gallery(label="Your images", visible=False, columns=5, rows=1, height=200)
-            with gr.Column(visible=False) as clear_button:
-                remove_and_reupload = gr.ClearButton(value="Remove and upload new ones", components=files, size="sm")
-            prompt = gr.Textbox(label="Prompt",
-                       info="Try something like 'a photo of a man/woman img', 'img' is the trigger word.",
-                       placeholder="A photo of a [man/woman img]...")
-            style = gr.Dropdown(label="Style template", choices=STYLE_NAMES, value=DEFAULT_STYLE_NAME)
-            aspect_ratio = gr.Dropdown(label="Output aspect ratio", choices=ASPECT_RATIO_LABELS, value=DEFAULT_ASPECT_RATIO)
-            submit = gr.Button("Submit")
-
-            enable_doodle = gr.Checkbox(
-                label="Enable Drawing Doodle for Control", value=enable_doodle_arg,
-                info="After enabling this option, PhotoMaker will generate content based on your doodle on the canvas, driven by the T2I-Adapter (Quality may be decreased)",
-            )
-            with gr.Accordion("T2I-Adapter-Doodle (Optional)", visible=False) as doodle_space:
-                with gr.Row():
-                    sketch_image = gr.Sketchpad(
-                        label="Canvas",
-                        type="pil",
-                        crop_size=[1024,1024],
-                        layers=False,
-                        canvas_size=(350, 350),
-                        brush=gr.Brush(default_size=5, colors=["#000000"], color_mode="fixed")
-                    )
-                    with gr.Group():
-                        adapter_conditioning_scale = gr.Slider(
-                            label="Adapter conditioning scale",
-                            minimum=0.5,
-                            maximum=1,
-                            step=0.1,
-                            value=0.7,
-                        )
-                        adapter_conditioning_factor = gr.Slider(
-                            label="Adapter conditioning factor",
-                            info="Fraction of timesteps for which adapter should be applied",
-                            minimum=0.5,
-                            maximum=1,
-                            step=0.1,
-                            value=0.8,
+def create_demo():
+    """Build the Gradio UI, the models are only loaded once the first image is generated"""
+    with gr.Blocks(css=css) as demo:
+        gr.Markdown(logo)
+        gr.Markdown(title)
+        gr.Markdown(description)
+        # gr.DuplicateButton(
+        #     value="Duplicate Space for private use ",
+        #     elem_id="duplicate-button",
+        #     visible=os.getenv("SHOW_DUPLICATE_BUTTON") == "1",
+        # )
+        with gr.Row():
+            with gr.Column():
+                files = gr.Files(
+                            label="Drag (Select) 1 or more photos of your face",
+                            file_types=["image"]
                         )
-            with gr.Accordion(open=False, label="Advanced Options"):
-                negative_prompt = gr.Textbox(
-                    label="Negative Prompt", 
-                    placeholder="low quality",
-                    value="nsfw, lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry",
-                )
-                num_steps = gr.Slider( 
-                    label="Number of sample steps",
-                    minimum=20,
-                    maximum=100,
-                    step=1,
-                    value=50,
-                )
-                style_strength_ratio = gr.Slider(
-                    label="Style strength (%)",
-                    minimum=15,
-                    maximum=50,
-                    step=1,
-                    value=20,
-                )
-                num_outputs = gr.Slider(
-                    label="Number of output images",
-                    minimum=1,
-                    maximum=4,
-                    step=1,
-                    value=2,
-                )
-                guidance_scale = gr.Slider(
-                    label="Guidance scale",
-                    minimum=0.1,
-                    maximum=10.0,
-                    step=0.1,
-                    value=5,
+                uploaded_files = gr.Gallery(label="Your images", visible=False, columns=5, rows=1, height=200)
+                with gr.Column(visible=False) as clear_button:
+                    remove_and_reupload = gr.ClearButton(value="Remove and upload new ones", components=files, size="sm")
+                prompt = gr.Textbox(label="Prompt",
+                           info="Try something like 'a photo of a man/woman img', 'img' is the trigger word.",
+                           placeholder="A photo of a [man/woman img]...")
+                style = gr.Dropdown(label="Style template", choices=STYLE_NAMES, value=DEFAULT_STYLE_NAME)
+                aspect_ratio = gr.Dropdown(label="Output aspect ratio", choices=ASPECT_RATIO_LABELS, value=DEFAULT_ASPECT_RATIO)
+                submit = gr.Button("Submit")
+
+                enable_doodle = gr.Checkbox(
+                    label="Enable Drawing Doodle for Control", value=enable_doodle_arg,
+                    info="After enabling this option, PhotoMaker will generate content based on your doodle on the canvas, driven by the T2I-Adapter (Quality may be decreased)",
                 )
-                seed = gr.Slider(
-                    label="Seed",
-                    minimum=0,
-                    maximum=MAX_SEED,
-                    step=1,
-                    value=0,
-                )
-                randomize_seed = gr.Checkbox(label="Randomize seed", value=True)
-        with gr.Column():
-            gallery = gr.Gallery(label="Generated Images")
-            usage_tips = gr.Markdown(label="Usage tips of PhotoMaker", value=tips ,visible=False)
-
-        files.upload(fn=swap_to_gallery, inputs=files, outputs=[uploaded_files, clear_button, files])
-        remove_and_reupload.click(fn=remove_back_to_files, outputs=[uploaded_files, clear_button, files])
-        enable_doodle.select(fn=change_doodle_space, inputs=enable_doodle, outputs=doodle_space)
-
-        input_list = [
-            files, 
-            prompt, 
-            negative_prompt, 
-            aspect_ratio, 
-            style, 
-            num_steps, 
-            style_strength_ratio, 
-            num_outputs, 
-            guidance_scale, 
-            seed,
-            enable_doodle,
-            sketch_image,
-            adapter_conditioning_scale,
-            adapter_conditioning_factor
-        ]
-
-        submit.click(
-            fn=remove_tips,
-            outputs=usage_tips,            
-        ).then(
-            fn=randomize_seed_fn,
-            inputs=[seed, randomize_seed],
-            outputs=seed,
-            queue=False,
-            api_name=False,
-        ).then(
-            fn=generate_image,
-            inputs=input_list,
-            outputs=[gallery, usage_tips]
-        )
+                with gr.Accordion("T2I-Adapter-Doodle (Optional)", visible=False) as doodle_space:
+                    with gr.Row():
+                        sketch_image = gr.Sketchpad(
+                            label="Canvas",
+                            type="pil",
+                            crop_size=[1024,1024],
+                            layers=False,
+                            canvas_size=(350, 350),
+                            brush=gr.Brush(default_size=5, colors=["#000000"], color_mode="fixed")
+                        )
+                        with gr.Group():
+                            adapter_conditioning_scale = gr.Slider(
+                                label="Adapter conditioning scale",
+                                minimum=0.5,
+                                maximum=1,
+                                step=0.1,
+                                value=0.7,
+                            )
+                            adapter_conditioning_factor = gr.Slider(
+                                label="Adapter conditioning factor",
+                                info="Fraction of timesteps for which adapter should be applied",
+                                minimum=0.5,
+                                maximum=1,
+                                step=0.1,
+                                value=0.8,
+                            )
+                with gr.Accordion(open=False, label="Advanced Options"):
+                    negative_prompt = gr.Textbox(
+                        label="Negative Prompt", 
+                        placeholder="low quality",
+                        value=DEFAULT_NEGATIVE_PROMPT,
+                    )
+                    sampling_preset = gr.Dropdown(
+                        label="Sampler",
+                        info="; ".join(f"{preset.name}: {preset.description}" for preset in SAMPLING_PRESETS.values()),
+                        choices=list(SAMPLING_PRESETS),
+                        value=DEFAULT_SAMPLING_PRESET,
+                    )
+                    num_steps = gr.Slider( 
+                        label="Number of sample steps",
+                        minimum=4,
+                        maximum=100,
+                        step=1,
+                        value=50,
+                    )
+                    style_strength_ratio = gr.Slider(
+                        label="Style strength (%)",
+                        minimum=15,
+                        maximum=50,
+                        step=1,
+                        value=20,
+                    )
+                    num_outputs = gr.Slider(
+                        label="Number of output images",
+                        minimum=1,
+                        maximum=4,
+                        step=1,
+                        value=2,
+                    )
+                    guidance_scale = gr.Slider(
+                        label="Guidance scale",
+                        minimum=0.1,
+                        maximum=10.0,
+                        step=0.1,
+                        value=5,
+                    )
+                    seed = gr.Slider(
+                        label="Seed",
+                        minimum=0,
+                        maximum=MAX_SEED,
+                        step=1,
+                        value=0,
+                    )
+                    randomize_seed = gr.Checkbox(label="Randomize seed", value=True)
+            with gr.Column():
+                gallery = gr.Gallery(label="Generated Images")
+                usage_tips = gr.Markdown(label="Usage tips of PhotoMaker", value=tips ,visible=False)
+
+            files.upload(fn=swap_to_gallery, inputs=files, outputs=[uploaded_files, clear_button, files])
+            remove_and_reupload.click(fn=remove_back_to_files, outputs=[uploaded_files, clear_button, files])
+            enable_doodle.select(fn=change_doodle_space, inputs=enable_doodle, outputs=doodle_space)
+            sampling_preset.change(fn=change_sampling_preset, inputs=sampling_preset, outputs=num_steps)
+
+            input_list = [
+                files, 
+                prompt, 
+                negative_prompt, 
+                aspect_ratio, 
+                style, 
+                num_steps, 
+                style_strength_ratio, 
+                num_outputs, 
+                guidance_scale, 
+                seed,
+                enable_doodle,
+                sketch_image,
+                adapter_conditioning_scale,
+                adapter_conditioning_factor,
+                sampling_preset,
+            ]
+
+            submit.click(
+                fn=remove_tips,
+                outputs=usage_tips,            
+            ).then(
+                fn=randomize_seed_fn,
+                inputs=[seed, randomize_seed],
+                outputs=seed,
+                queue=False,
+                api_name=False,
+            ).then(
+                fn=generate_image,
+                inputs=input_list,
+                outputs=[gallery, usage_tips],
+                # let enough requests in to fill the next batch while one is running
+                concurrency_limit=2 * runtime.max_batch_size,
+            )
 
-    gr.Examples(
-        examples=get_example(),
-        inputs=[files, prompt, style, negative_prompt],
-        run_on_click=True,
-        fn=upload_example_to_gallery,
-        outputs=[uploaded_files, clear_button, files],
-    )
-    
-    gr.Markdown(article)
+        gr.Examples(
+            examples=get_example(),
+            inputs=[files, prompt, style, negative_prompt],
+            run_on_click=True,
+            fn=upload_example_to_gallery,
+            outputs=[uploaded_files, clear_button, files],
+        )
     
-demo.launch(share=True)
+        gr.Markdown(article)
+    return demo
+
+
+if __name__ == "__main__":
+    # load the models and encode the negative prompt of every style before the first click
+    if warmup_enabled():
+        runtime.warmup()
+    create_demo().launch(share=True)
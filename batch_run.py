@@ -0,0 +1,199 @@
+"""
+Bulk generation from a job manifest, one row per image.
+
+    python batch_run.py jobs.jsonl --output-dir outputs
+    python batch_run.py jobs.csv --output-dir outputs --batch-size 4
+    python batch_run.py jobs.jsonl --output-dir outputs --tiny --scale 0.25   # tiny random models on CPU
+
+A row has `images` (a list of paths, `;` separated in a CSV), `prompt` and optionally `id`,
+`negative_prompt`, `style`, `aspect_ratio`, `seed`, `steps`, `style_strength_ratio`,
+`guidance_scale` and `sampler` (a preset of sampling_presets.py, `steps` defaults to its steps). Relative image paths are relative to the manifest. Rows of the same person
+and resolution are run next to each other and denoised `--batch-size` at a time.
+
+Every finished row is appended to `progress.jsonl` in the output directory with its output
+path and the seconds each stage spent on its batch. Rows that are already there are skipped,
+so a run that crashed picks up where it stopped when started again; failed rows are retried.
+"""
+
+import argparse
+import csv
+import json
+import os
+import time
+
+from aspect_ratio_template import aspect_ratios
+from prompt_utils import check_trigger_word
+from runtime import warmup_enabled
+from sampling_presets import DEFAULT_SAMPLING_PRESET, get_sampling_preset, merge_step
+from staged_pipeline import StagedPipeline, photomaker_stages
+from style_template import apply_style, DEFAULT_NEGATIVE_PROMPT, DEFAULT_STYLE_NAME
+import tracing
+
+DEFAULT_ASPECT_RATIO = "Instagram (1:1)"
+
+
+def read_manifest(path):
+    """Rows of a `.jsonl` or `.csv` manifest, with defaults filled in and image paths resolved"""
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for index, row in enumerate(rows):
+        images = row["images"]
+        if isinstance(images, str):
+            images = [image.strip() for image in images.split(";") if image.strip()]
+        row["images"] = [os.path.join(base_dir, image) for image in images]
+        row["id"] = str(index if row.get("id") in (None, "") else row["id"])
+        row["negative_prompt"] = row.get("negative_prompt") or DEFAULT_NEGATIVE_PROMPT
+        row["style"] = row.get("style") or DEFAULT_STYLE_NAME
+        row["aspect_ratio"] = row.get("aspect_ratio") or DEFAULT_ASPECT_RATIO
+        # csv values are strings, empty ones take the default
+        row["seed"] = int(row.get("seed") or 0)
+        row["sampler"] = row.get("sampler") or DEFAULT_SAMPLING_PRESET
+        row["steps"] = int(row.get("steps") or get_sampling_preset(row["sampler"]).num_steps)
+        row["style_strength_ratio"] = float(row.get("style_strength_ratio") or 20)
+        row["guidance_scale"] = float(row.get("guidance_scale") or 5.0)
+    return rows
+
+
+def read_progress(progress_file):
+    """Ids of the rows that finished without an error in an earlier run"""
+    done = set()
+    if not os.path.exists(progress_file):
+        return done
+    with open(progress_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # the last line of a run that was killed while writing it
+                continue
+            if "error" not in record:
+                done.add(record["id"])
+    return done
+
+
+def resolution(aspect_ratio, scale=1.0):
+    width, height = aspect_ratios[aspect_ratio]
+    # the VAE needs multiples of 8, the templates already are
+    return max(64, int(width * scale) // 8 * 8), max(64, int(height * scale) // 8 * 8)
+
+
+def batch_jobs(rows, output_dir, batch_size, scale=1.0):
+    """Group rows of the same person and sampling parameters into staged pipeline jobs of up to `batch_size` rows"""
+    groups = {}
+    for row in rows:
+        width, height = resolution(row["aspect_ratio"], scale)
+        start_merge_step = merge_step(row["style_strength_ratio"], row["steps"], row["sampler"])
+        key = (tuple(row["images"]), width, height, row["sampler"], row["steps"], start_merge_step, row["guidance_scale"])
+        groups.setdefault(key, []).append(row)
+
+    # NOTE: the groups of one person are consecutive, so its identity is computed once and stays in the cache
+    for (images, width, height, sampler, steps, start_merge_step, guidance_scale), group in sorted(groups.items(), key=lambda item: item[0]):
+        for i in range(0, len(group), batch_size):
+            batch = group[i:i + batch_size]
+            styled = [apply_style(row["style"], row["prompt"], row["negative_prompt"]) for row in batch]
+            yield {
+                "rows": batch,
+                "image_paths": list(images),
+                "prompt": [prompt for prompt, _ in styled],
+                "negative_prompt": [negative_prompt for _, negative_prompt in styled],
+                "seed": [row["seed"] for row in batch],
+                "output_path": [os.path.join(output_dir, f"{row['id']}.png") for row in batch],
+                "width": width,
+                "height": height,
+                "sampling_preset": sampler,
+                "num_steps": steps,
+                "start_merge_step": start_merge_step,
+                "guidance_scale": guidance_scale,
+            }
+
+
+def run_manifest(runtime, manifest, output_dir, batch_size=1, scale=1.0, save_workers=2):
+    """Generate every row of `manifest` that is not in the progress file yet, returns a summary of the run"""
+    os.makedirs(output_dir, exist_ok=True)
+    progress_file = os.path.join(output_dir, "progress.jsonl")
+    rows = read_manifest(manifest)
+    done = read_progress(progress_file)
+    pending = [row for row in rows if row["id"] not in done]
+    print(f"[Debug] {len(rows)} rows in {manifest}, {len(rows) - len(pending)} done already, {len(pending)} to run")
+
+    pipe = runtime.pipe
+    summary = {"rows": len(rows), "skipped": len(rows) - len(pending), "finished": 0, "failed": 0}
+    staged = StagedPipeline(photomaker_stages(runtime, save_workers=save_workers))
+    with open(progress_file, "a") as progress:
+        def record(row, **fields):
+            progress.write(json.dumps({"id": row["id"], **fields}) + "\n")
+            progress.flush()
+            os.fsync(progress.fileno())
+            summary["failed" if "error" in fields else "finished"] += 1
+
+        runnable = []
+        for row in pending:
+            try:
+                check_trigger_word(pipe, row["prompt"])
+            except ValueError as e:
+                record(row, error=str(e))
+            else:
+                runnable.append(row)
+
+        for job in staged.run(batch_jobs(runnable, output_dir, batch_size, scale)):
+            for row, output_path in zip(job["rows"], job["output_path"]):
+                fields = {
+                    "output": output_path,
+                    "seed": row["seed"],
+                    "width": job["width"],
+                    "height": job["height"],
+                    "batch_size": len(job["rows"]),
+                    "timings": job.get("timings", {}),
+                    "finished_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                }
+                if "error" in job:
+                    fields["error"] = job["error"]
+                record(row, **fields)
+
+    summary["wall_time"] = staged.wall_time
+    summary["images_per_s"] = summary["finished"] / staged.wall_time if staged.wall_time else 0.0
+    summary["stages"] = staged.stats()["stages"]
+    summary["identity_cache"] = runtime.identity_cache.stats()
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", help="a .jsonl or .csv file, one row per image")
+    parser.add_argument("--output-dir", default="outputs")
+    parser.add_argument("--batch-size", type=int, default=1, help="rows of the same person denoised together")
+    parser.add_argument("--scale", type=float, default=1.0, help="shrink every aspect ratio, e.g. 0.25 with --tiny")
+    parser.add_argument("--save-workers", type=int, default=2)
+    parser.add_argument("--tiny", action="store_true", help="tiny random models and a stub face detector on CPU")
+    parser.add_argument("--trace", action="store_true", help="write trace.json (Chrome trace) and metrics.prom to the output dir")
+    args = parser.parse_args()
+    if args.trace:
+        tracing.enable()
+
+    if args.tiny:
+        from tiny_models import TinyPhotoMakerRuntime
+
+        runtime = TinyPhotoMakerRuntime()
+    else:
+        from runtime import get_runtime
+
+        runtime = get_runtime()
+
+    if warmup_enabled():
+        # the load times and the style negatives are then not part of the first batch's timings
+        runtime.warmup()
+    summary = run_manifest(runtime, args.manifest, args.output_dir, args.batch_size, args.scale, args.save_workers)
+    print(json.dumps(summary, indent=2))
+    if args.trace:
+        tracing.save_chrome_trace(os.path.join(args.output_dir, "trace.json"))
+        with open(os.path.join(args.output_dir, "metrics.prom"), "w") as f:
+            f.write(tracing.prometheus_text())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,856 @@
+"""
+Micro-benchmarks for the PhotoMaker pipeline, they run on CPU and do not need any checkpoint.
+
+    python benchmark.py class-tokens --batch-sizes 1 8 32
+    python benchmark.py denoise-conditioning --steps 50
+    python benchmark.py perceiver-attention --batch-sizes 1 4 16
+    python benchmark.py vae-decode --device cuda --tile-sample-size 512
+    python benchmark.py checkpoint-load --lora-mb 200
+    python benchmark.py id-encoder-fuse --num-prompts 8
+    python benchmark.py staged-pipeline --jobs 16 --denoise-ms 200
+    python benchmark.py stages --output baseline.json
+    python benchmark.py stages --baseline baseline.json --threshold 0.25
+    python benchmark.py theme-pack --themes 8 --step-groups 2
+    python benchmark.py samplers --reference-steps 100
+    python benchmark.py preview --steps 20 --preview-steps 1 5
+"""
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+
+from aspect_ratio_template import aspect_ratios
+from checkpoint_loader import build_empty, convert_checkpoint, load_module_weights, load_tensors, split_checkpoint_paths
+from identity_cache import IdentityCache, detect_id_embeds, load_identity
+from module.model_v2 import PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken
+from module.resampler import PerceiverAttention
+from pipeline_t2i_adapter import PhotoMakerStableDiffusionXLAdapterPipeline
+from sampling_presets import SAMPLING_PRESETS, get_sampling_preset, merge_step
+from staged_pipeline import Stage, StagedPipeline
+from theme_pack import pack_entries, pack_jobs, render_pack
+from theme_registry import ThemeRegistry
+from tiny_models import StubFaceAnalysis, TinyPhotoMakerRuntime, build_tiny_pipeline
+from vae_decoder import VaeDecodeStage
+
+TRIGGER_TOKEN_ID = 49408
+PAD_TOKEN_ID = 49407
+MAX_LENGTH = 77
+
+
+def timeit(fn, repeat=20, warmup=3):
+    """Median wall time of `fn` in milliseconds"""
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def expand_class_tokens_loop(text_input_ids, pad_token_id, image_token_id, num_id_images, num_tokens=2):
+    # the per-token Python loop encode_prompt_with_trigger_word used before it was vectorized
+    batch_clean_input_ids = []
+    batch_class_tokens_mask = []
+    for one_input_ids in text_input_ids.tolist():
+        clean_index = 0
+        clean_input_ids = []
+        class_token_index = []
+        for i, token_id in enumerate(one_input_ids):
+            if token_id == image_token_id:
+                class_token_index.append(clean_index - 1)
+            else:
+                clean_input_ids.append(token_id)
+                clean_index += 1
+        class_token_index = class_token_index[0]
+        class_token = clean_input_ids[class_token_index]
+        clean_input_ids = clean_input_ids[:class_token_index] + [class_token] * num_id_images * num_tokens + \
+            clean_input_ids[class_token_index+1:]
+        max_len = len(one_input_ids)
+        if len(clean_input_ids) > max_len:
+            clean_input_ids = clean_input_ids[:max_len]
+        else:
+            clean_input_ids = clean_input_ids + [pad_token_id] * (max_len - len(clean_input_ids))
+        class_tokens_mask = [True if class_token_index <= i < class_token_index+(num_id_images * num_tokens) else False \
+             for i in range(len(clean_input_ids))]
+        batch_clean_input_ids.append(clean_input_ids)
+        batch_class_tokens_mask.append(class_tokens_mask)
+    return torch.tensor(batch_clean_input_ids, dtype=torch.long), torch.tensor(batch_class_tokens_mask, dtype=torch.bool)
+
+
+def random_prompt_ids(batch_size, generator):
+    # [BOS] words ... class word [trigger] words ... [EOS] [PAD]...
+    text_input_ids = torch.full((batch_size, MAX_LENGTH), PAD_TOKEN_ID, dtype=torch.long)
+    for row in range(batch_size):
+        length = int(torch.randint(8, MAX_LENGTH - 1, (1,), generator=generator))
+        text_input_ids[row, 0] = 49406
+        text_input_ids[row, 1:length] = torch.randint(1000, 40000, (length - 1,), generator=generator)
+        text_input_ids[row, int(torch.randint(2, length, (1,), generator=generator))] = TRIGGER_TOKEN_ID
+        text_input_ids[row, length] = PAD_TOKEN_ID
+    return text_input_ids
+
+
+def bench_class_tokens(args):
+    tokenizer = SimpleNamespace(pad_token_id=PAD_TOKEN_ID, model_max_length=MAX_LENGTH)
+    stub_pipe = SimpleNamespace(
+        trigger_word="img",
+        num_tokens=2,
+        tokenizer_2=SimpleNamespace(convert_tokens_to_ids=lambda token: TRIGGER_TOKEN_ID),
+    )
+    generator = torch.Generator().manual_seed(0)
+    results = []
+    for batch_size in args.batch_sizes:
+        text_input_ids = random_prompt_ids(batch_size, generator)
+        prompts = [""] * batch_size
+
+        def vectorized():
+            return PhotoMakerStableDiffusionXLAdapterPipeline._expand_class_tokens(
+                stub_pipe, text_input_ids, tokenizer, args.num_id_images, prompts
+            )
+
+        def loop():
+            return expand_class_tokens_loop(text_input_ids, PAD_TOKEN_ID, TRIGGER_TOKEN_ID, args.num_id_images)
+
+        for expected, actual in zip(loop(), vectorized()):
+            assert torch.equal(expected, actual), "vectorized class token expansion differs from the loop"
+
+        loop_ms = timeit(loop, repeat=args.repeat)
+        vectorized_ms = timeit(vectorized, repeat=args.repeat)
+        results.append({
+            "batch_size": batch_size,
+            "loop_ms": round(loop_ms, 4),
+            "vectorized_ms": round(vectorized_ms, 4),
+            "speedup": round(loop_ms / vectorized_ms, 2),
+        })
+    return results
+
+
+def _new_bytes(tensors, sources):
+    # bytes of the tensors that do not share storage with one of the prebuilt inputs
+    source_ptrs = {t.data_ptr() for t in sources}
+    return sum(t.numel() * t.element_size() for t in tensors if t.data_ptr() not in source_ptrs)
+
+
+def bench_denoise_conditioning(args):
+    # conditioning tensors of one SDXL step: 77 tokens of 2048 channels, 1280 pooled channels and
+    # the four sketch adapter features at 1/16, 1/32 and 1/64 of the image size
+    dtype = getattr(torch, args.dtype)
+    batch = args.batch_size
+    negative_embeds, embeds, embeds_text_only = (torch.randn(batch, 77, 2048, dtype=dtype) for _ in range(3))
+    negative_pooled, pooled, pooled_text_only = (torch.randn(batch, 1280, dtype=dtype) for _ in range(3))
+    adapter_state = [
+        torch.randn(2 * batch, channels, args.height // scale, args.width // scale, dtype=dtype)
+        for channels, scale in ((320, 16), (640, 32), (1280, 64), (1280, 64))
+    ]
+    sources = [negative_embeds, embeds, embeds_text_only, negative_pooled, pooled, pooled_text_only] + adapter_state
+
+    def per_step():
+        allocated = 0
+        for i in range(args.steps):
+            if i <= args.start_merge_step:
+                current = torch.cat([negative_embeds, embeds_text_only], dim=0)
+                current_pooled = torch.cat([negative_pooled, pooled_text_only], dim=0)
+            else:
+                current = torch.cat([negative_embeds, embeds], dim=0)
+                current_pooled = torch.cat([negative_pooled, pooled], dim=0)
+            residuals = [state.clone() for state in adapter_state]
+            allocated += _new_bytes([current, current_pooled] + residuals, sources)
+        return allocated
+
+    def prebuilt():
+        text_only = torch.cat([negative_embeds, embeds_text_only], dim=0)
+        text_only_pooled = torch.cat([negative_pooled, pooled_text_only], dim=0)
+        merged = torch.cat([negative_embeds, embeds], dim=0)
+        merged_pooled = torch.cat([negative_pooled, pooled], dim=0)
+        allocated = _new_bytes([text_only, text_only_pooled, merged, merged_pooled], sources)
+        sources_with_prebuilt = sources + [text_only, text_only_pooled, merged, merged_pooled]
+        for i in range(args.steps):
+            if i <= args.start_merge_step:
+                current, current_pooled = text_only, text_only_pooled
+            else:
+                current, current_pooled = merged, merged_pooled
+            residuals = list(adapter_state)
+            allocated += _new_bytes([current, current_pooled] + residuals, sources_with_prebuilt)
+        return allocated
+
+    per_step_bytes = per_step()
+    prebuilt_bytes = prebuilt()
+    per_step_ms = timeit(per_step, repeat=args.repeat)
+    prebuilt_ms = timeit(prebuilt, repeat=args.repeat)
+    return {
+        "steps": args.steps,
+        "batch_size": batch,
+        "per_step_mb": round(per_step_bytes / 1024 ** 2, 2),
+        "prebuilt_mb": round(prebuilt_bytes / 1024 ** 2, 2),
+        "per_step_ms": round(per_step_ms, 4),
+        "prebuilt_ms": round(prebuilt_ms, 4),
+        "speedup": round(per_step_ms / prebuilt_ms, 2),
+    }
+
+
+def bench_perceiver_attention(args):
+    # one attention layer of the v2 QFormer perceiver: 2 ID tokens attend to the 257 CLIP patch tokens
+    dtype = getattr(torch, args.dtype)
+    math_attn = PerceiverAttention(dim=2048, dim_head=128, heads=16, attention_backend="math").to(dtype).eval()
+    sdpa_attn = PerceiverAttention(dim=2048, dim_head=128, heads=16, attention_backend="sdpa").to(dtype).eval()
+    sdpa_attn.load_state_dict(math_attn.state_dict())
+    generator = torch.Generator().manual_seed(0)
+    results = []
+    for batch_size in args.batch_sizes:
+        x = torch.randn(batch_size, 257, 2048, generator=generator).to(dtype)
+        latents = torch.randn(batch_size, 2, 2048, generator=generator).to(dtype)
+        with torch.no_grad():
+            max_abs_diff = (math_attn(x, latents) - sdpa_attn(x, latents)).abs().max().item()
+            assert max_abs_diff < args.atol, f"sdpa attention differs from the math path by {max_abs_diff}"
+            math_ms = timeit(lambda: math_attn(x, latents), repeat=args.repeat)
+            sdpa_ms = timeit(lambda: sdpa_attn(x, latents), repeat=args.repeat)
+        results.append({
+            "batch_size": batch_size,
+            "max_abs_diff": max_abs_diff,
+            "math_ms": round(math_ms, 4),
+            "sdpa_ms": round(sdpa_ms, 4),
+            "speedup": round(math_ms / sdpa_ms, 2),
+        })
+    return results
+
+
+# the architecture of the SDXL VAE, the weights are random
+SDXL_VAE_CONFIG = dict(
+    in_channels=3,
+    out_channels=3,
+    down_block_types=["DownEncoderBlock2D"] * 4,
+    up_block_types=["UpDecoderBlock2D"] * 4,
+    block_out_channels=[128, 256, 512, 512],
+    layers_per_block=2,
+    latent_channels=4,
+    sample_size=1024,
+    scaling_factor=0.13025,
+    force_upcast=True,
+)
+
+
+def _measure(fn, device, repeat):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+    ms = timeit(lambda: (fn(), torch.cuda.synchronize() if device.type == "cuda" else None), repeat=repeat, warmup=1)
+    peak_mb = torch.cuda.max_memory_allocated() / 1024 ** 2 if device.type == "cuda" else None
+    return ms, peak_mb
+
+
+def bench_vae_decode(args):
+    from diffusers import AutoencoderKL
+
+    device = torch.device(args.device)
+    vae = AutoencoderKL(**SDXL_VAE_CONFIG).to(device=device, dtype=torch.float16).eval()
+    stage = VaeDecodeStage(vae, chunk_size=args.chunk_size, tiling=False)
+    tiled_stage = VaeDecodeStage(vae, chunk_size=args.chunk_size, tiling=True, tile_sample_size=args.tile_sample_size)
+
+    def upcast_per_call(latents):
+        # what __call__ did before: cast the whole vae to float32 and back for every decode
+        vae.to(dtype=torch.float32)
+        with torch.no_grad():
+            image = torch.cat([vae.decode(chunk.float()).sample for chunk in latents.split(args.chunk_size)])
+        vae.to(dtype=torch.float16)
+        return image
+
+    results = []
+    for name, (width, height) in aspect_ratios.items():
+        width, height = int(width * args.scale) // 8 * 8, int(height * args.scale) // 8 * 8
+        latents = torch.randn(args.batch_size, 4, height // 8, width // 8, device=device, dtype=torch.float16)
+        row = {"aspect_ratio": name, "width": width, "height": height}
+        for mode, fn in (("upcast_per_call", upcast_per_call), ("stage", stage.decode), ("tiled", tiled_stage.decode)):
+            ms, peak_mb = _measure(lambda: fn(latents), device, args.repeat)
+            row[f"{mode}_ms"] = round(ms, 2)
+            row[f"{mode}_peak_mb"] = round(peak_mb, 1) if peak_mb is not None else None
+        results.append(row)
+    return results
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _load_checkpoint(mode, checkpoint, cache_dir):
+    # one load per process, the peak RSS of a process never goes down
+    baseline_mb = _peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "torch-load":
+        state_dict = torch.load(checkpoint, map_location="cpu")
+        id_encoder = PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken()
+        id_encoder.load_state_dict(state_dict["id_encoder"], strict=True)
+        id_encoder = id_encoder.to(dtype=torch.float16)
+        lora_weights = state_dict["lora_weights"]
+    else:
+        paths = split_checkpoint_paths(checkpoint, cache_dir)
+        if not all(os.path.exists(path) for path in paths.values()):
+            convert_checkpoint(checkpoint, paths)
+        id_encoder = build_empty(PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken)
+        id_encoder = load_module_weights(id_encoder, paths["id_encoder"], "cpu", torch.float16)
+        lora_weights = load_tensors(paths["lora_weights"])
+    return {
+        "mode": mode,
+        "seconds": round(time.perf_counter() - start, 3),
+        "baseline_rss_mb": round(baseline_mb, 1),
+        "peak_rss_mb": round(_peak_rss_mb(), 1),
+        "lora_tensors": len(lora_weights),
+    }
+
+
+def bench_checkpoint_load(args):
+    if args.mode is not None:
+        return _load_checkpoint(args.mode, args.checkpoint, args.cache_dir)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # a random checkpoint with the shapes of photomaker-v2.bin and `--lora-mb` of lora weights
+        checkpoint = os.path.join(tmp_dir, "photomaker-random.bin")
+        generator = torch.Generator().manual_seed(0)
+        lora_numel = int(args.lora_mb * 1024 ** 2 / 2)
+        torch.save({
+            "id_encoder": PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken().state_dict(),
+            "lora_weights": {
+                f"lora_{i}": torch.randn(lora_numel // 64 // 1280, 1280, generator=generator).half()
+                for i in range(64)
+            },
+        }, checkpoint)
+
+        results = []
+        # cold converts the .bin to the split cache, warm memory-maps the cache
+        for mode in ("torch-load", "cold", "warm"):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "checkpoint-load", "--mode", mode,
+                 "--checkpoint", checkpoint, "--cache-dir", os.path.join(tmp_dir, "cache")],
+                check=True, capture_output=True, text=True,
+            ).stdout
+            results.append(json.loads(output[output.index("{"):]))
+    return results
+
+
+def bench_id_encoder_fuse(args):
+    # a prompt sweep for one person: the monolithic forward per prompt vs encode_identity once + fuse per prompt
+    id_encoder = PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken().eval()
+    generator = torch.Generator().manual_seed(0)
+    num_class_tokens = args.num_id_images * id_encoder.num_tokens
+    id_pixel_values = torch.randn(1, args.num_id_images, 3, 224, 224, generator=generator)
+    id_embeds = torch.randn(1, args.num_id_images, 512, generator=generator)
+    prompt_embeds = torch.randn(args.num_prompts, 1, 77, 2048, generator=generator)
+    class_tokens_mask = torch.zeros(1, 77, dtype=torch.bool)
+    class_tokens_mask[:, 5:5 + num_class_tokens] = True
+
+    with torch.no_grad():
+        def monolithic():
+            return [
+                id_encoder(id_pixel_values, embeds.clone(), class_tokens_mask, id_embeds)
+                for embeds in prompt_embeds
+            ]
+
+        def split():
+            id_tokens = id_encoder.encode_identity(id_pixel_values, id_embeds)
+            return [id_encoder.fuse(embeds.clone(), class_tokens_mask, id_tokens) for embeds in prompt_embeds]
+
+        # equivalence is checked by tests/test_id_encoder.py, the difference is only reported here
+        max_abs_diff = max((a - b).abs().max().item() for a, b in zip(monolithic(), split()))
+        monolithic_ms = timeit(monolithic, repeat=args.repeat, warmup=1)
+        split_ms = timeit(split, repeat=args.repeat, warmup=1)
+    return {
+        "num_prompts": args.num_prompts,
+        "num_id_images": args.num_id_images,
+        "max_abs_diff": max_abs_diff,
+        "monolithic_ms": round(monolithic_ms, 2),
+        "split_ms": round(split_ms, 2),
+        "speedup": round(monolithic_ms / split_ms, 2),
+    }
+
+
+def bench_staged_pipeline(args):
+    # stubbed stages: sleeps stand in for loading, face analysis, the UNet and the VAE (the GPU does
+    # not hold the GIL either), the save stage really encodes a PNG
+    image = Image.fromarray(np.random.default_rng(0).integers(0, 256, (args.size, args.size, 3), dtype=np.uint8))
+
+    def sleep_stage(ms):
+        def fn(job):
+            time.sleep(ms / 1000)
+            return job
+        return fn
+
+    def save(job):
+        image.save(os.path.join(args.output_dir, f"{job['index']}.png"))
+        return job
+
+    stages = [
+        Stage("prefetch", sleep_stage(args.prefetch_ms), workers=args.cpu_workers),
+        Stage("preprocess", sleep_stage(args.preprocess_ms)),
+        Stage("denoise", sleep_stage(args.denoise_ms)),
+        Stage("decode", sleep_stage(args.decode_ms)),
+        Stage("save", save, workers=args.cpu_workers),
+    ]
+    with tempfile.TemporaryDirectory() as output_dir:
+        args.output_dir = output_dir
+        start = time.perf_counter()
+        for index in range(args.jobs):
+            job = {"index": index}
+            for stage in stages:
+                job = stage.fn(job)
+        serial_s = time.perf_counter() - start
+
+        staged = StagedPipeline(stages)
+        finished = list(staged.run({"index": index} for index in range(args.jobs)))
+    stats = staged.stats()
+    return {
+        "jobs": args.jobs,
+        "failed_jobs": [job["error"] for job in finished if "error" in job],
+        "serial_jobs_per_s": round(args.jobs / serial_s, 2),
+        "staged_jobs_per_s": round(args.jobs / stats["wall_time"], 2),
+        "denoise_bound_jobs_per_s": round(1000 / args.denoise_ms, 2),
+        "speedup": round(serial_s / stats["wall_time"], 2),
+        "utilization": {name: round(stage["utilization"], 2) for name, stage in stats["stages"].items()},
+    }
+
+
+def _stage_key(result):
+    return f"{result['stage']}/bs={result['batch_size']}/{result['aspect_ratio']}/steps={result.get('steps')}"
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """Measurements more than `threshold` (a fraction) slower than the same measurement of `baseline`"""
+    baseline_ms = {_stage_key(result): result["ms"] for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        before = baseline_ms.get(_stage_key(result))
+        if before and result["ms"] > before * (1 + threshold):
+            regressions.append({"key": _stage_key(result), "baseline_ms": before, "ms": result["ms"], "ratio": round(result["ms"] / before, 2)})
+    return regressions
+
+
+def bench_stages(args):
+    # every stage of a generation on the tiny random models of tiny_models.py, on CPU by default. the
+    # absolute numbers say little about real checkpoints, a change between two runs of the same machine does
+    torch.set_num_threads(args.threads)
+    pipe = build_tiny_pipeline(device=args.device)
+    pipe.set_progress_bar_config(disable=True)
+    # measure the text encoders, not the embedding cache
+    pipe.text_embedding_cache = None
+    face_detector = StubFaceAnalysis()
+    rng = np.random.default_rng(0)
+    id_images = [Image.fromarray(rng.integers(0, 256, (512, 512, 3), dtype=np.uint8)) for _ in range(args.num_id_images)]
+    dtype = pipe.unet.dtype
+
+    results = []
+
+    def record(stage, fn, batch_size, aspect_ratio, steps=None, repeat=args.repeat):
+        with torch.no_grad():
+            ms = timeit(fn, repeat=repeat, warmup=1)
+        results.append({"stage": stage, "batch_size": batch_size, "aspect_ratio": aspect_ratio, "steps": steps, "ms": round(ms, 3)})
+
+    id_embeds = detect_id_embeds(face_detector, id_images)
+    identity = pipe.create_identity(id_images, id_embeds)
+    record("face_analysis", lambda: detect_id_embeds(face_detector, id_images), 1, None)
+    record("id_encoding", lambda: pipe.create_identity(id_images, id_embeds), 1, None)
+
+    for batch_size in args.batch_sizes:
+        prompts = [f"a photo of a man img, portrait {i}" for i in range(batch_size)]
+        record("prompt_encoding", lambda: pipe.encode_prompt_single_pass(
+            prompt=prompts, device=args.device, negative_prompt=["blurry"] * batch_size, num_id_images=args.num_id_images,
+        ), batch_size, None)
+
+        for aspect_ratio in args.aspect_ratios:
+            width, height = (max(64, int(size * args.scale) // 16 * 16) for size in aspect_ratios[aspect_ratio])
+            latents = torch.randn(batch_size, 4, height // 8, width // 8, device=args.device, dtype=dtype)
+            # classifier free guidance doubles the batch of the unet
+            unet_kwargs = {
+                "encoder_hidden_states": torch.randn(2 * batch_size, 77, pipe.unet.config.cross_attention_dim, device=args.device, dtype=dtype),
+                "added_cond_kwargs": {
+                    "text_embeds": torch.randn(2 * batch_size, pipe.text_encoder_2.config.projection_dim, device=args.device, dtype=dtype),
+                    "time_ids": torch.tensor([[height, width, 0, 0, height, width]] * 2 * batch_size, device=args.device, dtype=dtype),
+                },
+                "return_dict": False,
+            }
+            sketch = torch.rand(batch_size, 3, height, width, device=args.device, dtype=dtype)
+            adapter_state = pipe.adapter(sketch)
+            adapter_state = [torch.cat([state] * 2) for state in adapter_state]
+
+            record("unet_step", lambda: pipe.unet(torch.cat([latents] * 2), 500, **unet_kwargs), batch_size, aspect_ratio)
+            record("adapter", lambda: pipe.adapter(sketch), batch_size, aspect_ratio)
+            record("unet_step_adapter", lambda: pipe.unet(
+                torch.cat([latents] * 2), 500, down_intrablock_additional_residuals=list(adapter_state), **unet_kwargs
+            ), batch_size, aspect_ratio)
+            images = pipe.vae_decode_stage.decode(latents)
+            record("vae_decode", lambda: pipe.vae_decode_stage.decode(latents), batch_size, aspect_ratio)
+            record("postprocess", lambda: pipe.image_processor.postprocess(images, output_type="pil"), batch_size, aspect_ratio)
+
+            for steps in args.steps:
+                record("denoise", lambda: pipe(
+                    prompt=prompts,
+                    negative_prompt=["blurry"] * batch_size,
+                    width=width,
+                    height=height,
+                    num_inference_steps=steps,
+                    start_merge_step=steps // 5,
+                    identity=identity,
+                    generator=torch.Generator(device=args.device).manual_seed(0),
+                    output_type="latent",
+                ), batch_size, aspect_ratio, steps=steps, repeat=max(1, args.repeat // 2))
+
+    report = {
+        "torch": torch.__version__,
+        "device": args.device,
+        "threads": args.threads,
+        "scale": args.scale,
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            report["regressions"] = compare_to_baseline(results, json.load(f), args.threshold)
+    return report
+
+
+def bench_theme_pack(args):
+    # a pack of `--themes` themes on the tiny models: the per-click loop of gradio_run (identity
+    # lookup and one scheduler job per theme, waiting for each) vs the whole pack queued at once
+    torch.set_num_threads(args.threads)
+    runtime = TinyPhotoMakerRuntime(max_batch_size=args.max_batch_size, max_batch_pixels=None)
+    runtime.pipe.set_progress_bar_config(disable=True)
+    rng = np.random.default_rng(0)
+    id_images = [Image.fromarray(rng.integers(0, 256, (512, 512, 3), dtype=np.uint8)) for _ in range(args.num_id_images)]
+    size = max(64, int(1024 * args.scale) // 16 * 16)
+
+    with tempfile.TemporaryDirectory() as themes_dir:
+        themes_file = os.path.join(themes_dir, "themes.json")
+        with open(themes_file, "w") as f:
+            json.dump({"dream_world_themes": [
+                {
+                    "name": f"theme {i}",
+                    "prompt": f"style {i} of {{prompt}}",
+                    "negative_prompt": "blurry",
+                    "style_name": "(No style)",
+                    "num_steps": args.steps + i % args.step_groups,
+                    "style_strength_ratio": 20,
+                    "guidance_scale": 5.0,
+                }
+                for i in range(args.themes)
+            ]}, f)
+        registry = ThemeRegistry(themes_file)
+        entries = pack_entries(registry, registry.names(), "a child img")
+
+    def per_click():
+        # one click per theme: the identity comes from the cache after the first, each click waits for its images
+        cache = IdentityCache()
+        images = []
+        for i, entry in enumerate(entries):
+            identity = load_identity(runtime.pipe, runtime.face_detector, id_images, cache)
+            job, = pack_jobs([entry], identity, args.seed + i * args.num_outputs, args.num_outputs, size, size)
+            images += runtime.request_scheduler.generate(job)
+        return images
+
+    def pack():
+        identity = load_identity(runtime.pipe, runtime.face_detector, id_images, IdentityCache())
+        jobs = pack_jobs(entries, identity, args.seed, args.num_outputs, size, size)
+        return {index: images for index, images, error in render_pack(runtime.request_scheduler, jobs) if error is None}
+
+    with torch.no_grad():
+        # warm up both paths, the first pipeline calls are slower
+        per_click()
+        pack()
+        start = time.perf_counter()
+        per_click_images = per_click()
+        per_click_s = time.perf_counter() - start
+        start = time.perf_counter()
+        pack_images = pack()
+        pack_s = time.perf_counter() - start
+    runtime.request_scheduler.stop()
+
+    # same seeds, so the pack reproduces the per-click images whatever batches they ran in
+    pack_images = [image for index in range(len(entries)) for image in pack_images[index]]
+    max_diff = max(
+        int(np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)).max())
+        for a, b in zip(per_click_images, pack_images)
+    )
+    return {
+        "themes": len(entries),
+        "images": len(pack_images),
+        "step_groups": args.step_groups,
+        "size": size,
+        "per_click_s": round(per_click_s, 3),
+        "pack_s": round(pack_s, 3),
+        "speedup": round(per_click_s / pack_s, 2),
+        "max_pixel_diff": max_diff,
+        "scheduler": runtime.request_scheduler.stats(),
+    }
+
+
+def bench_samplers(args):
+    # every sampling preset on the tiny models, from the same initial noise. quality is the distance
+    # to a reference run with many steps: on random weights it measures how well a sampler follows
+    # the ODE, not how good the images look. ancestral samplers add noise and solve a different (SDE)
+    # trajectory, a large distance is expected there
+    torch.set_num_threads(args.threads)
+    pipe = build_tiny_pipeline(device=args.device)
+    pipe.set_progress_bar_config(disable=True)
+    shared_scheduler = pipe.scheduler
+    shared_config = dict(pipe.scheduler.config)
+    rng = np.random.default_rng(0)
+    id_images = [Image.fromarray(rng.integers(0, 256, (512, 512, 3), dtype=np.uint8)) for _ in range(args.num_id_images)]
+    identity = pipe.create_identity(id_images, detect_id_embeds(StubFaceAnalysis(), id_images))
+    size = max(64, int(1024 * args.scale) // 16 * 16)
+
+    def run(preset, steps):
+        return pipe(
+            prompt="a photo of a man img",
+            negative_prompt="blurry",
+            width=size,
+            height=size,
+            num_inference_steps=steps,
+            start_merge_step=merge_step(args.style_strength_ratio, steps, preset),
+            identity=identity,
+            generator=torch.Generator(device=args.device).manual_seed(args.seed),
+            output_type="latent",
+            scheduler=get_sampling_preset(preset).make_scheduler(pipe.scheduler.config),
+        ).images
+
+    def decode(latents):
+        return pipe.vae_decode_stage.decode(latents / pipe.vae.config.scaling_factor).clamp(-1, 1).float()
+
+    with torch.no_grad():
+        reference = decode(run(args.reference, args.reference_steps))
+        results = []
+        for name, preset in SAMPLING_PRESETS.items():
+            for steps in sorted({preset.num_steps, *args.steps}):
+                run(name, steps)
+                start = time.perf_counter()
+                for _ in range(args.repeat):
+                    latents = run(name, steps)
+                ms = (time.perf_counter() - start) / args.repeat * 1000
+                mse = float(((decode(latents) - reference) ** 2).mean())
+                results.append({
+                    "preset": name,
+                    "steps": steps,
+                    "start_merge_step": merge_step(args.style_strength_ratio, steps, name),
+                    "ms": round(ms, 1),
+                    "ms_per_step": round(ms / steps, 2),
+                    # images are in [-1, 1], a peak to peak range of 2
+                    "psnr_db": round(10 * np.log10(4 / mse), 2) if mse > 0 else float("inf"),
+                })
+
+    # the presets must never replace or reconfigure the pipeline's own scheduler
+    assert pipe.scheduler is shared_scheduler and dict(pipe.scheduler.config) == shared_config
+    print(f"{'preset':<18}{'steps':>6}{'merge':>7}{'ms':>10}{'ms/step':>9}{'psnr dB':>9}", file=sys.stderr)
+    for result in results:
+        print(
+            f"{result['preset']:<18}{result['steps']:>6}{result['start_merge_step']:>7}{result['ms']:>10}"
+            f"{result['ms_per_step']:>9}{result['psnr_db']:>9}",
+            file=sys.stderr,
+        )
+    return {
+        "reference": f"{args.reference}/{args.reference_steps}",
+        "size": size,
+        "device": args.device,
+        "results": results,
+    }
+
+
+def bench_preview(args):
+    # the cost of the latent previews: the tiny pipeline with and without a preview callback, and
+    # decode_latents_preview alone on the latents of a full size SDXL image. the tiny UNet is far
+    # cheaper than the SDXL one, so the end to end overhead here is an upper bound
+    torch.set_num_threads(args.threads)
+    pipe = build_tiny_pipeline()
+    pipe.set_progress_bar_config(disable=True)
+    rng = np.random.default_rng(0)
+    id_images = [Image.fromarray(rng.integers(0, 256, (512, 512, 3), dtype=np.uint8)) for _ in range(args.num_id_images)]
+    identity = pipe.create_identity(id_images, detect_id_embeds(StubFaceAnalysis(), id_images))
+    size = max(64, int(1024 * args.scale) // 16 * 16)
+
+    def run(preview_steps):
+        previews = []
+        pipe(
+            prompt="a photo of a man img",
+            negative_prompt="blurry",
+            width=size,
+            height=size,
+            num_inference_steps=args.steps,
+            start_merge_step=merge_step(20, args.steps),
+            identity=identity,
+            num_images_per_prompt=args.batch_size,
+            generator=torch.Generator().manual_seed(0),
+            output_type="latent",
+            preview_callback=(lambda step, images: previews.append(images)) if preview_steps else None,
+            preview_steps=preview_steps or 1,
+        )
+        return len(previews)
+
+    with torch.no_grad():
+        baseline_ms = timeit(lambda: run(None), repeat=args.repeat, warmup=1)
+        pipeline = []
+        for preview_steps in args.preview_steps:
+            ms = timeit(lambda: run(preview_steps), repeat=args.repeat, warmup=1)
+            pipeline.append({
+                "preview_steps": preview_steps,
+                "previews": run(preview_steps),
+                "ms": round(ms, 1),
+                "overhead": round(ms / baseline_ms - 1, 4),
+            })
+
+        latents = torch.randn(args.batch_size, 4, 128, 128)
+        preview_ms = timeit(lambda: pipe.decode_latents_preview(latents), repeat=args.repeat * 5)
+    return {
+        "size": size,
+        "steps": args.steps,
+        "batch_size": args.batch_size,
+        "no_preview_ms": round(baseline_ms, 1),
+        "pipeline": pipeline,
+        "preview_1024_ms": round(preview_ms, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    class_tokens = subparsers.add_parser("class-tokens", help="trigger word expansion: Python loop vs tensor ops")
+    class_tokens.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 128])
+    class_tokens.add_argument("--num-id-images", type=int, default=4)
+    class_tokens.add_argument("--repeat", type=int, default=50)
+    class_tokens.set_defaults(fn=bench_class_tokens)
+
+    conditioning = subparsers.add_parser(
+        "denoise-conditioning", help="CFG conditioning: concatenated every step vs prebuilt before the loop"
+    )
+    conditioning.add_argument("--steps", type=int, default=50)
+    conditioning.add_argument("--start-merge-step", type=int, default=10)
+    conditioning.add_argument("--batch-size", type=int, default=1)
+    conditioning.add_argument("--height", type=int, default=1024)
+    conditioning.add_argument("--width", type=int, default=1024)
+    conditioning.add_argument("--dtype", default="float32")
+    conditioning.add_argument("--repeat", type=int, default=10)
+    conditioning.set_defaults(fn=bench_denoise_conditioning)
+
+    perceiver = subparsers.add_parser("perceiver-attention", help="perceiver attention: math path vs sdpa")
+    perceiver.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, 16])
+    perceiver.add_argument("--dtype", default="float32")
+    perceiver.add_argument("--atol", type=float, default=1e-4)
+    perceiver.add_argument("--repeat", type=int, default=20)
+    perceiver.set_defaults(fn=bench_perceiver_attention)
+
+    vae_decode = subparsers.add_parser(
+        "vae-decode", help="VAE decode per aspect ratio: per-call upcast vs float32 decoder copy vs tiled"
+    )
+    vae_decode.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    vae_decode.add_argument("--batch-size", type=int, default=1)
+    vae_decode.add_argument("--chunk-size", type=int, default=1)
+    vae_decode.add_argument("--tile-sample-size", type=int, default=512)
+    vae_decode.add_argument("--scale", type=float, default=1.0, help="shrink every aspect ratio, e.g. 0.25 on CPU")
+    vae_decode.add_argument("--repeat", type=int, default=3)
+    vae_decode.set_defaults(fn=bench_vae_decode)
+
+    checkpoint_load = subparsers.add_parser(
+        "checkpoint-load", help="PhotoMaker checkpoint: torch.load vs split safetensors, cold and warm"
+    )
+    checkpoint_load.add_argument("--lora-mb", type=float, default=200)
+    checkpoint_load.add_argument("--mode", choices=["torch-load", "cold", "warm"], default=None, help=argparse.SUPPRESS)
+    checkpoint_load.add_argument("--checkpoint", help=argparse.SUPPRESS)
+    checkpoint_load.add_argument("--cache-dir", help=argparse.SUPPRESS)
+    checkpoint_load.set_defaults(fn=bench_checkpoint_load)
+
+    id_encoder_fuse = subparsers.add_parser(
+        "id-encoder-fuse", help="ID encoder: monolithic forward per prompt vs encode_identity once + fuse per prompt"
+    )
+    id_encoder_fuse.add_argument("--num-prompts", type=int, default=8)
+    id_encoder_fuse.add_argument("--num-id-images", type=int, default=2)
+    id_encoder_fuse.add_argument("--repeat", type=int, default=3)
+    id_encoder_fuse.set_defaults(fn=bench_id_encoder_fuse)
+
+    staged_pipeline = subparsers.add_parser(
+        "staged-pipeline", help="batch jobs with a stubbed denoiser: one stage after the other vs overlapping stages"
+    )
+    staged_pipeline.add_argument("--jobs", type=int, default=16)
+    staged_pipeline.add_argument("--prefetch-ms", type=float, default=30)
+    staged_pipeline.add_argument("--preprocess-ms", type=float, default=80)
+    staged_pipeline.add_argument("--denoise-ms", type=float, default=200)
+    staged_pipeline.add_argument("--decode-ms", type=float, default=40)
+    staged_pipeline.add_argument("--size", type=int, default=1024, help="side of the PNG the save stage encodes")
+    staged_pipeline.add_argument("--cpu-workers", type=int, default=2)
+    staged_pipeline.set_defaults(fn=bench_staged_pipeline)
+
+    stages = subparsers.add_parser(
+        "stages", help="every pipeline stage on tiny random models, compared with a stored baseline"
+    )
+    stages.add_argument("--device", default="cpu")
+    stages.add_argument("--threads", type=int, default=4, help="torch threads, keep it fixed between runs")
+    stages.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4])
+    stages.add_argument("--steps", type=int, nargs="+", default=[4, 8])
+    stages.add_argument(
+        "--aspect-ratios", nargs="+", default=["Instagram (1:1)", "35mm film / Landscape (3:2)"], choices=list(aspect_ratios)
+    )
+    stages.add_argument("--scale", type=float, default=0.25, help="shrink every aspect ratio")
+    stages.add_argument("--num-id-images", type=int, default=2)
+    stages.add_argument("--repeat", type=int, default=5)
+    stages.add_argument("--output", help="write the results there, e.g. to use them as the baseline")
+    stages.add_argument("--baseline", help="results of an earlier run to compare with")
+    stages.add_argument("--threshold", type=float, default=0.25, help="slowdown that counts as a regression, 0.25 = 25%%")
+    stages.set_defaults(fn=bench_stages)
+
+    theme_pack = subparsers.add_parser(
+        "theme-pack", help="a dream world theme pack on tiny random models: one click per theme vs the whole pack at once"
+    )
+    theme_pack.add_argument("--themes", type=int, default=8)
+    theme_pack.add_argument("--step-groups", type=int, default=2, help="distinct step counts among the themes")
+    theme_pack.add_argument("--steps", type=int, default=4)
+    theme_pack.add_argument("--num-outputs", type=int, default=1)
+    theme_pack.add_argument("--max-batch-size", type=int, default=4)
+    theme_pack.add_argument("--num-id-images", type=int, default=2)
+    theme_pack.add_argument("--scale", type=float, default=0.25, help="shrink the 1024x1024 output")
+    theme_pack.add_argument("--threads", type=int, default=4)
+    theme_pack.add_argument("--seed", type=int, default=0)
+    theme_pack.set_defaults(fn=bench_theme_pack)
+
+    samplers = subparsers.add_parser(
+        "samplers", help="latency and distance to a many-step reference of every sampling preset, on tiny models"
+    )
+    samplers.add_argument("--device", default="cpu")
+    samplers.add_argument("--threads", type=int, default=4)
+    samplers.add_argument("--steps", type=int, nargs="*", default=[8, 20], help="step counts run for every preset besides its own")
+    samplers.add_argument("--reference", default="euler", choices=list(SAMPLING_PRESETS))
+    samplers.add_argument("--reference-steps", type=int, default=100)
+    samplers.add_argument("--style-strength-ratio", type=float, default=20)
+    samplers.add_argument("--scale", type=float, default=0.25, help="shrink the 1024x1024 output")
+    samplers.add_argument("--num-id-images", type=int, default=2)
+    samplers.add_argument("--repeat", type=int, default=2)
+    samplers.add_argument("--seed", type=int, default=0)
+    samplers.set_defaults(fn=bench_samplers)
+
+    preview = subparsers.add_parser(
+        "preview", help="latent previews: the tiny pipeline with and without a preview callback, and one 1024x1024 preview"
+    )
+    preview.add_argument("--steps", type=int, default=20)
+    preview.add_argument("--preview-steps", type=int, nargs="+", default=[1, 5])
+    preview.add_argument("--batch-size", type=int, default=1)
+    preview.add_argument("--scale", type=float, default=0.25, help="shrink the 1024x1024 output")
+    preview.add_argument("--num-id-images", type=int, default=2)
+    preview.add_argument("--threads", type=int, default=4)
+    preview.add_argument("--repeat", type=int, default=5)
+    preview.set_defaults(fn=bench_preview)
+
+    args = parser.parse_args()
+    result = args.fn(args)
+    print(json.dumps(result, indent=2))
+    if isinstance(result, dict) and result.get("regressions"):
+        sys.exit(f"{len(result['regressions'])} measurement(s) regressed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+import hashlib
+import os
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from safetensors import safe_open
+from safetensors.torch import load_file, save_file
+
+# NOTE: the two halves of a PhotoMaker checkpoint, they are stored as separate safetensors
+# files so that each one can be memory-mapped and loaded without the other
+CHECKPOINT_PARTS = ("id_encoder", "lora_weights")
+DEFAULT_CHECKPOINT_CACHE = os.path.join(os.path.expanduser("~"), ".cache", "photomaker")
+
+
+def split_checkpoint_paths(model_file, cache_dir=None):
+    """Paths of the split safetensors files of `model_file` in `cache_dir`"""
+    cache_dir = cache_dir or os.environ.get("PHOTOMAKER_CHECKPOINT_CACHE", DEFAULT_CHECKPOINT_CACHE)
+    # hub files are symlinks to blobs named after their sha256, local files are keyed by size and mtime
+    real_path = os.path.realpath(model_file)
+    stat = os.stat(real_path)
+    key = hashlib.sha256(f"{real_path}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    stem = os.path.splitext(os.path.basename(model_file))[0]
+    return {part: os.path.join(cache_dir, f"{stem}-{key}.{part}.safetensors") for part in CHECKPOINT_PARTS}
+
+
+def _unshare(state_dict):
+    # safetensors refuses tensors that share storage, only those are copied
+    seen = set()
+    tensors = {}
+    for key, tensor in state_dict.items():
+        tensor = tensor.detach().contiguous()
+        ptr = tensor.untyped_storage().data_ptr()
+        tensors[key] = tensor.clone() if ptr in seen else tensor
+        seen.add(ptr)
+    return tensors
+
+
+def convert_checkpoint(model_file, paths):
+    """Convert a pickled PhotoMaker checkpoint to the split safetensors files in `paths`, once"""
+    print(f"[Debug] Converting {model_file} to {list(paths.values())}")
+    try:
+        state_dict = torch.load(model_file, map_location="cpu", mmap=True, weights_only=True)
+    except Exception:
+        # older torch, a checkpoint that is not in the zip format or one that pickles more than tensors
+        state_dict = torch.load(model_file, map_location="cpu")
+    os.makedirs(os.path.dirname(next(iter(paths.values()))), exist_ok=True)
+    for part in CHECKPOINT_PARTS:
+        # write to a temporary file first so that an interrupted conversion is never picked up
+        tmp_path = paths[part] + ".tmp"
+        save_file(_unshare(state_dict[part]), tmp_path)
+        os.replace(tmp_path, paths[part])
+    return paths
+
+
+def load_module_weights(module, path, device, dtype, prefix=""):
+    """
+    Load the tensors of `path` whose keys start with `prefix` into `module`, one at a time.
+
+    `module` should be built under `accelerate.init_empty_weights()`: its parameters are on the
+    meta device and every tensor is read from the memory-mapped file and placed on `device` in
+    `dtype` directly, so the full state dict is never materialized on the CPU.
+    """
+    expected = set(module.state_dict().keys())
+    with safe_open(path, framework="pt", device="cpu") as f:
+        keys = [key for key in f.keys() if key.startswith(prefix)]
+        names = {key[len(prefix):] for key in keys}
+        missing, unexpected = expected - names, names - expected
+        if missing or unexpected:
+            raise RuntimeError(
+                f"Error(s) in loading state_dict for {module.__class__.__name__} from {path}: "
+                f"missing keys {sorted(missing)}, unexpected keys {sorted(unexpected)}"
+            )
+        for key in keys:
+            tensor = f.get_tensor(key)
+            set_module_tensor_to_device(
+                module, key[len(prefix):], device, value=tensor, dtype=dtype if tensor.is_floating_point() else None
+            )
+    # non-persistent buffers (e.g. position ids) were created on the cpu and are not in the file
+    return module.to(device)
+
+
+def load_tensors(path, prefix=""):
+    """State dict of the tensors of `path` whose keys start with `prefix`, with the prefix removed"""
+    if not prefix:
+        return load_file(path)
+    with safe_open(path, framework="pt", device="cpu") as f:
+        return {key[len(prefix):]: f.get_tensor(key) for key in f.keys() if key.startswith(prefix)}
+
+
+def build_empty(module_factory):
+    """Build a module without allocating or initializing its parameters"""
+    with init_empty_weights(include_buffers=False):
+        return module_factory()
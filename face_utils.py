@@ -1,9 +1,14 @@
+import time
+
 import numpy as np
 # pip install insightface==0.7.3
 from insightface.app import FaceAnalysis
+from insightface.app.common import Face
 from insightface.data import get_image as ins_get_image
 
-### 
+import tracing
+
+###
 # https://github.com/cubiq/ComfyUI_IPAdapter_plus/issues/165#issue-2055829543
 ###
 class FaceAnalysis2(FaceAnalysis):
@@ -17,13 +22,56 @@ class FaceAnalysis2(FaceAnalysis):
 
         return super().get(img, max_num)
 
-def analyze_faces(face_analysis: FaceAnalysis, img_data: np.ndarray, det_size=(640, 640)):
-    # NOTE: try detect faces, if no faces detected, lower det_size until it does
-    detection_sizes = [None] + [(size, size) for size in range(640, 256, -64)] + [(256, 256)]
 
-    for size in detection_sizes:
-        faces = face_analysis.get(img_data, det_size=size)
-        if len(faces) > 0:
-            return faces
+def detect_faces(face_analysis: FaceAnalysis, img_data: np.ndarray, det_size=(640, 640)):
+    # NOTE: runs the detector only, unlike FaceAnalysis.get which also runs
+    # every other allowed module (recognition, landmarks...) on every face found
+    if det_size is not None:
+        face_analysis.det_model.input_size = det_size
+    return face_analysis.det_model.detect(img_data, max_num=0, metric='default')
+
+
+def embed_face(face_analysis: FaceAnalysis, img_data: np.ndarray, bbox, kps, det_score):
+    face = Face(bbox=bbox, kps=kps, det_score=det_score)
+    for taskname, model in face_analysis.models.items():
+        if taskname == 'detection':
+            continue
+        model.get(img_data, face)
+    return face
+
+
+def analyze_faces(face_analysis: FaceAnalysis, img_data: np.ndarray, det_size=(640, 640), timings=None):
+    # NOTE: try detect faces, if no faces detected, lower det_size until it does.
+    # only the detector runs for each size, recognition runs once on the best face found.
+    # pass a dict as `timings` to get the seconds spent in each stage.
+    detection_sizes = [det_size] + [(size, size) for size in range(det_size[0] - 64, 256, -64)] + [(256, 256)]
+    detection_sizes = list(dict.fromkeys(detection_sizes))
+    timings = {} if timings is None else timings
+    timings["detection"] = 0.0
+    timings["recognition"] = 0.0
+
+    for attempt, size in enumerate(detection_sizes, start=1):
+        start = time.perf_counter()
+        with tracing.span("face_detection", det_size=list(size)):
+            bboxes, kpss = detect_faces(face_analysis, img_data, det_size=size)
+        timings["detection"] += time.perf_counter() - start
+        tracing.count("face_detection_attempts")
+        timings["detection_attempts"] = attempt
+        if bboxes.shape[0] > 0:
+            timings["det_size"] = size
+            break
+    else:
+        return []
 
-    return []
+    best = int(np.argmax(bboxes[:, 4]))
+    start = time.perf_counter()
+    with tracing.span("face_recognition"):
+        face = embed_face(
+            face_analysis,
+            img_data,
+            bbox=bboxes[best, 0:4],
+            kps=kpss[best] if kpss is not None else None,
+            det_score=bboxes[best, 4],
+        )
+    timings["recognition"] = time.perf_counter() - start
+    return [face]
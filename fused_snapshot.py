@@ -0,0 +1,91 @@
+"""
+Fused PhotoMaker snapshots: the SDXL UNet with the PhotoMaker LoRA already fused in and the
+ID encoder in the target dtype, saved once so that later starts skip `load_lora_weights` and
+`fuse_lora` entirely.
+
+    PHOTOMAKER_SNAPSHOT_DIR=/models/snapshots python fused_snapshot.py
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from diffusers import UNet2DConditionModel
+from safetensors.torch import save_file
+
+# bump when the layout of a snapshot changes, older snapshots are then ignored
+SNAPSHOT_FORMAT = 1
+
+
+def fingerprint(path):
+    """Hash of the paths, sizes and mtimes of a file or of every file below a directory"""
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        files = [path]
+    else:
+        files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+    for file in files:
+        # hub files are symlinks to blobs named after their content hash
+        real_path = os.path.realpath(file)
+        stat = os.stat(real_path)
+        digest.update(f"{os.path.relpath(file, path)}:{real_path}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def snapshot_key(base_model_dir, photomaker_ckpt, torch_dtype, pm_version="v2"):
+    digest = hashlib.sha256()
+    for part in (SNAPSHOT_FORMAT, fingerprint(base_model_dir), fingerprint(photomaker_ckpt), torch_dtype, pm_version):
+        digest.update(f"{part}\n".encode())
+    return digest.hexdigest()[:32]
+
+
+class FusedSnapshot:
+    """One snapshot directory: `unet/` in the diffusers layout, `id_encoder.safetensors` and `manifest.json`"""
+
+    def __init__(self, root, key):
+        self.key = key
+        self.path = os.path.join(root, key)
+        self.unet_dir = os.path.join(self.path, "unet")
+        self.id_encoder_file = os.path.join(self.path, "id_encoder.safetensors")
+        self.manifest_file = os.path.join(self.path, "manifest.json")
+
+    def exists(self):
+        # the manifest is written last, a snapshot without it is incomplete
+        return os.path.exists(self.manifest_file)
+
+    def load_unet(self, torch_dtype):
+        return UNet2DConditionModel.from_pretrained(self.unet_dir, torch_dtype=torch_dtype)
+
+    def save(self, pipe, base_model_path, photomaker_ckpt):
+        """Save the fused UNet and the ID encoder of `pipe`, the LoRA must be fused and unloaded already"""
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        pipe.unet.save_pretrained(os.path.join(tmp_path, "unet"))
+        id_encoder_state = {k: v.detach().to("cpu").contiguous() for k, v in pipe.id_encoder.state_dict().items()}
+        save_file(id_encoder_state, os.path.join(tmp_path, "id_encoder.safetensors"))
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+            json.dump({
+                "format": SNAPSHOT_FORMAT,
+                "key": self.key,
+                "base_model": base_model_path,
+                "photomaker_ckpt": photomaker_ckpt,
+                "dtype": str(pipe.unet.dtype),
+                "trigger_word": pipe.trigger_word,
+                "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            }, f, indent=2)
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.replace(tmp_path, self.path)
+        print(f"[Debug] Saved the fused snapshot to {self.path}")
+
+
+if __name__ == "__main__":
+    # the "compile artifacts" step of a deploy: build the snapshot once, later starts load it
+    from runtime import PhotoMakerRuntime
+
+    runtime = PhotoMakerRuntime.from_env()
+    if runtime.snapshot_dir is None:
+        raise SystemExit("Set PHOTOMAKER_SNAPSHOT_DIR to the directory the snapshot should be saved to.")
+    runtime.pipe
+    print(f"[Debug] Snapshot ready in {runtime.load_times}")
@@ -1,37 +1,38 @@
 from run import (
-    pipe, 
-    device, 
-    face_detector, 
+    runtime,
     apply_style, 
-    styles, 
-    aspect_ratios,
-    analyze_faces, 
-    torch, 
-    np, 
-    load_image,
-    TF
+    DEFAULT_NEGATIVE_PROMPT,
+    load_identity,
 )
+from media_store import MediaStore
+from prompt_utils import check_trigger_word
+from theme_pack import pack_entries, pack_jobs, render_pack
+from theme_registry import ThemeRegistry
+from request_queue import GenerationJob
+from runtime import warmup_enabled
+from sampling_presets import merge_step
 import gradio as gr
 import json
 import os
 import random
-from datetime import datetime
-import shutil
-from PIL import Image
-import io
-import glob
+import time
 
 # Constants
-IMG_DIR = "img"
-GEN_IMG_DIR = "gen_img"
+GEN_IMG_DIR = os.environ.get("PHOTOMAKER_MEDIA_DIR", "gen_img")
 THEMES_FILE = "dream_world_presets.json"
 
+# NOTE: every request keeps its uploads in memory and writes its outputs to its own
+# directory below GEN_IMG_DIR, directories of old requests are removed after the retention
+media_store = MediaStore(
+    root=GEN_IMG_DIR,
+    retention_seconds=float(os.environ.get("PHOTOMAKER_MEDIA_RETENTION", 3600)),
+    max_requests=int(os.environ.get("PHOTOMAKER_MEDIA_MAX_REQUESTS", 100)),
+)
+# NOTE: parsed once, reloaded when the file changes on disk
+theme_registry = ThemeRegistry(THEMES_FILE)
+
 def setup_environment():
-    """Set up the necessary directories and theme data"""
-    # Create directories if they don't exist
-    os.makedirs(IMG_DIR, exist_ok=True)
-    os.makedirs(GEN_IMG_DIR, exist_ok=True)
-    
+    """Set up the theme data"""
     # Generate theme presets file if it doesn't exist
     if not os.path.exists(THEMES_FILE):
         create_theme_presets()
@@ -156,29 +157,19 @@ def create_theme_presets():
     with open(THEMES_FILE, 'w') as f:
         json.dump(theme_data, f, indent=2)
 
-def load_theme_data():
-    """Load themes from the JSON file"""
-    with open(THEMES_FILE, 'r') as f:
-        return json.load(f)
-
 def get_theme_names():
     """Get list of theme names for dropdown"""
-    theme_data = load_theme_data()
-    return [theme["name"] for theme in theme_data["dream_world_themes"]]
+    return theme_registry.names()
 
 def get_theme_by_name(name):
     """Get theme data by name"""
-    theme_data = load_theme_data()
-    for theme in theme_data["dream_world_themes"]:
-        if theme["name"] == name:
-            return theme
-    return None
+    return theme_registry.get(name)
 
 def get_season_options(theme_name):
     """Get season options if available"""
     theme = get_theme_by_name(theme_name)
-    if theme and "seasons" in theme:
-        return theme["seasons"]
+    if theme:
+        return theme.seasons
     return []
 
 def update_season_dropdown(theme_name):
@@ -195,17 +186,9 @@ def update_theme_params(theme_name, season=None, custom_prompt=None):
     if not theme:
         return "", "", "", 50, 20, 5.0
     
-    prompt_template = theme["prompt"]
-    
-    # Inject custom prompt if provided
-    final_prompt = prompt_template
-    if custom_prompt:
-        final_prompt = prompt_template.replace("{prompt}", custom_prompt)
-    
-    # Handle season replacement if applicable
-    if season and "[season]" in final_prompt:
-        final_prompt = final_prompt.replace("[season]", season)
-        
+    # Inject custom prompt and season if provided
+    final_prompt = theme.render(custom_prompt, season)
+
     return (
         final_prompt, 
         theme["negative_prompt"], 
@@ -215,47 +198,28 @@ def update_theme_params(theme_name, season=None, custom_prompt=None):
         theme["guidance_scale"]
     )
 
-def process_images(uploaded_files):
-    """Process uploaded images and return their paths"""
-    # Clear existing images in directory
-    for file in os.listdir(IMG_DIR):
-        file_path = os.path.join(IMG_DIR, file)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
-    
-    # Save uploaded files
-    image_paths = []
-    for i, file in enumerate(uploaded_files):
-        if file is not None:
-            file_path = os.path.join(IMG_DIR, f"uploaded_img_{i}.png")
-            if isinstance(file, str):  # If already a path
-                shutil.copy(file, file_path)
-            else:  # If a file object
-                img = Image.open(file)
-                img.save(file_path)
-            image_paths.append(file_path)
-    
-    return image_paths
+def process_images(uploaded_files, media):
+    """Decode the uploaded images into the request's media, nothing is written to disk"""
+    return media.add_uploads(uploaded_files)
 
 # Direct implementation of image generation (bypassing run.py to have exact same behavior as app.py)
 def generate_photomaker_image(
-    image_paths,
+    id_images,
     prompt,
     negative_prompt,
     style_name,
     num_steps,
     style_strength_ratio,
     guidance_scale,
-    seed
+    seed,
+    num_outputs=1
 ):
-    # Check for trigger word
-    image_token_id = pipe.tokenizer.convert_tokens_to_ids(pipe.trigger_word)
-    input_ids = pipe.tokenizer.encode(prompt)
-    if image_token_id not in input_ids:
-        raise ValueError(f"Cannot find the trigger word '{pipe.trigger_word}' in text prompt! Please add 'img' to your prompt.")
+    pipe = runtime.pipe
+    face_detector = runtime.face_detector
+    identity_cache = runtime.identity_cache
 
-    if input_ids.count(image_token_id) > 1:
-        raise ValueError(f"Cannot use multiple trigger words '{pipe.trigger_word}' in text prompt!")
+    # Check for trigger word
+    check_trigger_word(pipe, prompt)
 
     # Determine output dimensions - using square format (1:1 aspect ratio) as in the original app
     output_w, output_h = 1024, 1024  # Default to square format like the original
@@ -263,54 +227,36 @@ def generate_photomaker_image(
     # Apply the style template
     prompt, negative_prompt = apply_style(style_name, prompt, negative_prompt)
 
-    input_id_images = []
-    for img_path in image_paths:
-        input_id_images.append(load_image(img_path))
-    
-    id_embed_list = []
-
-    for img in input_id_images:
-        img = np.array(img)
-        img = img[:, :, ::-1]  # RGB to BGR
-        faces = analyze_faces(face_detector, img)
-        if len(faces) > 0:
-            id_embed_list.append(torch.from_numpy((faces[0]['embedding'])))
-
-    if len(id_embed_list) == 0:
-        raise ValueError("No face detected, please update the input face image(s)")
-    
-    id_embeds = torch.stack(id_embed_list)
-
-    generator = torch.Generator(device=device).manual_seed(seed)
+    # ArcFace embeddings and ID tokens are reused when the same photos were seen before
+    identity = load_identity(pipe, face_detector, id_images, identity_cache)
+    print(f"[Debug] Identity cache: {identity_cache.stats()}")
 
     print("Start inference...")
-    print(f"[Debug] Seed: {seed}")
+    print(f"[Debug] Seeds: {list(range(seed, seed + num_outputs))}")
     print(f"[Debug] Prompt: {prompt}")
     print(f"[Debug] Neg Prompt: {negative_prompt}")
     
-    start_merge_step = int(float(style_strength_ratio) / 100 * num_steps)
-    if start_merge_step > 30:
-        start_merge_step = 30
+    start_merge_step = merge_step(style_strength_ratio, num_steps)
     print(f"[Debug] Start merge step: {start_merge_step}")
     
-    images = pipe(
+    # concurrent requests with the same settings are denoised together by the runtime's scheduler
+    job = GenerationJob(
         prompt=prompt,
+        negative_prompt=negative_prompt,
+        identity=identity,
         width=output_w,
         height=output_h,
-        input_id_images=input_id_images,
-        negative_prompt=negative_prompt,
-        num_images_per_prompt=1,
-        num_inference_steps=num_steps,
+        num_steps=num_steps,
         start_merge_step=start_merge_step,
-        generator=generator,
         guidance_scale=guidance_scale,
-        id_embeds=id_embeds,
-        image=None,  # No sketch image
-        adapter_conditioning_scale=0.0,  # Disable adapter
-        adapter_conditioning_factor=0.0,  # Disable adapter
-    ).images
-    
-    return images
+        seed=seed,
+        num_outputs=num_outputs,
+        sketch_image=None,  # No sketch image, the adapter is disabled
+    )
+    # image i gets the seed `seed + i`, the scheduler splits the job when the images do not fit in one batch
+    # yields (previews, False) while denoising and (images, True) at the end
+    yield from runtime.request_scheduler.stream(job)
+    print(f"[Debug] Request scheduler: {runtime.request_scheduler.stats()}")
 
 def generate_images(
     uploaded_files, 
@@ -326,53 +272,109 @@ def generate_images(
     num_outputs, 
     seed
 ):
-    """Generate images using the provided parameters"""
+    """Generate images using the provided parameters, the gallery shows previews until they are done"""
     if not uploaded_files:
-        return "❌ Please upload at least one image of the child.", []
+        yield "❌ Please upload at least one image of the child.", []
+        return
     
-    # Process uploaded images
-    image_paths = process_images(uploaded_files)
+    media = media_store.open_request()
     
     # Generate a random seed if necessary
     if seed == 0:
         seed = random.randint(0, 2147483647)
-    
-    # Generate timestamp for unique filenames
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    
-    # Clear previous generated images
-    for file in os.listdir(GEN_IMG_DIR):
-        file_path = os.path.join(GEN_IMG_DIR, file)
-        if os.path.isfile(file_path):
-            os.remove(file_path)
+    seed = int(seed)
     
     # Import the actual generation function
     try:
+        # Uploads are decoded in memory and passed as images, no other request can touch them
+        id_images = process_images(uploaded_files, media)
+
         # Use our direct implementation for exact same behavior
-        generated_images = generate_photomaker_image(
-            image_paths=image_paths,
+        for generated_images, done in generate_photomaker_image(
+            id_images=id_images,
             prompt=prompt,
             negative_prompt=negative_prompt,
             style_name=style_name,
             num_steps=num_steps,
             style_strength_ratio=style_strength_ratio,
             guidance_scale=guidance_scale,
-            seed=seed
-        )
+            seed=seed,
+            num_outputs=int(num_outputs)
+        ):
+            if not done:
+                yield "⏳ Generating...", generated_images
         
-        # Save generated images
-        saved_paths = []
+        # Save generated images in the background, the gallery shows them right away
         theme_name_safe = theme_name.replace(" ", "_").lower()
+        media.save_outputs(generated_images, prefix=f"dream_{theme_name_safe}")
         
-        for i, img in enumerate(generated_images[:num_outputs]):
-            save_path = f"{GEN_IMG_DIR}/dream_{theme_name_safe}_{timestamp}_{i+1}.png"
-            img.save(save_path)
-            saved_paths.append(save_path)
-        
-        return f"✅ Generated {len(saved_paths)} images successfully!", saved_paths
+        yield f"✅ Generated {len(generated_images)} images successfully! Seeds {seed} to {seed + len(generated_images) - 1}, image i uses seed + i. Saved to {media.dir}", generated_images
         
     except Exception as e:
-        return f"❌ Error generating images: {str(e)}\n\nTips: Make sure your images have clear faces and the prompt includes 'img' after the subject.", []
+        yield f"❌ Error generating images: {str(e)}\n\nTips: Make sure your images have clear faces and the prompt includes 'img' after the subject.", []
+    finally:
+        media.close()
+
+def generate_pack(uploaded_files, pack_themes, pack_seasons, custom_prompt, num_outputs, seed):
+    """Render every selected theme (and season) with one identity, the gallery fills up as the themes finish"""
+    if not uploaded_files:
+        yield "❌ Please upload at least one image of the child.", []
+        return
+    if not pack_themes:
+        yield "❌ Please select at least one theme for the pack.", []
+        return
+
+    media = media_store.open_request()
+    if seed == 0:
+        seed = random.randint(0, 2147483647)
+    seed = int(seed)
+    num_outputs = int(num_outputs)
+
+    try:
+        start = time.perf_counter()
+        pipe = runtime.pipe
+        entries = pack_entries(theme_registry, pack_themes, custom_prompt, pack_seasons)
+        renderable, skipped = [], []
+        for entry in entries:
+            try:
+                check_trigger_word(pipe, entry.prompt)
+            except ValueError as e:
+                skipped.append(f"{entry.label}: {e}")
+            else:
+                renderable.append(entry)
+        entries = renderable
+        if not entries:
+            yield "❌ No theme of the pack can be rendered:\n" + "\n".join(skipped), []
+            return
+
+        # the identity is encoded once for the whole pack
+        id_images = process_images(uploaded_files, media)
+        identity = load_identity(pipe, runtime.face_detector, id_images, runtime.identity_cache)
+        jobs = pack_jobs(entries, identity, seed, num_outputs=num_outputs)
+        print(f"[Debug] Rendering a pack of {len(entries)} themes, {len(jobs) * num_outputs} images, seeds {seed} to {seed + len(jobs) * num_outputs - 1}")
+
+        gallery_items = []
+        failed = []
+        for index, images, error in render_pack(runtime.request_scheduler, jobs):
+            entry = entries[index]
+            if error is not None:
+                failed.append(f"{entry.label}: {error}")
+                continue
+            label_safe = entry.label.replace(" ", "_").lower()
+            media.save_outputs(images, prefix=f"pack_{label_safe}")
+            gallery_items.extend((image, entry.label) for image in images)
+            yield f"⏳ {len(gallery_items)} of {len(jobs) * num_outputs} images done ({time.perf_counter() - start:.1f}s)", gallery_items
+        print(f"[Debug] Request scheduler: {runtime.request_scheduler.stats()}")
+
+        status = f"✅ Rendered {len(gallery_items)} images of {len(entries) - len(failed)} themes in {time.perf_counter() - start:.1f}s. Saved to {media.dir}"
+        if skipped or failed:
+            status += "\n\nSkipped:\n" + "\n".join(skipped + failed)
+        yield status, gallery_items
+
+    except Exception as e:
+        yield f"❌ Error rendering the pack: {str(e)}\n\nTips: Make sure your images have clear faces and the custom prompt includes 'img' after the subject.", []
+    finally:
+        media.close()
 
 # Initialize environment
 setup_environment()
@@ -437,7 +439,7 @@ with gr.Blocks(title="Dream World Photo Generator") as demo:
                     label="Negative Prompt",
                     info="What to avoid in the image",
                     lines=2,
-                    value="nsfw, lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
+                    value=DEFAULT_NEGATIVE_PROMPT
                 )
                 style_name = gr.Textbox(label="Style Name")
             
@@ -490,6 +492,22 @@ with gr.Blocks(title="Dream World Photo Generator") as demo:
     
     with gr.Row():
         gallery = gr.Gallery(label="Generated Images", columns=2, height=500)
+
+    # Theme Pack Section
+    with gr.Accordion("📚 Render a Theme Pack", open=False):
+        gr.Markdown("Render the uploaded child in several themes at once, e.g. every season for a calendar or a set of styles for stickers. Uses the custom prompt, the number of images and the seed above.")
+        with gr.Row():
+            pack_themes = gr.CheckboxGroup(
+                choices=get_theme_names(),
+                label="Themes",
+                info="Every selected theme is rendered, themes with seasons once per season"
+            )
+            pack_seasons = gr.CheckboxGroup(
+                choices=sorted({season for name in get_theme_names() for season in get_season_options(name)}),
+                label="Seasons",
+                info="Leave empty for all seasons"
+            )
+        pack_btn = gr.Button("📚 Render Pack", variant="secondary")
     
     # Set up theme change event to update parameters
     theme_dropdown.change(
@@ -538,7 +556,17 @@ with gr.Blocks(title="Dream World Photo Generator") as demo:
             num_outputs,
             seed
         ],
-        outputs=[result_text, gallery]
+        outputs=[result_text, gallery],
+        # uploads and outputs are per request now, concurrent clicks are batched by the scheduler
+        concurrency_limit=2 * runtime.max_batch_size,
+    )
+
+    pack_btn.click(
+        fn=generate_pack,
+        inputs=[upload, pack_themes, pack_seasons, custom_prompt, num_outputs, seed],
+        outputs=[result_text, gallery],
+        # a pack already fills the batches on its own
+        concurrency_limit=1,
     )
 
     # Add instructions
@@ -568,6 +596,9 @@ with gr.Blocks(title="Dream World Photo Generator") as demo:
 def launch_app():
     # First setup the environment
     setup_environment()
+    # load the models and encode the negative prompt of every style before the first click
+    if warmup_enabled():
+        runtime.warmup()
     # Launch the Gradio interface
     demo.launch(debug=True, share=True)
 
@@ -0,0 +1,191 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from PIL import Image
+from diffusers.utils import load_image
+from safetensors.torch import load_file, save_file
+
+from face_utils import analyze_faces
+from identity_handle import IdentityHandle
+import tracing
+
+
+def hash_identity_images(images):
+    """Content hash of an ordered set of reference images (paths, bytes or PIL images)"""
+    digest = hashlib.sha256()
+    for img in images:
+        if isinstance(img, (bytes, bytearray)):
+            data = bytes(img)
+        elif isinstance(img, Image.Image):
+            data = f"{img.mode}:{img.size}".encode() + img.tobytes()
+        else:
+            with open(img, "rb") as f:
+                data = f.read()
+        # hash every image separately so that the image boundaries are part of the key
+        digest.update(hashlib.sha256(data).digest())
+    return digest.hexdigest()
+
+
+def model_fingerprint(*parts):
+    """
+    Short hash of what the tensors of an `IdentityHandle` depend on besides the photos, e.g. the
+    `fused_snapshot.fingerprint` of the PhotoMaker checkpoint, the dtype and the face detector.
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(f"{part}\n".encode())
+    return digest.hexdigest()[:16]
+
+
+def _entry_nbytes(entry):
+    return entry.nbytes
+
+
+class IdentityCache:
+    """In-memory LRU of `IdentityHandle`s with an optional on-disk store.
+
+    Entries are keyed by `hash_identity_images` and evicted least recently used
+    first once their total size exceeds `max_bytes` or their number exceeds
+    `max_entries`. When `cache_dir` is set every entry is also written there as a
+    safetensors file, so a restarted process can pick up identities it has seen
+    before, evicted ones included. The files go to a subdirectory named after
+    `fingerprint` (see `model_fingerprint`), so identities computed by another
+    checkpoint, dtype or face detector are never served from disk.
+    """
+
+    def __init__(self, max_bytes=1024 ** 3, cache_dir=None, max_entries=None, fingerprint=None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.fingerprint = fingerprint
+        if cache_dir is not None and fingerprint is not None:
+            cache_dir = os.path.join(cache_dir, fingerprint)
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries or (self._disk_path(key) is not None and os.path.exists(self._disk_path(key)))
+
+    def _disk_path(self, key):
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, f"{key}.safetensors")
+
+    def _insert(self, key, entry):
+        # called with the lock held
+        if key in self._entries:
+            self.current_bytes -= _entry_nbytes(self._entries.pop(key))
+        self._entries[key] = entry
+        self.current_bytes += _entry_nbytes(entry)
+        while len(self._entries) > 1 and (
+            self.current_bytes > self.max_bytes
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            _, evicted = self._entries.popitem(last=False)
+            self.current_bytes -= _entry_nbytes(evicted)
+            self.evictions += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+
+            path = self._disk_path(key)
+            if path is not None and os.path.exists(path):
+                entry = IdentityHandle.from_tensors(load_file(path), key=key)
+                self._insert(key, entry)
+                self.hits += 1
+                return entry
+
+            self.misses += 1
+            return None
+
+    def put(self, key, entry):
+        entry = entry.to("cpu")
+        entry.key = key
+        with self._lock:
+            self._insert(key, entry)
+        path = self._disk_path(key)
+        if path is not None:
+            save_file(entry.tensors(), path)
+        return entry
+
+    def evict(self, key):
+        """Drop `key` from memory, it stays on disk when there is a `cache_dir`"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.current_bytes -= _entry_nbytes(entry)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self.current_bytes,
+            "max_bytes": self.max_bytes,
+            "max_entries": self.max_entries,
+        }
+
+
+def detect_id_embeds(face_detector, input_id_images):
+    """ArcFace embeddings of the first face found in every ID image, [num_faces, 512]"""
+    id_embed_list = []
+
+    for img in input_id_images:
+        img = np.array(img)
+        img = img[:, :, ::-1]  # RGB to BGR
+        timings = {}
+        faces = analyze_faces(face_detector, img, timings=timings)
+        print(f"[Debug] Face analysis: {timings}")
+        if len(faces) > 0:
+            id_embed_list.append(torch.from_numpy((faces[0]['embedding'])))
+
+    if len(id_embed_list) == 0:
+        raise ValueError("No face detected, please update the input face image(s)")
+
+    return torch.stack(id_embed_list)
+
+
+def load_identity(pipe, face_detector, image_paths, cache=None):
+    """Return the `IdentityHandle` of `image_paths` (paths or decoded PIL images), computing it only on a cache miss"""
+    key = hash_identity_images(image_paths) if cache is not None else None
+    if cache is not None:
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+
+    input_id_images = []
+    with tracing.span("image_load", num_images=len(image_paths)):
+        for img_path in image_paths:
+            input_id_images.append(load_image(img_path))
+
+    id_embeds = detect_id_embeds(face_detector, input_id_images)
+    entry = pipe.create_identity(input_id_images, id_embeds, key=key)
+
+    if cache is not None:
+        entry = cache.put(key, entry)
+    return entry
@@ -0,0 +1,59 @@
+import torch
+
+
+class IdentityHandle:
+    """Everything the pipeline needs about one person, computed once from their reference photos.
+
+    `id_pixel_values` are the CLIP-preprocessed photos, `id_embeds` their ArcFace embeddings,
+    `last_hidden_state` the output of the CLIP vision tower and `id_tokens` the output of the
+    QFormer perceiver. Pass the handle to the pipeline as `identity=` and none of them is
+    recomputed, only the prompt dependent fuse step runs per request. Tensors are kept on the
+    CPU and moved to the device by the pipeline.
+    """
+
+    TENSOR_KEYS = ("id_pixel_values", "id_embeds", "last_hidden_state", "id_tokens")
+
+    def __init__(self, id_embeds, id_tokens, last_hidden_state=None, id_pixel_values=None, key=None):
+        self.key = key
+        self.id_embeds = id_embeds
+        self.id_tokens = id_tokens
+        self.last_hidden_state = last_hidden_state
+        self.id_pixel_values = id_pixel_values
+
+    @property
+    def num_id_images(self):
+        return self.id_tokens.shape[-3]
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() * t.element_size() for t in self.tensors().values())
+
+    def tensors(self):
+        return {k: getattr(self, k) for k in self.TENSOR_KEYS if getattr(self, k) is not None}
+
+    def to(self, device):
+        tensors = {k: v.detach().to(device).contiguous() for k, v in self.tensors().items()}
+        return IdentityHandle(key=self.key, **tensors)
+
+    @classmethod
+    def from_tensors(cls, tensors, key=None):
+        return cls(key=key, **{k: tensors[k] for k in cls.TENSOR_KEYS if k in tensors})
+
+    def __getitem__(self, name):
+        # identities used to be plain dicts of tensors
+        if name not in self.TENSOR_KEYS:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __repr__(self):
+        return f"IdentityHandle(key={self.key!r}, num_id_images={self.num_id_images}, nbytes={self.nbytes})"
+
+
+def stack_identity_tokens(identities):
+    """ID tokens of one identity per prompt, [len(identities), num_id_images, num_tokens, 2048]"""
+    if isinstance(identities, IdentityHandle):
+        identities = [identities]
+    num_id_images = {identity.num_id_images for identity in identities}
+    if len(num_id_images) > 1:
+        raise ValueError(f"Every identity of a batch needs the same number of ID images, got {sorted(num_id_images)}.")
+    return torch.cat([identity.id_tokens.reshape(1, *identity.id_tokens.shape[-3:]) for identity in identities])
@@ -0,0 +1,157 @@
+import concurrent.futures
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+from PIL import Image, ImageOps
+
+import tracing
+
+DEFAULT_MEDIA_ROOT = os.path.join(tempfile.gettempdir(), "photomaker-media")
+
+
+def decode_upload(file):
+    """RGB image of an upload: a path, a file object with a `name` (what gradio passes), raw bytes or a PIL image"""
+    if isinstance(file, Image.Image):
+        return ImageOps.exif_transpose(file).convert("RGB")
+    source = io.BytesIO(file) if isinstance(file, (bytes, bytearray)) else getattr(file, "name", file)
+    with Image.open(source) as image:
+        # decoded once here, the image is never written back to disk before face analysis
+        return ImageOps.exif_transpose(image).convert("RGB")
+
+
+class RequestMedia:
+    """The uploads and outputs of one request.
+
+    Uploads are kept decoded in memory and go straight to face analysis and the ID image
+    processor. The request directory is only created when a file is needed: when outputs
+    are saved or when `upload_paths` spills the uploads for code that only takes paths.
+    """
+
+    def __init__(self, store, request_id):
+        self.store = store
+        self.request_id = request_id
+        self.uploads = []
+        self.outputs = []
+        self._dir = None
+
+    @property
+    def dir(self):
+        if self._dir is None:
+            self._dir = os.path.join(self.store.root, self.request_id)
+            os.makedirs(self._dir, exist_ok=True)
+        return self._dir
+
+    def add_uploads(self, files):
+        with tracing.span("upload_decode", num_images=len(files)):
+            self.uploads.extend(decode_upload(file) for file in files if file is not None)
+        return self.uploads
+
+    def upload_paths(self):
+        paths = []
+        for i, image in enumerate(self.uploads):
+            path = os.path.join(self.dir, f"upload_{i}.png")
+            if not os.path.exists(path):
+                image.save(path)
+            paths.append(path)
+        return paths
+
+    def save_outputs(self, images, prefix="output"):
+        """Write `images` as PNGs in the background, returns the paths they will have"""
+        paths = []
+        for image in images:
+            path = os.path.join(self.dir, f"{prefix}_{len(self.outputs) + 1}.png")
+            self.outputs.append(self.store.write(image, path))
+            paths.append(path)
+        return paths
+
+    def wait(self, timeout=None):
+        """Block until every output is written, returns their paths"""
+        return [future.result(timeout=timeout) for future in self.outputs]
+
+    def close(self):
+        """Drop the uploads, the request is released to `gc` once its pending outputs are written"""
+        # the outputs stay on disk until the store's retention expires
+        self.uploads = []
+        pending = [future for future in self.outputs if not future.done()]
+        if not pending:
+            self.store.release(self)
+            return
+        # NOTE: releasing before the writes finish would let `gc` remove the directory under them
+        remaining = [len(pending)]
+        lock = threading.Lock()
+
+        def on_written(future):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                self.store.release(self)
+
+        for future in pending:
+            future.add_done_callback(on_written)
+
+
+class MediaStore:
+    """Per-request media with background PNG writes and a retention policy.
+
+    Every request gets its own `RequestMedia`, so concurrent sessions never see or delete
+    each other's files. Output PNGs are encoded on `writer_workers` threads while the next
+    request runs. Request directories older than `retention_seconds`, and the oldest ones
+    beyond `max_requests`, are removed when a new request opens; open requests are kept.
+    """
+
+    def __init__(self, root=None, retention_seconds=3600, max_requests=100, writer_workers=2):
+        self.root = root or DEFAULT_MEDIA_ROOT
+        self.retention_seconds = retention_seconds
+        self.max_requests = max_requests
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=writer_workers, thread_name_prefix="photomaker-media"
+        )
+        self._open = set()
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def open_request(self):
+        self.gc()
+        request_id = f"{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+        with self._lock:
+            self._open.add(request_id)
+        return RequestMedia(self, request_id)
+
+    def release(self, media):
+        with self._lock:
+            self._open.discard(media.request_id)
+
+    def write(self, image, path):
+        return self._executor.submit(self._write, image, path)
+
+    @staticmethod
+    def _write(image, path):
+        with tracing.span("png_encode"):
+            # a partially written file is never visible under the final name
+            tmp_path = f"{path}.tmp"
+            image.save(tmp_path, format="PNG")
+            os.replace(tmp_path, path)
+        return path
+
+    def gc(self):
+        """Remove the directories of expired requests, returns how many were removed"""
+        with self._lock:
+            open_requests = set(self._open)
+        entries = sorted(
+            (entry for entry in os.scandir(self.root) if entry.is_dir() and entry.name not in open_requests),
+            key=lambda entry: entry.stat().st_mtime,
+        )
+        now = time.time()
+        excess = max(0, len(entries) - self.max_requests)
+        removed = 0
+        for i, entry in enumerate(entries):
+            if i < excess or now - entry.stat().st_mtime > self.retention_seconds:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        return removed
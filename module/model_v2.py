@@ -41,7 +41,7 @@ class MLP(nn.Module):
 
 
 class QFormerPerceiver(nn.Module):
-    def __init__(self, id_embeddings_dim, cross_attention_dim, num_tokens, embedding_dim=1024, use_residual=True, ratio=4):
+    def __init__(self, id_embeddings_dim, cross_attention_dim, num_tokens, embedding_dim=1024, use_residual=True, ratio=4, attention_backend="auto", dim_head=128):
         super().__init__()
 
         self.num_tokens = num_tokens
@@ -57,11 +57,12 @@ class QFormerPerceiver(nn.Module):
         self.perceiver_resampler = FacePerceiverResampler(
             dim=cross_attention_dim,
             depth=4,
-            dim_head=128,
-            heads=cross_attention_dim // 128,
+            dim_head=dim_head,
+            heads=cross_attention_dim // dim_head,
             embedding_dim=embedding_dim,
             output_dim=cross_attention_dim,
             ff_mult=4,
+            attention_backend=attention_backend,
         )
 
     def forward(self, x, last_hidden_state):
@@ -94,9 +95,10 @@ class FuseModule(nn.Module):
         id_embeds,
         class_tokens_mask,
     ) -> torch.Tensor:
-        # id_embeds shape: [b, max_num_inputs, 1, 2048]
+        # id_embeds shape: [b, max_num_inputs, num_tokens, 2048]
         id_embeds = id_embeds.to(prompt_embeds.dtype)
-        num_inputs = class_tokens_mask.sum().unsqueeze(0) # TODO: check for training case
+        # each ID image expands to `num_tokens` class tokens in every prompt of the batch
+        num_inputs = class_tokens_mask.sum(dim=-1) // id_embeds.shape[-2]
         batch_size, max_num_inputs = id_embeds.shape[:2]
         # seq_length: 77
         seq_length = prompt_embeds.shape[1]
@@ -124,12 +126,14 @@ class FuseModule(nn.Module):
 
 
 class PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken(CLIPVisionModelWithProjection):
-    def __init__(self, id_embeddings_dim=512):
-        super().__init__(CLIPVisionConfig(**VISION_CONFIG_DICT))
-        self.fuse_module = FuseModule(2048)
-        self.visual_projection_2 = nn.Linear(1024, 1280, bias=False)
+    # NOTE: `vision_config`, `cross_attention_dim` and `perceiver_dim_head` only change for
+    # the tiny randomly initialized encoders of tiny_models.py, checkpoints use the defaults
+    def __init__(self, id_embeddings_dim=512, attention_backend="auto", vision_config=None, cross_attention_dim=2048, perceiver_dim_head=128):
+        vision_config = CLIPVisionConfig(**(vision_config or VISION_CONFIG_DICT))
+        super().__init__(vision_config)
+        self.fuse_module = FuseModule(cross_attention_dim)
+        self.visual_projection_2 = nn.Linear(vision_config.hidden_size, 1280, bias=False)
 
-        cross_attention_dim = 2048
         # projection
         self.num_tokens = 2
         self.cross_attention_dim = cross_attention_dim
@@ -137,18 +141,34 @@ class PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken(CLIPVisionModelWithProjecti
                                     id_embeddings_dim, 
                                     cross_attention_dim, 
                                     self.num_tokens,
+                                    embedding_dim=vision_config.hidden_size,
+                                    attention_backend=attention_backend,
+                                    dim_head=perceiver_dim_head,
                                 )
 
-    def forward(self, id_pixel_values, prompt_embeds, class_tokens_mask, id_embeds):
+    def encode_identity(self, id_pixel_values, id_embeds, output_hidden_state=False):
+        # the expensive half: CLIP vision tower + qformer perceiver, depends on the ID images only.
+        # returns the ID tokens [b, num_inputs, num_tokens, 2048], and the CLIP patch tokens if asked
         b, num_inputs, c, h, w = id_pixel_values.shape
         id_pixel_values = id_pixel_values.view(b * num_inputs, c, h, w)
 
         last_hidden_state = self.vision_model(id_pixel_values)[0]
         id_embeds = id_embeds.view(b * num_inputs, -1)
 
-        id_embeds = self.qformer_perceiver(id_embeds, last_hidden_state)
-        id_embeds = id_embeds.view(b, num_inputs, self.num_tokens, -1)
-        updated_prompt_embeds = self.fuse_module(prompt_embeds, id_embeds, class_tokens_mask)
+        id_tokens = self.qformer_perceiver(id_embeds, last_hidden_state)
+        id_tokens = id_tokens.view(b, num_inputs, self.num_tokens, -1)
+        if output_hidden_state:
+            return last_hidden_state, id_tokens
+        return id_tokens
+
+    def fuse(self, prompt_embeds, class_tokens_mask, id_tokens):
+        # the cheap half: the two MLPs of the fuse module, run for every prompt
+        return self.fuse_module(prompt_embeds, id_tokens, class_tokens_mask)
+
+    def forward(self, id_pixel_values, prompt_embeds, class_tokens_mask, id_embeds, id_tokens=None):
+        if id_tokens is None:
+            id_tokens = self.encode_identity(id_pixel_values, id_embeds)
+        updated_prompt_embeds = self.fuse(prompt_embeds, class_tokens_mask, id_tokens)
 
         return updated_prompt_embeds
 
@@ -6,6 +6,7 @@ import math
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from einops import rearrange
 from einops.layers.torch import Rearrange
 
@@ -21,6 +22,7 @@ class FacePerceiverResampler(torch.nn.Module):
         embedding_dim=1280,
         output_dim=768,
         ff_mult=4,
+        attention_backend="auto",
     ):
         super().__init__()
         
@@ -32,7 +34,7 @@ class FacePerceiverResampler(torch.nn.Module):
             self.layers.append(
                 torch.nn.ModuleList(
                     [
-                        PerceiverAttention(dim=dim, dim_head=dim_head, heads=heads),
+                        PerceiverAttention(dim=dim, dim_head=dim_head, heads=heads, attention_backend=attention_backend),
                         FeedForward(dim=dim, mult=ff_mult),
                     ]
                 )
@@ -68,12 +70,26 @@ def reshape_tensor(x, heads):
     return x
 
 
+ATTENTION_BACKENDS = ("auto", "sdpa", "math")
+
+
+def resolve_attention_backend(attention_backend):
+    # "auto" picks the fused kernel of torch.nn.functional.scaled_dot_product_attention when
+    # this torch has it, its softmax accumulates in float32 like the "math" path does
+    if attention_backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"`attention_backend` must be one of {ATTENTION_BACKENDS}, got {attention_backend!r}")
+    if attention_backend == "auto":
+        return "sdpa" if hasattr(F, "scaled_dot_product_attention") else "math"
+    return attention_backend
+
+
 class PerceiverAttention(nn.Module):
-    def __init__(self, *, dim, dim_head=64, heads=8):
+    def __init__(self, *, dim, dim_head=64, heads=8, attention_backend="auto"):
         super().__init__()
         self.scale = dim_head**-0.5
         self.dim_head = dim_head
         self.heads = heads
+        self.attention_backend = resolve_attention_backend(attention_backend)
         inner_dim = dim_head * heads
 
         self.norm1 = nn.LayerNorm(dim)
@@ -105,12 +121,16 @@ class PerceiverAttention(nn.Module):
         v = reshape_tensor(v, self.heads)
 
         # attention
-        scale = 1 / math.sqrt(math.sqrt(self.dim_head))
-        weight = (q * scale) @ (k * scale).transpose(-2, -1)  # More stable with f16 than dividing afterwards
-        weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
-        out = weight @ v
+        if self.attention_backend == "sdpa":
+            # the default scale of sdpa is dim_head**-0.5, the same as the "math" path
+            out = F.scaled_dot_product_attention(q, k, v)
+        else:
+            scale = 1 / math.sqrt(math.sqrt(self.dim_head))
+            weight = (q * scale) @ (k * scale).transpose(-2, -1)  # More stable with f16 than dividing afterwards
+            weight = torch.softmax(weight.float(), dim=-1).type(weight.dtype)
+            out = weight @ v
 
-        out = out.permute(0, 2, 1, 3).reshape(b, l, -1)
+        out = out.transpose(1, 2).reshape(b, l, -1)
 
         return self.to_out(out)
 
@@ -129,6 +149,7 @@ class Resampler(nn.Module):
         max_seq_len: int = 257,  # CLIP tokens + CLS token
         apply_pos_emb: bool = False,
         num_latents_mean_pooled: int = 0,  # number of latents derived from mean pooled representation of the sequence
+        attention_backend="auto",
     ):
         super().__init__()
         self.pos_emb = nn.Embedding(max_seq_len, embedding_dim) if apply_pos_emb else None
@@ -155,7 +176,7 @@ class Resampler(nn.Module):
             self.layers.append(
                 nn.ModuleList(
                     [
-                        PerceiverAttention(dim=dim, dim_head=dim_head, heads=heads),
+                        PerceiverAttention(dim=dim, dim_head=dim_head, heads=heads, attention_backend=attention_backend),
                         FeedForward(dim=dim, mult=ff_mult),
                     ]
                 )
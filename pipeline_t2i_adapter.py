@@ -19,6 +19,9 @@
 # limitations under the License.
 
 import inspect
+import os
+import queue
+import threading
 from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -61,10 +64,28 @@ from diffusers.pipelines.pipeline_utils import DiffusionPipeline, StableDiffusio
 from diffusers.pipelines.stable_diffusion_xl.pipeline_output import StableDiffusionXLPipelineOutput
 from diffusers.pipelines import StableDiffusionXLAdapterPipeline
 from diffusers.utils import _get_model_file
-from safetensors import safe_open
 from huggingface_hub.utils import validate_hf_hub_args
 
 from module.model_v2 import PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken
+from identity_handle import IdentityHandle, stack_identity_tokens
+from checkpoint_loader import build_empty, convert_checkpoint, load_module_weights, load_tensors, split_checkpoint_paths
+from text_embedding_cache import TextEmbeddingCache
+from vae_decoder import VaeDecodeStage
+import tracing
+
+
+# NOTE: least squares fit of the SDXL VAE decoder output on its 4 latent channels, from ComfyUI's
+# latent previewer. good enough for a progress preview at 1/8 of the resolution, for nearly free
+SDXL_LATENT_RGB_FACTORS = [
+    [0.3651, 0.4232, 0.4341],
+    [-0.2533, -0.0042, 0.1068],
+    [0.1076, 0.1111, -0.0362],
+    [-0.3165, -0.2492, -0.2188],
+]
+SDXL_LATENT_RGB_BIAS = [0.1084, -0.0175, -0.0011]
+
+# the components whose replacement invalidates the text embedding cache
+_TEXT_COMPONENTS = ("text_encoder", "text_encoder_2", "tokenizer", "tokenizer_2")
 
 
 # Copied from diffusers.pipelines.stable_diffusion.pipeline_stable_diffusion.rescale_noise_cfg
@@ -202,6 +223,15 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
                 The trigger word is used to identify the position of class word in the text prompt, 
                 and it is recommended not to set it as a common word. 
                 This trigger word must be placed after the class word when used, otherwise, it will affect the performance of the personalized generation.           
+
+            attention_backend (`str`, *optional*, defaults to `"auto"`):
+                Attention kernel of the v2 perceiver resampler, `"sdpa"` for `torch.nn.functional.scaled_dot_product_attention`,
+                `"math"` for the original implementation, `"auto"` uses `"sdpa"` when torch provides it.
+
+            checkpoint_cache_dir (`str`, *optional*):
+                Where a `.bin` checkpoint is converted to split safetensors files on first load, defaults to
+                `PHOTOMAKER_CHECKPOINT_CACHE` or `~/.cache/photomaker`. Later loads memory-map these files and copy every
+                tensor straight into the ID encoder on the pipeline's device and dtype.
         """
 
         # Load the main state dict first.
@@ -212,6 +242,8 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
         local_files_only = kwargs.pop("local_files_only", None)
         token = kwargs.pop("token", None)
         revision = kwargs.pop("revision", None)
+        attention_backend = kwargs.pop("attention_backend", "auto")
+        checkpoint_cache_dir = kwargs.pop("checkpoint_cache_dir", None)
 
         user_agent = {
             "file_type": "attn_procs_weights",
@@ -233,50 +265,171 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
                 user_agent=user_agent,
             )
             if weight_name.endswith(".safetensors"):
-                state_dict = {"id_encoder": {}, "lora_weights": {}}
-                with safe_open(model_file, framework="pt", device="cpu") as f:
-                    for key in f.keys():
-                        if key.startswith("id_encoder."):
-                            state_dict["id_encoder"][key.replace("id_encoder.", "")] = f.get_tensor(key)
-                        elif key.startswith("lora_weights."):
-                            state_dict["lora_weights"][key.replace("lora_weights.", "")] = f.get_tensor(key)
+                # a single file with prefixed keys, loaded lazily like the split files
+                checkpoint_files = {"id_encoder": model_file, "lora_weights": model_file}
+                prefixes = {"id_encoder": "id_encoder.", "lora_weights": "lora_weights."}
             else:
-                state_dict = torch.load(model_file, map_location="cpu")
+                checkpoint_files = split_checkpoint_paths(model_file, checkpoint_cache_dir)
+                if not all(os.path.exists(path) for path in checkpoint_files.values()):
+                    convert_checkpoint(model_file, checkpoint_files)
+                prefixes = {"id_encoder": "", "lora_weights": ""}
+            state_dict = None
         else:
             state_dict = pretrained_model_name_or_path_or_dict
-
-        keys = list(state_dict.keys())
-        if keys != ["id_encoder", "lora_weights"]:
-            raise ValueError("Required keys are (`id_encoder` and `lora_weights`) missing from the state dict.")
+            keys = list(state_dict.keys())
+            if keys != ["id_encoder", "lora_weights"]:
+                raise ValueError("Required keys are (`id_encoder` and `lora_weights`) missing from the state dict.")
 
         self.num_tokens = 2
         self.trigger_word = trigger_word
+        self.text_embedding_cache = TextEmbeddingCache()
         # load finetuned CLIP image encoder and fuse module here if it has not been registered to the pipeline yet
         print(f"Loading PhotoMaker {pm_version} components [1] id_encoder from [{pretrained_model_name_or_path_or_dict}]...")
         self.id_image_processor = CLIPImageProcessor()
         if pm_version == "v1": # PhotoMaker v1 
-            id_encoder = PhotoMakerIDEncoder()
+            build_id_encoder = lambda: PhotoMakerIDEncoder()
         elif pm_version == "v2": # PhotoMaker v2
-            id_encoder = PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken()
+            build_id_encoder = lambda: PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken(attention_backend=attention_backend)
         else:
             raise NotImplementedError(f"The PhotoMaker version [{pm_version}] does not support")
 
-        id_encoder.load_state_dict(state_dict["id_encoder"], strict=True)
-        id_encoder = id_encoder.to(self.device, dtype=self.unet.dtype)    
+        if state_dict is None:
+            id_encoder = build_empty(build_id_encoder)
+            id_encoder = load_module_weights(
+                id_encoder, checkpoint_files["id_encoder"], self.device, self.unet.dtype, prefix=prefixes["id_encoder"]
+            )
+            lora_weights = load_tensors(checkpoint_files["lora_weights"], prefix=prefixes["lora_weights"])
+        else:
+            id_encoder = build_id_encoder()
+            id_encoder.load_state_dict(state_dict["id_encoder"], strict=True)
+            id_encoder = id_encoder.to(self.device, dtype=self.unet.dtype)
+            lora_weights = state_dict["lora_weights"]
         self.id_encoder = id_encoder
 
         # load lora into models
         print(f"Loading PhotoMaker {pm_version} components [2] lora_weights from [{pretrained_model_name_or_path_or_dict}]")
-        self.load_lora_weights(state_dict["lora_weights"], adapter_name="photomaker")
+        self.load_lora_weights(lora_weights, adapter_name="photomaker")
 
         # Add trigger word token
         if self.tokenizer is not None: 
             self.tokenizer.add_tokens([self.trigger_word], special_tokens=True)
         
         self.tokenizer_2.add_tokens([self.trigger_word], special_tokens=True)
-        
 
-    def encode_prompt_with_trigger_word(
+    def __setattr__(self, name, value):
+        # cached text embeddings belong to the encoders and tokenizers that produced them
+        if name in _TEXT_COMPONENTS and self.__dict__.get(name) is not value:
+            self.clear_text_embedding_cache()
+        super().__setattr__(name, value)
+
+    def clear_text_embedding_cache(self):
+        cache = getattr(self, "text_embedding_cache", None)
+        if cache is not None:
+            cache.clear()
+
+    # the LoRA methods change the text encoder weights in place, the cached embeddings are stale afterwards
+    def load_lora_weights(self, *args, **kwargs):
+        super().load_lora_weights(*args, **kwargs)
+        self.clear_text_embedding_cache()
+
+    def fuse_lora(self, *args, **kwargs):
+        super().fuse_lora(*args, **kwargs)
+        self.clear_text_embedding_cache()
+
+    def unfuse_lora(self, *args, **kwargs):
+        super().unfuse_lora(*args, **kwargs)
+        self.clear_text_embedding_cache()
+
+    def unload_lora_weights(self, *args, **kwargs):
+        super().unload_lora_weights(*args, **kwargs)
+        self.clear_text_embedding_cache()
+
+    def set_adapters(self, *args, **kwargs):
+        super().set_adapters(*args, **kwargs)
+        self.clear_text_embedding_cache()
+
+    def load_photomaker_snapshot(self, id_encoder_file, trigger_word="img", attention_backend="auto"):
+        """
+        Set up PhotoMaker v2 from a fused snapshot (see `fused_snapshot.py`). The UNet of the pipeline must come from
+        the same snapshot, the PhotoMaker LoRA is already fused into it, so only the ID encoder is loaded here and
+        PEFT is never involved.
+        """
+        print(f"Loading PhotoMaker v2 id_encoder from the snapshot [{id_encoder_file}]...")
+        id_encoder = build_empty(lambda: PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken(attention_backend=attention_backend))
+        id_encoder = load_module_weights(id_encoder, id_encoder_file, self.device, self.unet.dtype)
+        self.set_id_encoder(id_encoder, trigger_word=trigger_word)
+
+    def set_id_encoder(self, id_encoder, trigger_word="img"):
+        """
+        Use an ID encoder that is already built and loaded, e.g. a tiny random one (see `tiny_models.py`). The UNet
+        is used as it is, fuse the PhotoMaker LoRA into it before if the encoder comes from a checkpoint.
+        """
+        self.num_tokens = id_encoder.num_tokens
+        self.trigger_word = trigger_word
+        self.text_embedding_cache = TextEmbeddingCache()
+        self.id_image_processor = CLIPImageProcessor()
+        self.id_encoder = id_encoder
+
+        # Add trigger word token
+        if self.tokenizer is not None:
+            self.tokenizer.add_tokens([self.trigger_word], special_tokens=True)
+
+        self.tokenizer_2.add_tokens([self.trigger_word], special_tokens=True)
+
+    def _encode_text_input_ids(
+        self,
+        text_input_ids: torch.LongTensor,
+        tokenizer: CLIPTokenizer,
+        text_encoder: Union[CLIPTextModel, CLIPTextModelWithProjection],
+        device: torch.device,
+        clip_skip: Optional[int] = None,
+    ):
+        """
+        Runs `text_encoder` on a batch of token ids. Rows that were encoded before are served from
+        `self.text_embedding_cache` and the encoder only runs once, on the rows that are left.
+
+        Returns:
+            `Tuple[torch.Tensor, Optional[torch.Tensor]]`: the hidden states SDXL conditions on (the penultimate
+            layer, or the one selected by `clip_skip`) and the pooled embeddings, which are only available for
+            `CLIPTextModelWithProjection`.
+        """
+        # "2" because SDXL always indexes from the penultimate layer.
+        hidden_state_index = -2 if clip_skip is None else -(clip_skip + 2)
+
+        def run_encoder(input_ids):
+            output = text_encoder(input_ids.to(device), output_hidden_states=True)
+            pooled = output.text_embeds if hasattr(output, "text_embeds") else None
+            return output.hidden_states[hidden_state_index], pooled
+
+        cache = getattr(self, "text_embedding_cache", None)
+        if cache is None:
+            return run_encoder(text_input_ids)
+
+        # NOTE: keyed by the encoder's slot, not its id(): ids are reused once an encoder is freed. replacing an
+        # encoder or tokenizer, or loading and fusing LoRAs, clears the cache (see `clear_text_embedding_cache`)
+        encoder_name = "text_encoder" if text_encoder is self.text_encoder else "text_encoder_2"
+        keys = [
+            (encoder_name, hidden_state_index, getattr(self, "_lora_scale", None), tuple(ids))
+            for ids in text_input_ids.tolist()
+        ]
+        values = [cache.get(key) for key in keys]
+
+        missing = {}
+        for i, (key, value) in enumerate(zip(keys, values)):
+            if value is None:
+                missing.setdefault(key, i)
+        if missing:
+            hidden_states, pooled = run_encoder(text_input_ids[list(missing.values())])
+            for j, key in enumerate(missing):
+                # clone so that a cached row does not keep the whole batch alive
+                cache.put(key, (hidden_states[j].clone(), pooled[j].clone() if pooled is not None else None))
+            values = [value if value is not None else cache.get(key) for key, value in zip(keys, values)]
+
+        prompt_embeds = torch.stack([value[0] for value in values])
+        pooled_prompt_embeds = torch.stack([value[1] for value in values]) if values[0][1] is not None else None
+        return prompt_embeds, pooled_prompt_embeds
+
+    def encode_prompt(
         self,
         prompt: str,
         prompt_2: Optional[str] = None,
@@ -291,10 +444,11 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
         negative_pooled_prompt_embeds: Optional[torch.Tensor] = None,
         lora_scale: Optional[float] = None,
         clip_skip: Optional[int] = None,
-        ### Added args
-        num_id_images: int = 1,
-        class_tokens_mask: Optional[torch.LongTensor] = None,
     ):
+        r"""
+        Same as `StableDiffusionXLPipeline.encode_prompt`, except that the text encoders run through
+        `_encode_text_input_ids` so that repeated prompts are served from the text embedding cache.
+        """
         device = device or self._execution_device
 
         # set lora scale so that monkey patched LoRA
@@ -322,9 +476,6 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
         else:
             batch_size = prompt_embeds.shape[0]
 
-        # Find the token id of the trigger word
-        image_token_id = self.tokenizer_2.convert_tokens_to_ids(self.trigger_word)
-
         # Define tokenizers and text encoders
         tokenizers = [self.tokenizer, self.tokenizer_2] if self.tokenizer is not None else [self.tokenizer_2]
         text_encoders = (
@@ -350,7 +501,7 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
                     return_tensors="pt",
                 )
 
-                text_input_ids = text_inputs.input_ids 
+                text_input_ids = text_inputs.input_ids
                 untruncated_ids = tokenizer(prompt, padding="longest", return_tensors="pt").input_ids
 
                 if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(
@@ -362,53 +513,288 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
                         f" {tokenizer.model_max_length} tokens: {removed_text}"
                     )
 
-                clean_index = 0
-                clean_input_ids = []
-                class_token_index = []
-                # Find out the corresponding class word token based on the newly added trigger word token
-                for i, token_id in enumerate(text_input_ids.tolist()[0]):
-                    if token_id == image_token_id:
-                        class_token_index.append(clean_index - 1)
-                    else:
-                        clean_input_ids.append(token_id)
-                        clean_index += 1
+                # We are only ALWAYS interested in the pooled output of the final text encoder
+                prompt_embeds, pooled_prompt_embeds = self._encode_text_input_ids(
+                    text_input_ids, tokenizer, text_encoder, device, clip_skip=clip_skip
+                )
 
-                if len(class_token_index) != 1:
-                    raise ValueError(
-                        f"PhotoMaker currently does not support multiple trigger words in a single prompt.\
-                            Trigger word: {self.trigger_word}, Prompt: {prompt}."
-                    )
-                class_token_index = class_token_index[0]
-
-                # Expand the class word token and corresponding mask
-                class_token = clean_input_ids[class_token_index]
-                clean_input_ids = clean_input_ids[:class_token_index] + [class_token] * num_id_images * self.num_tokens + \
-                    clean_input_ids[class_token_index+1:]                
-                    
-                # Truncation or padding
-                max_len = tokenizer.model_max_length
-                if len(clean_input_ids) > max_len:
-                    clean_input_ids = clean_input_ids[:max_len]
-                else:
-                    clean_input_ids = clean_input_ids + [tokenizer.pad_token_id] * (
-                        max_len - len(clean_input_ids)
-                    )
+                prompt_embeds_list.append(prompt_embeds)
+
+            prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
+
+        # get unconditional embeddings for classifier free guidance
+        zero_out_negative_prompt = negative_prompt is None and self.config.force_zeros_for_empty_prompt
+        if do_classifier_free_guidance and negative_prompt_embeds is None and zero_out_negative_prompt:
+            negative_prompt_embeds = torch.zeros_like(prompt_embeds)
+            negative_pooled_prompt_embeds = torch.zeros_like(pooled_prompt_embeds)
+        elif do_classifier_free_guidance and negative_prompt_embeds is None:
+            negative_prompt = negative_prompt or ""
+            negative_prompt_2 = negative_prompt_2 or negative_prompt
+
+            # normalize str to list
+            negative_prompt = batch_size * [negative_prompt] if isinstance(negative_prompt, str) else negative_prompt
+            negative_prompt_2 = (
+                batch_size * [negative_prompt_2] if isinstance(negative_prompt_2, str) else negative_prompt_2
+            )
+
+            uncond_tokens: List[str]
+            if prompt is not None and type(prompt) is not type(negative_prompt):
+                raise TypeError(
+                    f"`negative_prompt` should be the same type to `prompt`, but got {type(negative_prompt)} !="
+                    f" {type(prompt)}."
+                )
+            elif batch_size != len(negative_prompt):
+                raise ValueError(
+                    f"`negative_prompt`: {negative_prompt} has batch size {len(negative_prompt)}, but `prompt`:"
+                    f" {prompt} has batch size {batch_size}. Please make sure that passed `negative_prompt` matches"
+                    " the batch size of `prompt`."
+                )
+            else:
+                uncond_tokens = [negative_prompt, negative_prompt_2]
 
-                class_tokens_mask = [True if class_token_index <= i < class_token_index+(num_id_images * self.num_tokens) else False \
-                     for i in range(len(clean_input_ids))]
-                
-                clean_input_ids = torch.tensor(clean_input_ids, dtype=torch.long).unsqueeze(0)
-                class_tokens_mask = torch.tensor(class_tokens_mask, dtype=torch.bool).unsqueeze(0)
+            negative_prompt_embeds_list = []
+            for negative_prompt, tokenizer, text_encoder in zip(uncond_tokens, tokenizers, text_encoders):
+                if isinstance(self, TextualInversionLoaderMixin):
+                    negative_prompt = self.maybe_convert_prompt(negative_prompt, tokenizer)
 
-                prompt_embeds = text_encoder(clean_input_ids.to(device), output_hidden_states=True)
+                max_length = prompt_embeds.shape[1]
+                uncond_input = tokenizer(
+                    negative_prompt,
+                    padding="max_length",
+                    max_length=max_length,
+                    truncation=True,
+                    return_tensors="pt",
+                )
 
                 # We are only ALWAYS interested in the pooled output of the final text encoder
-                pooled_prompt_embeds = prompt_embeds[0]
-                if clip_skip is None:
-                    prompt_embeds = prompt_embeds.hidden_states[-2]
+                negative_prompt_embeds, negative_pooled_prompt_embeds = self._encode_text_input_ids(
+                    uncond_input.input_ids, tokenizer, text_encoder, device
+                )
+
+                negative_prompt_embeds_list.append(negative_prompt_embeds)
+
+            negative_prompt_embeds = torch.concat(negative_prompt_embeds_list, dim=-1)
+
+        if self.text_encoder_2 is not None:
+            prompt_embeds = prompt_embeds.to(dtype=self.text_encoder_2.dtype, device=device)
+        else:
+            prompt_embeds = prompt_embeds.to(dtype=self.unet.dtype, device=device)
+
+        bs_embed, seq_len, _ = prompt_embeds.shape
+        # duplicate text embeddings for each generation per prompt, using mps friendly method
+        prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
+        prompt_embeds = prompt_embeds.view(bs_embed * num_images_per_prompt, seq_len, -1)
+
+        if do_classifier_free_guidance:
+            # duplicate unconditional embeddings for each generation per prompt, using mps friendly method
+            seq_len = negative_prompt_embeds.shape[1]
+
+            if self.text_encoder_2 is not None:
+                negative_prompt_embeds = negative_prompt_embeds.to(dtype=self.text_encoder_2.dtype, device=device)
+            else:
+                negative_prompt_embeds = negative_prompt_embeds.to(dtype=self.unet.dtype, device=device)
+
+            negative_prompt_embeds = negative_prompt_embeds.repeat(1, num_images_per_prompt, 1)
+            negative_prompt_embeds = negative_prompt_embeds.view(batch_size * num_images_per_prompt, seq_len, -1)
+
+        pooled_prompt_embeds = pooled_prompt_embeds.repeat(1, num_images_per_prompt).view(
+            bs_embed * num_images_per_prompt, -1
+        )
+        if do_classifier_free_guidance:
+            negative_pooled_prompt_embeds = negative_pooled_prompt_embeds.repeat(1, num_images_per_prompt).view(
+                bs_embed * num_images_per_prompt, -1
+            )
+
+        if self.text_encoder is not None:
+            if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
+                # Retrieve the original scale by scaling back the LoRA layers
+                unscale_lora_layers(self.text_encoder, lora_scale)
+
+        if self.text_encoder_2 is not None:
+            if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
+                # Retrieve the original scale by scaling back the LoRA layers
+                unscale_lora_layers(self.text_encoder_2, lora_scale)
+
+        return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
+
+    @torch.no_grad()
+    def warmup_text_embeddings(self, prompts: List[str]):
+        """
+        Encodes `prompts` through both text encoders and keeps the results in the text embedding cache, e.g. the
+        negative prompts of every style template so that the first request of each style is already a cache hit.
+        """
+        device = self._execution_device
+        tokenizers = [self.tokenizer, self.tokenizer_2] if self.tokenizer is not None else [self.tokenizer_2]
+        text_encoders = (
+            [self.text_encoder, self.text_encoder_2] if self.text_encoder is not None else [self.text_encoder_2]
+        )
+        for tokenizer, text_encoder in zip(tokenizers, text_encoders):
+            text_input_ids = tokenizer(
+                prompts,
+                padding="max_length",
+                max_length=tokenizer.model_max_length,
+                truncation=True,
+                return_tensors="pt",
+            ).input_ids
+            self._encode_text_input_ids(text_input_ids, tokenizer, text_encoder, device)
+
+    def _tokenize_prompts(self, prompt: List[str], tokenizer: CLIPTokenizer, warn_truncation: bool = True):
+        """
+        Tokenizes `prompt` once and returns the ids `padding="max_length", truncation=True` would give. The untruncated
+        ids of the same call tell which prompts lost text, so there is no second tokenization just for the warning.
+        """
+        max_len = tokenizer.model_max_length
+        untruncated_ids = tokenizer(prompt, padding=False, truncation=False).input_ids
+        lengths = torch.tensor([len(ids) for ids in untruncated_ids])
+        text_input_ids = torch.nn.utils.rnn.pad_sequence(
+            [torch.tensor(ids, dtype=torch.long) for ids in untruncated_ids],
+            batch_first=True,
+            padding_value=tokenizer.pad_token_id,
+        )
+
+        truncated = lengths > max_len
+        if truncated.any():
+            if warn_truncation:
+                removed_text = [
+                    tokenizer.decode(untruncated_ids[i][max_len - 1 : -1]) for i in truncated.nonzero().flatten().tolist()
+                ]
+                print(
+                    "The following part of your input was truncated because CLIP can only handle sequences up to"
+                    f" {max_len} tokens: {removed_text}"
+                )
+            # keep the end-of-text token, like the tokenizer's own truncation does
+            end_ids = text_input_ids[truncated].gather(1, (lengths[truncated] - 1).unsqueeze(1)).squeeze(1)
+            text_input_ids[truncated, max_len - 1] = end_ids
+
+        text_input_ids = text_input_ids[:, :max_len]
+        if text_input_ids.shape[1] < max_len:
+            text_input_ids = torch.nn.functional.pad(
+                text_input_ids, (0, max_len - text_input_ids.shape[1]), value=tokenizer.pad_token_id
+            )
+        return text_input_ids
+
+    def _expand_class_tokens(
+        self,
+        text_input_ids: torch.LongTensor,
+        tokenizer: CLIPTokenizer,
+        num_id_images: int,
+        prompt: List[str],
+    ):
+        """
+        Removes the trigger word from every row of `text_input_ids` and repeats the class word in front of it
+        `num_id_images * num_tokens` times, the repeated positions are marked in the returned `class_tokens_mask`.
+        The whole batch is handled with tensor ops, every prompt with its own trigger word position.
+        """
+        image_token_id = self.tokenizer_2.convert_tokens_to_ids(self.trigger_word)
+        batch_size, seq_len = text_input_ids.shape
+        num_class_tokens = num_id_images * self.num_tokens
+
+        # Find out the corresponding class word token based on the newly added trigger word token
+        is_trigger = text_input_ids == image_token_id
+        num_triggers = is_trigger.sum(dim=1)
+        if (num_triggers != 1).any():
+            one_prompt = prompt[(num_triggers != 1).nonzero()[0].item()]
+            raise ValueError(
+                f"PhotoMaker currently does not support multiple trigger words in a single prompt.\
+                    Trigger word: {self.trigger_word}, Prompt: {one_prompt}."
+            )
+        class_token_index = is_trigger.long().argmax(dim=1, keepdim=True) - 1
+
+        # Expand the class word token and corresponding mask. For every output position look up the input
+        # position it is copied from: tokens before the class word stay in place, the class word is repeated
+        # `num_class_tokens` times and everything after it moves right, skipping over the trigger word.
+        positions = torch.arange(seq_len, device=text_input_ids.device).unsqueeze(0)
+        class_tokens_mask = (positions >= class_token_index) & (positions < class_token_index + num_class_tokens)
+        source_index = torch.where(positions < class_token_index, positions, positions - num_class_tokens + 2)
+        source_index = torch.where(class_tokens_mask, class_token_index, source_index)
+
+        # Truncation or padding
+        clean_input_ids = text_input_ids.gather(1, source_index.clamp(0, seq_len - 1))
+        clean_input_ids = clean_input_ids.masked_fill(source_index >= seq_len, tokenizer.pad_token_id)
+        return clean_input_ids, class_tokens_mask
+
+    def _remove_trigger_word(self, prompt: List[str]):
+        # encode, remove trigger word token, then decode
+        trigger_word_token = self.tokenizer.convert_tokens_to_ids(self.trigger_word)
+        prompt_text_only = []
+        for one_prompt in prompt:
+            tokens_text_only = self.tokenizer.encode(one_prompt, add_special_tokens=False)
+            tokens_text_only.remove(trigger_word_token)
+            prompt_text_only.append(self.tokenizer.decode(tokens_text_only, add_special_tokens=False))
+        return prompt_text_only
+
+    def encode_prompt_with_trigger_word(
+        self,
+        prompt: str,
+        prompt_2: Optional[str] = None,
+        device: Optional[torch.device] = None,
+        num_images_per_prompt: int = 1,
+        do_classifier_free_guidance: bool = True,
+        negative_prompt: Optional[str] = None,
+        negative_prompt_2: Optional[str] = None,
+        prompt_embeds: Optional[torch.Tensor] = None,
+        negative_prompt_embeds: Optional[torch.Tensor] = None,
+        pooled_prompt_embeds: Optional[torch.Tensor] = None,
+        negative_pooled_prompt_embeds: Optional[torch.Tensor] = None,
+        lora_scale: Optional[float] = None,
+        clip_skip: Optional[int] = None,
+        ### Added args
+        num_id_images: int = 1,
+        class_tokens_mask: Optional[torch.LongTensor] = None,
+    ):
+        device = device or self._execution_device
+
+        # set lora scale so that monkey patched LoRA
+        # function of text encoder can correctly access it
+        if lora_scale is not None and isinstance(self, StableDiffusionXLLoraLoaderMixin):
+            self._lora_scale = lora_scale
+
+            # dynamically adjust the LoRA scale
+            if self.text_encoder is not None:
+                if not USE_PEFT_BACKEND:
+                    adjust_lora_scale_text_encoder(self.text_encoder, lora_scale)
+                else:
+                    scale_lora_layers(self.text_encoder, lora_scale)
+
+            if self.text_encoder_2 is not None:
+                if not USE_PEFT_BACKEND:
+                    adjust_lora_scale_text_encoder(self.text_encoder_2, lora_scale)
                 else:
-                    # "2" because SDXL always indexes from the penultimate layer.
-                    prompt_embeds = prompt_embeds.hidden_states[-(clip_skip + 2)]
+                    scale_lora_layers(self.text_encoder_2, lora_scale)
+
+        prompt = [prompt] if isinstance(prompt, str) else prompt
+
+        if prompt is not None:
+            batch_size = len(prompt)
+        else:
+            batch_size = prompt_embeds.shape[0]
+
+        # Define tokenizers and text encoders
+        tokenizers = [self.tokenizer, self.tokenizer_2] if self.tokenizer is not None else [self.tokenizer_2]
+        text_encoders = (
+            [self.text_encoder, self.text_encoder_2] if self.text_encoder is not None else [self.text_encoder_2]
+        )
+
+        if prompt_embeds is None:
+            prompt_2 = prompt_2 or prompt
+            prompt_2 = [prompt_2] if isinstance(prompt_2, str) else prompt_2
+
+            # textual inversion: process multi-vector tokens if necessary
+            prompt_embeds_list = []
+            prompts = [prompt, prompt_2]
+            for prompt, tokenizer, text_encoder in zip(prompts, tokenizers, text_encoders):
+                if isinstance(self, TextualInversionLoaderMixin):
+                    prompt = self.maybe_convert_prompt(prompt, tokenizer)
+
+                text_input_ids = self._tokenize_prompts(prompt, tokenizer)
+                clean_input_ids, class_tokens_mask = self._expand_class_tokens(
+                    text_input_ids, tokenizer, num_id_images, prompt
+                )
+
+                # We are only ALWAYS interested in the pooled output of the final text encoder
+                prompt_embeds, pooled_prompt_embeds = self._encode_text_input_ids(
+                    clean_input_ids, tokenizer, text_encoder, device, clip_skip=clip_skip
+                )
 
                 prompt_embeds_list.append(prompt_embeds)
 
@@ -460,13 +846,10 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
                     return_tensors="pt",
                 )
 
-                negative_prompt_embeds = text_encoder(
-                    uncond_input.input_ids.to(device),
-                    output_hidden_states=True,
-                )
                 # We are only ALWAYS interested in the pooled output of the final text encoder
-                negative_pooled_prompt_embeds = negative_prompt_embeds[0]
-                negative_prompt_embeds = negative_prompt_embeds.hidden_states[-2]
+                negative_prompt_embeds, negative_pooled_prompt_embeds = self._encode_text_input_ids(
+                    uncond_input.input_ids, tokenizer, text_encoder, device
+                )
 
                 negative_prompt_embeds_list.append(negative_prompt_embeds)
 
@@ -511,10 +894,315 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
 
         return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds, class_tokens_mask
 
+    def encode_prompt_single_pass(
+        self,
+        prompt: Union[str, List[str]],
+        prompt_2: Optional[Union[str, List[str]]] = None,
+        device: Optional[torch.device] = None,
+        num_images_per_prompt: int = 1,
+        do_classifier_free_guidance: bool = True,
+        negative_prompt: Optional[Union[str, List[str]]] = None,
+        negative_prompt_2: Optional[Union[str, List[str]]] = None,
+        lora_scale: Optional[float] = None,
+        clip_skip: Optional[int] = None,
+        num_id_images: int = 1,
+    ):
+        r"""
+        Encodes the prompt with the expanded class word, the prompt without the trigger word (used until
+        `start_merge_step`) and the negative prompt with a single forward per text encoder. The results match
+        `encode_prompt_with_trigger_word` followed by `encode_prompt` on the text-only prompt.
+
+        Returns:
+            `Tuple`: `prompt_embeds` (not yet repeated for `num_images_per_prompt`, the ID encoder fuses them first),
+            `pooled_prompt_embeds`, `class_tokens_mask`, `prompt_embeds_text_only`, `pooled_prompt_embeds_text_only`,
+            `negative_prompt_embeds` and `negative_pooled_prompt_embeds`.
+        """
+        device = device or self._execution_device
+
+        # set lora scale so that monkey patched LoRA
+        # function of text encoder can correctly access it
+        if lora_scale is not None and isinstance(self, StableDiffusionXLLoraLoaderMixin):
+            self._lora_scale = lora_scale
+
+            # dynamically adjust the LoRA scale
+            if self.text_encoder is not None:
+                if not USE_PEFT_BACKEND:
+                    adjust_lora_scale_text_encoder(self.text_encoder, lora_scale)
+                else:
+                    scale_lora_layers(self.text_encoder, lora_scale)
+
+            if self.text_encoder_2 is not None:
+                if not USE_PEFT_BACKEND:
+                    adjust_lora_scale_text_encoder(self.text_encoder_2, lora_scale)
+                else:
+                    scale_lora_layers(self.text_encoder_2, lora_scale)
+
+        prompt = [prompt] if isinstance(prompt, str) else prompt
+        batch_size = len(prompt)
+
+        prompt_text_only = self._remove_trigger_word(prompt)
+        # a separate `prompt_2` is used as is for the text-only embeddings, like `encode_prompt` would
+        prompt_2_text_only = [prompt_2] if isinstance(prompt_2, str) else (prompt_2 or prompt_text_only)
+        prompt_2 = prompt_2 or prompt
+        prompt_2 = [prompt_2] if isinstance(prompt_2, str) else prompt_2
+
+        # get unconditional embeddings for classifier free guidance
+        zero_out_negative_prompt = negative_prompt is None and self.config.force_zeros_for_empty_prompt
+        encode_negative_prompt = do_classifier_free_guidance and not zero_out_negative_prompt
+        if encode_negative_prompt:
+            negative_prompt = negative_prompt or ""
+            negative_prompt_2 = negative_prompt_2 or negative_prompt
+
+            # normalize str to list
+            negative_prompt = batch_size * [negative_prompt] if isinstance(negative_prompt, str) else negative_prompt
+            negative_prompt_2 = (
+                batch_size * [negative_prompt_2] if isinstance(negative_prompt_2, str) else negative_prompt_2
+            )
+            if batch_size != len(negative_prompt):
+                raise ValueError(
+                    f"`negative_prompt`: {negative_prompt} has batch size {len(negative_prompt)}, but `prompt`:"
+                    f" {prompt} has batch size {batch_size}. Please make sure that passed `negative_prompt` matches"
+                    " the batch size of `prompt`."
+                )
+        else:
+            negative_prompt, negative_prompt_2 = None, None
+
+        # Define tokenizers and text encoders
+        tokenizers = [self.tokenizer, self.tokenizer_2] if self.tokenizer is not None else [self.tokenizer_2]
+        text_encoders = (
+            [self.text_encoder, self.text_encoder_2] if self.text_encoder is not None else [self.text_encoder_2]
+        )
+
+        def tokenize(texts, tokenizer):
+            if isinstance(self, TextualInversionLoaderMixin):
+                texts = self.maybe_convert_prompt(texts, tokenizer)
+            return self._tokenize_prompts(texts, tokenizer, warn_truncation=False)
+
+        prompt_embeds_list = []
+        prompt_embeds_text_only_list = []
+        negative_prompt_embeds_list = []
+        for one_prompt, one_prompt_text_only, one_negative_prompt, tokenizer, text_encoder in zip(
+            [prompt, prompt_2],
+            [prompt_text_only, prompt_2_text_only],
+            [negative_prompt, negative_prompt_2],
+            tokenizers,
+            text_encoders,
+        ):
+            if isinstance(self, TextualInversionLoaderMixin):
+                one_prompt = self.maybe_convert_prompt(one_prompt, tokenizer)
+
+            text_input_ids = self._tokenize_prompts(one_prompt, tokenizer)
+            clean_input_ids, class_tokens_mask = self._expand_class_tokens(
+                text_input_ids, tokenizer, num_id_images, one_prompt
+            )
+
+            # all prompts of this encoder go through one forward
+            # the negative prompt always reads the penultimate layer, so it only joins the batch without clip_skip
+            input_ids = [clean_input_ids, tokenize(one_prompt_text_only, tokenizer)]
+            if encode_negative_prompt and clip_skip is None:
+                input_ids.append(tokenize(one_negative_prompt, tokenizer))
+
+            embeds, pooled = self._encode_text_input_ids(
+                torch.cat(input_ids), tokenizer, text_encoder, device, clip_skip=clip_skip
+            )
+            if encode_negative_prompt and clip_skip is not None:
+                negative_embeds, negative_pooled = self._encode_text_input_ids(
+                    tokenize(one_negative_prompt, tokenizer), tokenizer, text_encoder, device
+                )
+                embeds = torch.cat([embeds, negative_embeds])
+                pooled = torch.cat([pooled, negative_pooled]) if pooled is not None else None
+
+            # We are only ALWAYS interested in the pooled output of the final text encoder
+            embeds = embeds.split(batch_size)
+            pooled = pooled.split(batch_size) if pooled is not None else [None] * len(embeds)
+            prompt_embeds_list.append(embeds[0])
+            prompt_embeds_text_only_list.append(embeds[1])
+            pooled_prompt_embeds, pooled_prompt_embeds_text_only = pooled[0], pooled[1]
+            if encode_negative_prompt:
+                negative_prompt_embeds_list.append(embeds[2])
+                negative_pooled_prompt_embeds = pooled[2]
+
+        dtype = self.text_encoder_2.dtype if self.text_encoder_2 is not None else self.unet.dtype
+        prompt_embeds = torch.concat(prompt_embeds_list, dim=-1).to(dtype=dtype, device=device)
+        prompt_embeds_text_only = torch.concat(prompt_embeds_text_only_list, dim=-1).to(dtype=dtype, device=device)
+        class_tokens_mask = class_tokens_mask.to(device=device)
+
+        negative_prompt_embeds = None
+        if do_classifier_free_guidance and encode_negative_prompt:
+            negative_prompt_embeds = torch.concat(negative_prompt_embeds_list, dim=-1).to(dtype=dtype, device=device)
+        elif do_classifier_free_guidance:
+            negative_prompt_embeds = torch.zeros_like(prompt_embeds_text_only)
+            negative_pooled_prompt_embeds = torch.zeros_like(pooled_prompt_embeds_text_only)
+        else:
+            negative_pooled_prompt_embeds = None
+
+        # duplicate text embeddings for each generation per prompt, using mps friendly method
+        def repeat_embeds(embeds):
+            bs_embed, seq_len, _ = embeds.shape
+            return embeds.repeat(1, num_images_per_prompt, 1).view(bs_embed * num_images_per_prompt, seq_len, -1)
+
+        def repeat_pooled(pooled):
+            return pooled.repeat(1, num_images_per_prompt).view(pooled.shape[0] * num_images_per_prompt, -1)
+
+        prompt_embeds_text_only = repeat_embeds(prompt_embeds_text_only)
+        pooled_prompt_embeds = repeat_pooled(pooled_prompt_embeds)
+        pooled_prompt_embeds_text_only = repeat_pooled(pooled_prompt_embeds_text_only)
+        if do_classifier_free_guidance:
+            negative_prompt_embeds = repeat_embeds(negative_prompt_embeds)
+            negative_pooled_prompt_embeds = repeat_pooled(negative_pooled_prompt_embeds)
+
+        if self.text_encoder is not None:
+            if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
+                # Retrieve the original scale by scaling back the LoRA layers
+                unscale_lora_layers(self.text_encoder, lora_scale)
+
+        if self.text_encoder_2 is not None:
+            if isinstance(self, StableDiffusionXLLoraLoaderMixin) and USE_PEFT_BACKEND:
+                # Retrieve the original scale by scaling back the LoRA layers
+                unscale_lora_layers(self.text_encoder_2, lora_scale)
+
+        return (
+            prompt_embeds,
+            pooled_prompt_embeds,
+            class_tokens_mask,
+            prompt_embeds_text_only,
+            pooled_prompt_embeds_text_only,
+            negative_prompt_embeds,
+            negative_pooled_prompt_embeds,
+        )
+
+    @torch.no_grad()
+    def encode_id_images(self, input_id_images, id_embeds):
+        """
+        Runs the ID images through the CLIP vision tower and the QFormer perceiver of the ID encoder.
+        The results only depend on the ID images, so they can be cached and passed back through `id_tokens`.
+
+        Returns:
+            `Tuple[torch.Tensor, torch.Tensor]`: the CLIP `last_hidden_state` with shape [num_id_images, 257, 1024]
+            and the ID tokens with shape [1, num_id_images, num_tokens, 2048].
+        """
+        device = self._execution_device
+        dtype = next(self.id_encoder.parameters()).dtype
+        id_pixel_values = self.preprocess_id_images(input_id_images)
+
+        id_pixel_values = id_pixel_values.unsqueeze(0).to(device=device, dtype=dtype)
+        id_embeds = id_embeds.unsqueeze(0).to(device=device, dtype=dtype)
+        with tracing.span("id_encoding", num_id_images=id_pixel_values.shape[1]):
+            return self.id_encoder.encode_identity(id_pixel_values, id_embeds, output_hidden_state=True)
+
+    def preprocess_id_images(self, input_id_images):
+        """CLIP pixel values of the ID images, [num_id_images, 3, 224, 224]"""
+        if not isinstance(input_id_images, list):
+            input_id_images = [input_id_images]
+        if not isinstance(input_id_images[0], torch.Tensor):
+            return self.id_image_processor(input_id_images, return_tensors="pt").pixel_values
+        return torch.stack(input_id_images)
+
+    @torch.no_grad()
+    def create_identity(self, input_id_images, id_embeds, key=None):
+        """
+        Preprocess and encode the ID images of one person once, the returned `IdentityHandle` can be passed to any
+        number of calls as `identity`.
+        """
+        id_pixel_values = self.preprocess_id_images(input_id_images)
+        last_hidden_state, id_tokens = self.encode_id_images(list(id_pixel_values), id_embeds)
+        return IdentityHandle(
+            id_embeds=id_embeds,
+            id_tokens=id_tokens,
+            last_hidden_state=last_hidden_state,
+            id_pixel_values=id_pixel_values,
+            key=key,
+        ).to("cpu")
+
     @property
     def interrupt(self):
         return self._interrupt
 
+    @property
+    def vae_decode_stage(self):
+        """The `VaeDecodeStage` used at the end of `__call__`, set its `chunk_size` and `tiling` to bound memory"""
+        if getattr(self, "_vae_decode_stage", None) is None or self._vae_decode_stage.vae is not self.vae:
+            self._vae_decode_stage = VaeDecodeStage(self.vae)
+        return self._vae_decode_stage
+
+    @torch.no_grad()
+    def decode_latents_preview(self, latents):
+        """
+        Cheap approximation of `vae.decode`: a linear projection of the 4 latent channels to RGB.
+
+        Returns:
+            `List[PIL.Image.Image]`: one image per latent, at 1/8 of the output resolution.
+        """
+        factors = torch.tensor(SDXL_LATENT_RGB_FACTORS, device=latents.device, dtype=latents.dtype)
+        bias = torch.tensor(SDXL_LATENT_RGB_BIAS, device=latents.device, dtype=latents.dtype)
+        rgb = torch.einsum("bchw,cr->bhwr", latents, factors) + bias
+        rgb = ((rgb.clamp(-1, 1) + 1) * 127.5).to(torch.uint8).cpu().numpy()
+        return [PIL.Image.fromarray(image) for image in rgb]
+
+    def stream(self, *args, preview_steps=5, **kwargs):
+        """
+        Run the pipeline in a background thread and yield `(images, done)` pairs: previews every `preview_steps`
+        steps with `done=False`, then the final images with `done=True`. Takes the arguments of `__call__`.
+        """
+        updates = queue.Queue()
+        result = {}
+
+        def run():
+            try:
+                result["images"] = self(
+                    *args,
+                    preview_callback=lambda step, images: updates.put(images),
+                    preview_steps=preview_steps,
+                    **kwargs,
+                ).images
+            except Exception as e:
+                result["error"] = e
+            finally:
+                updates.put(None)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        while True:
+            images = updates.get()
+            if images is None:
+                break
+            yield images, False
+        thread.join()
+        if "error" in result:
+            raise result["error"]
+        yield result["images"], True
+
+    def prepare_latents(
+        self, batch_size, num_channels_latents, height, width, dtype, device, generator, latents=None, scheduler=None
+    ):
+        # the parent's, with the scheduler of the call instead of always `self.scheduler`
+        scheduler = scheduler if scheduler is not None else self.scheduler
+        shape = (batch_size, num_channels_latents, int(height) // self.vae_scale_factor, int(width) // self.vae_scale_factor)
+        if isinstance(generator, list) and len(generator) != batch_size:
+            raise ValueError(
+                f"You have passed a list of generators of length {len(generator)}, but requested an effective batch"
+                f" size of {batch_size}. Make sure the batch size matches the length of the generators."
+            )
+
+        if latents is None:
+            latents = randn_tensor(shape, generator=generator, device=device, dtype=dtype)
+        else:
+            latents = latents.to(device)
+
+        # scale the initial noise by the standard deviation required by the scheduler
+        return latents * scheduler.init_noise_sigma
+
+    def prepare_extra_step_kwargs(self, generator, eta, scheduler=None):
+        # not all schedulers take `eta` (DDIM only) or a `generator` (the ancestral and SDE ones)
+        scheduler = scheduler if scheduler is not None else self.scheduler
+        step_parameters = set(inspect.signature(scheduler.step).parameters.keys())
+        extra_step_kwargs = {}
+        if "eta" in step_parameters:
+            extra_step_kwargs["eta"] = eta
+        if "generator" in step_parameters:
+            extra_step_kwargs["generator"] = generator
+        return extra_step_kwargs
+
     @torch.no_grad()
     def __call__(
         self,
@@ -562,6 +1250,11 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
         id_embeds: Optional[torch.FloatTensor] = None,
         prompt_embeds_text_only: Optional[torch.FloatTensor] = None,
         pooled_prompt_embeds_text_only: Optional[torch.FloatTensor] = None,
+        id_tokens: Optional[torch.FloatTensor] = None,
+        identity: Optional[Union[IdentityHandle, List[IdentityHandle]]] = None,
+        preview_callback: Optional[Callable[[int, List[PIL.Image.Image]], None]] = None,
+        preview_steps: int = 5,
+        scheduler=None,
         **kwargs,
     ):
         r"""
@@ -580,6 +1273,25 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
             pooled_prompt_embeds_text_only (`torch.FloatTensor`, *optional*):
                 Pre-generated pooled text embeddings. Can be used to easily tweak text inputs, *e.g.* prompt weighting.
                 If not provided, pooled text embeddings will be generated from `prompt` input argument.
+            id_tokens (`torch.FloatTensor`, *optional*):
+                Pre-generated ID tokens from `encode_id_images`. When provided, the CLIP vision tower and the QFormer
+                perceiver are skipped and `input_id_images` may be left undefined.
+            identity (`IdentityHandle` or `List[IdentityHandle]`, *optional*):
+                Identities from `create_identity`, one for all prompts or one per prompt. Takes the place of
+                `input_id_images`, `id_embeds` and `id_tokens`.
+            preview_callback (`Callable`, *optional*):
+                Called as `preview_callback(step, images)` every `preview_steps` steps with low resolution previews of
+                the current estimate of the final images, see `decode_latents_preview`.
+            preview_steps (`int`, *optional*, defaults to 5):
+                Number of denoising steps between two previews.
+            scheduler (`SchedulerMixin`, *optional*):
+                A scheduler used for this call only, e.g. from `SamplingPreset.make_scheduler`. Schedulers keep state
+                while denoising, so concurrent calls must not share one. `self.scheduler` is used when not given and
+                is never replaced.
+
+        A list of prompts is denoised as one batch, every prompt with its own trigger word position and all of them
+        sharing the same ID images. Pass one `torch.Generator` per prompt to get exactly the images that separate calls
+        with the same seeds would produce.
 
         Returns:
             [`~pipelines.stable_diffusion_xl.StableDiffusionXLPipelineOutput`] or `tuple`:
@@ -630,12 +1342,14 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
             raise ValueError(
                 "If `prompt_embeds` are provided, `class_tokens_mask` also have to be passed. Make sure to generate `class_tokens_mask` from the same tokenizer that was used to generate `prompt_embeds`."
             )
+        if identity is not None:
+            id_tokens = stack_identity_tokens(identity)
         # check the input id images
-        if input_id_images is None:
+        if input_id_images is None and id_tokens is None:
             raise ValueError(
                 "Provide `input_id_images`. Cannot leave `input_id_images` undefined for PhotoMaker pipeline."
             )
-        if not isinstance(input_id_images, list):
+        if input_id_images is not None and not isinstance(input_id_images, list):
             input_id_images = [input_id_images]
 
         # 2. Define call parameters
@@ -653,72 +1367,119 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
             cross_attention_kwargs.get("scale", None) if cross_attention_kwargs is not None else None
         )
         
-        num_id_images = len(input_id_images)
+        if id_tokens is not None:
+            if id_tokens.ndim == 3:
+                id_tokens = id_tokens.unsqueeze(0)
+            num_id_images = id_tokens.shape[1]
+        else:
+            num_id_images = len(input_id_images)
         
-        (
-            prompt_embeds, 
-            _,
-            pooled_prompt_embeds,
-            _,
-            class_tokens_mask,
-        ) = self.encode_prompt_with_trigger_word(
-            prompt=prompt,
-            prompt_2=prompt_2,
-            device=device,
-            num_id_images=num_id_images,
-            class_tokens_mask=class_tokens_mask,
-            num_images_per_prompt=num_images_per_prompt,
-            do_classifier_free_guidance=self.do_classifier_free_guidance,
-            negative_prompt=negative_prompt,
-            negative_prompt_2=negative_prompt_2,
-            prompt_embeds=prompt_embeds,
-            negative_prompt_embeds=negative_prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
-            lora_scale=lora_scale,
-            clip_skip=self._clip_skip,
-        )
-
-        # 4. Encode input prompt without the trigger word for delayed conditioning
-        # encode, remove trigger word token, then decode
-        tokens_text_only = self.tokenizer.encode(prompt, add_special_tokens=False)
-        trigger_word_token = self.tokenizer.convert_tokens_to_ids(self.trigger_word)
-        tokens_text_only.remove(trigger_word_token)
-        prompt_text_only = self.tokenizer.decode(tokens_text_only, add_special_tokens=False)
-        (
-            prompt_embeds_text_only,
+        precomputed_embeds = [
+            prompt_embeds,
             negative_prompt_embeds,
-            pooled_prompt_embeds_text_only, # TODO: replace the pooled_prompt_embeds with text only prompt
+            pooled_prompt_embeds,
             negative_pooled_prompt_embeds,
-        ) = self.encode_prompt(
-            prompt=prompt_text_only,
-            prompt_2=prompt_2,
-            device=device,
-            num_images_per_prompt=num_images_per_prompt,
-            do_classifier_free_guidance=self.do_classifier_free_guidance,
-            negative_prompt=negative_prompt,
-            negative_prompt_2=negative_prompt_2,
-            prompt_embeds=prompt_embeds_text_only,
-            negative_prompt_embeds=negative_prompt_embeds,
-            pooled_prompt_embeds=pooled_prompt_embeds_text_only,
-            negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
-            lora_scale=lora_scale,
-            clip_skip=self._clip_skip,
-        )
+            prompt_embeds_text_only,
+            pooled_prompt_embeds_text_only,
+        ]
+        with tracing.span("text_encoding", batch_size=batch_size):
+            if all(embeds is None for embeds in precomputed_embeds):
+                # 3.+4. Encode the prompt with and without the trigger word and the negative prompt in one pass
+                (
+                    prompt_embeds,
+                    pooled_prompt_embeds,
+                    class_tokens_mask,
+                    prompt_embeds_text_only,
+                    pooled_prompt_embeds_text_only, # TODO: replace the pooled_prompt_embeds with text only prompt
+                    negative_prompt_embeds,
+                    negative_pooled_prompt_embeds,
+                ) = self.encode_prompt_single_pass(
+                    prompt=prompt,
+                    prompt_2=prompt_2,
+                    device=device,
+                    num_images_per_prompt=num_images_per_prompt,
+                    do_classifier_free_guidance=self.do_classifier_free_guidance,
+                    negative_prompt=negative_prompt,
+                    negative_prompt_2=negative_prompt_2,
+                    lora_scale=lora_scale,
+                    clip_skip=self._clip_skip,
+                    num_id_images=num_id_images,
+                )
+            else:
+                (
+                    prompt_embeds, 
+                    _,
+                    pooled_prompt_embeds,
+                    _,
+                    class_tokens_mask,
+                ) = self.encode_prompt_with_trigger_word(
+                    prompt=prompt,
+                    prompt_2=prompt_2,
+                    device=device,
+                    num_id_images=num_id_images,
+                    class_tokens_mask=class_tokens_mask,
+                    num_images_per_prompt=num_images_per_prompt,
+                    do_classifier_free_guidance=self.do_classifier_free_guidance,
+                    negative_prompt=negative_prompt,
+                    negative_prompt_2=negative_prompt_2,
+                    prompt_embeds=prompt_embeds,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds,
+                    negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                    lora_scale=lora_scale,
+                    clip_skip=self._clip_skip,
+                )
+
+                # 4. Encode input prompt without the trigger word for delayed conditioning
+                prompt_text_only = self._remove_trigger_word([prompt] if isinstance(prompt, str) else prompt)
+                if isinstance(prompt, str):
+                    prompt_text_only = prompt_text_only[0]
+                (
+                    prompt_embeds_text_only,
+                    negative_prompt_embeds,
+                    pooled_prompt_embeds_text_only, # TODO: replace the pooled_prompt_embeds with text only prompt
+                    negative_pooled_prompt_embeds,
+                ) = self.encode_prompt(
+                    prompt=prompt_text_only,
+                    prompt_2=prompt_2,
+                    device=device,
+                    num_images_per_prompt=num_images_per_prompt,
+                    do_classifier_free_guidance=self.do_classifier_free_guidance,
+                    negative_prompt=negative_prompt,
+                    negative_prompt_2=negative_prompt_2,
+                    prompt_embeds=prompt_embeds_text_only,
+                    negative_prompt_embeds=negative_prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds_text_only,
+                    negative_pooled_prompt_embeds=negative_pooled_prompt_embeds,
+                    lora_scale=lora_scale,
+                    clip_skip=self._clip_skip,
+                )
 
         # 5. Prepare the input ID images
         dtype = next(self.id_encoder.parameters()).dtype
-        if not isinstance(input_id_images[0], torch.Tensor):
-            id_pixel_values = self.id_image_processor(input_id_images, return_tensors="pt").pixel_values
+        if id_tokens is None:
+            if id_embeds is None:
+                raise ValueError("Provide `id_embeds`. PhotoMaker v2 requires the face embeddings of the ID images.")
+            if not isinstance(input_id_images[0], torch.Tensor):
+                id_pixel_values = self.id_image_processor(input_id_images, return_tensors="pt").pixel_values
 
-        id_pixel_values = id_pixel_values.unsqueeze(0).to(device=device, dtype=dtype) # TODO: multiple prompts
+            id_pixel_values = id_pixel_values.unsqueeze(0).to(device=device, dtype=dtype)
+            id_embeds = id_embeds.unsqueeze(0).to(device=device, dtype=dtype)
+            # the identity is encoded once and shared by every prompt of the batch
+            with tracing.span("id_encoding", num_id_images=id_pixel_values.shape[1]):
+                id_tokens = self.id_encoder.encode_identity(id_pixel_values, id_embeds)
+        id_tokens = id_tokens.to(device=device, dtype=dtype)
+        if id_tokens.shape[0] == 1 and batch_size > 1:
+            id_tokens = id_tokens.repeat(batch_size, 1, 1, 1)
+        elif id_tokens.shape[0] != batch_size:
+            raise ValueError(
+                f"Got {id_tokens.shape[0]} identities for {batch_size} prompts, pass one identity for all prompts"
+                " or one per prompt."
+            )
 
         # 6. Get the update text embedding with the stacked ID embedding
-        if id_embeds is not None:
-            id_embeds = id_embeds.unsqueeze(0).to(device=device, dtype=dtype)
-            prompt_embeds = self.id_encoder(id_pixel_values, prompt_embeds, class_tokens_mask, id_embeds)
-        else:
-            prompt_embeds = self.id_encoder(id_pixel_values, prompt_embeds, class_tokens_mask)
+        with tracing.span("id_fuse", batch_size=batch_size):
+            prompt_embeds = self.id_encoder.fuse(prompt_embeds, class_tokens_mask, id_tokens)
 
         bs_embed, seq_len, _ = prompt_embeds.shape
         # duplicate text embeddings for each generation per prompt, using mps friendly method
@@ -736,8 +1497,10 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
             )
 
         # 7. Prepare timesteps
+        if scheduler is None:
+            scheduler = self.scheduler
         timesteps, num_inference_steps = retrieve_timesteps(
-            self.scheduler, num_inference_steps, device, timesteps, sigmas
+            scheduler, num_inference_steps, device, timesteps, sigmas
         )
 
         # 8. Prepare latent variables
@@ -751,9 +1514,10 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
             device,
             generator,
             latents,
+            scheduler=scheduler,
         )
         # 9. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
-        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta)
+        extra_step_kwargs = self.prepare_extra_step_kwargs(generator, eta, scheduler=scheduler)
 
         # 8.5 Optionally get Guidance Scale Embedding
         timestep_cond = None
@@ -765,20 +1529,23 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
 
         # 9. Prepare extra step kwargs. TODO: Logic should ideally just be moved out of the pipeline
         if use_adapter:
-            if isinstance(self.adapter, MultiAdapter):
-                adapter_state = self.adapter(adapter_input, adapter_conditioning_scale)
-                for k, v in enumerate(adapter_state):
-                    adapter_state[k] = v
-            else:
-                adapter_state = self.adapter(adapter_input)
-                for k, v in enumerate(adapter_state):
-                    adapter_state[k] = v * adapter_conditioning_scale
-            if num_images_per_prompt > 1:
-                for k, v in enumerate(adapter_state):
-                    adapter_state[k] = v.repeat(num_images_per_prompt, 1, 1, 1)
-            if self.do_classifier_free_guidance:
-                for k, v in enumerate(adapter_state):
-                    adapter_state[k] = torch.cat([v] * 2, dim=0)
+            with tracing.span("adapter", batch_size=batch_size * num_images_per_prompt):
+                if isinstance(self.adapter, MultiAdapter):
+                    adapter_state = self.adapter(adapter_input, adapter_conditioning_scale)
+                    for k, v in enumerate(adapter_state):
+                        adapter_state[k] = v
+                else:
+                    adapter_state = self.adapter(adapter_input)
+                    for k, v in enumerate(adapter_state):
+                        adapter_state[k] = v * adapter_conditioning_scale
+                if batch_size * num_images_per_prompt > adapter_state[0].shape[0]:
+                    # one sketch is shared by all prompts, or one sketch per prompt is shared by its images
+                    repeats = batch_size * num_images_per_prompt // adapter_state[0].shape[0]
+                    for k, v in enumerate(adapter_state):
+                        adapter_state[k] = v.repeat_interleave(repeats, dim=0)
+                if self.do_classifier_free_guidance:
+                    for k, v in enumerate(adapter_state):
+                        adapter_state[k] = torch.cat([v] * 2, dim=0)
 
         add_text_embeds = pooled_prompt_embeds
         if self.text_encoder_2 is None:
@@ -811,14 +1578,25 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
         add_text_embeds = add_text_embeds.to(device)
         add_time_ids = add_time_ids.to(device).repeat(batch_size * num_images_per_prompt, 1)
 
+        # 10.5 Prepare both conditionings once, the text-only one is used up to `start_merge_step`
+        # and the one with the stacked ID embedding afterwards, the loop only swaps references
+        if self.do_classifier_free_guidance:
+            text_only_embeds = torch.cat([negative_prompt_embeds, prompt_embeds_text_only], dim=0)
+            text_only_pooled = torch.cat([negative_pooled_prompt_embeds, pooled_prompt_embeds_text_only], dim=0)
+            merged_embeds = torch.cat([negative_prompt_embeds, prompt_embeds], dim=0)
+            merged_pooled = torch.cat([negative_pooled_prompt_embeds, pooled_prompt_embeds], dim=0)
+        else:
+            text_only_embeds, text_only_pooled = prompt_embeds_text_only, pooled_prompt_embeds_text_only
+            merged_embeds, merged_pooled = prompt_embeds, pooled_prompt_embeds
+
         # 11. Denoising loop
-        num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
+        num_warmup_steps = max(len(timesteps) - num_inference_steps * scheduler.order, 0)
         # Apply denoising_end
         if denoising_end is not None and isinstance(denoising_end, float) and denoising_end > 0 and denoising_end < 1:
             discrete_timestep_cutoff = int(
                 round(
-                    self.scheduler.config.num_train_timesteps
-                    - (denoising_end * self.scheduler.config.num_train_timesteps)
+                    scheduler.config.num_train_timesteps
+                    - (denoising_end * scheduler.config.num_train_timesteps)
                 )
             )
             num_inference_steps = len(list(filter(lambda ts: ts >= discrete_timestep_cutoff, timesteps)))
@@ -827,84 +1605,76 @@ class PhotoMakerStableDiffusionXLAdapterPipeline(StableDiffusionXLAdapterPipelin
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
 
-                # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
+                with tracing.span("denoise_step", step=i):
+                    # expand the latents if we are doing classifier free guidance
+                    latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
 
-                latent_model_input = self.scheduler.scale_model_input(latent_model_input, t)
-
-                if i <= start_merge_step:
-                    current_prompt_embeds = torch.cat(
-                        [negative_prompt_embeds, prompt_embeds_text_only], dim=0
-                    ) if self.do_classifier_free_guidance else prompt_embeds_text_only
-                    add_text_embeds = torch.cat(
-                        [negative_pooled_prompt_embeds, pooled_prompt_embeds_text_only], dim=0
-                        ) if self.do_classifier_free_guidance else pooled_prompt_embeds_text_only
-                else:
-                    current_prompt_embeds = torch.cat(
-                        [negative_prompt_embeds, prompt_embeds], dim=0
-                    ) if self.do_classifier_free_guidance else prompt_embeds
-                    add_text_embeds = torch.cat(
-                        [negative_pooled_prompt_embeds, pooled_prompt_embeds], dim=0
-                        ) if self.do_classifier_free_guidance else pooled_prompt_embeds
-
-                if i < int(num_inference_steps * adapter_conditioning_factor) and (use_adapter):
-                    down_intrablock_additional_residuals = [state.clone() for state in adapter_state]
-                else:
-                    down_intrablock_additional_residuals = None
-
-                added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
-                if ip_adapter_image is not None or ip_adapter_image_embeds is not None:
-                    added_cond_kwargs["image_embeds"] = image_embeds
-
-                # predict the noise residual
-                noise_pred = self.unet(
-                    latent_model_input,
-                    t,
-                    encoder_hidden_states=current_prompt_embeds,
-                    timestep_cond=timestep_cond,
-                    cross_attention_kwargs=cross_attention_kwargs,
-                    down_intrablock_additional_residuals=down_intrablock_additional_residuals,
-                    added_cond_kwargs=added_cond_kwargs,
-                    return_dict=False,
-                )[0]
-
-                # perform guidance
-                if self.do_classifier_free_guidance:
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+                    latent_model_input = scheduler.scale_model_input(latent_model_input, t)
 
-                if self.do_classifier_free_guidance and guidance_rescale > 0.0:
-                    # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
-                    noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=guidance_rescale)
+                    if i <= start_merge_step:
+                        current_prompt_embeds, add_text_embeds = text_only_embeds, text_only_pooled
+                    else:
+                        current_prompt_embeds, add_text_embeds = merged_embeds, merged_pooled
 
-                # compute the previous noisy sample x_t -> x_t-1
-                latents = self.scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=False)[0]
+                    if i < int(num_inference_steps * adapter_conditioning_factor) and (use_adapter):
+                        # NOTE: the unet pops the residuals off the list but never writes to them,
+                        # a new list is enough, the tensors themselves are shared by every step
+                        down_intrablock_additional_residuals = list(adapter_state)
+                    else:
+                        down_intrablock_additional_residuals = None
+
+                    added_cond_kwargs = {"text_embeds": add_text_embeds, "time_ids": add_time_ids}
+                    if ip_adapter_image is not None or ip_adapter_image_embeds is not None:
+                        added_cond_kwargs["image_embeds"] = image_embeds
+
+                    # predict the noise residual
+                    with tracing.span("unet", step=i, adapter=down_intrablock_additional_residuals is not None):
+                        noise_pred = self.unet(
+                            latent_model_input,
+                            t,
+                            encoder_hidden_states=current_prompt_embeds,
+                            timestep_cond=timestep_cond,
+                            cross_attention_kwargs=cross_attention_kwargs,
+                            down_intrablock_additional_residuals=down_intrablock_additional_residuals,
+                            added_cond_kwargs=added_cond_kwargs,
+                            return_dict=False,
+                        )[0]
+
+                    # perform guidance
+                    if self.do_classifier_free_guidance:
+                        noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                        noise_pred = noise_pred_uncond + guidance_scale * (noise_pred_text - noise_pred_uncond)
+
+                    if self.do_classifier_free_guidance and guidance_rescale > 0.0:
+                        # Based on 3.4. in https://arxiv.org/pdf/2305.08891.pdf
+                        noise_pred = rescale_noise_cfg(noise_pred, noise_pred_text, guidance_rescale=guidance_rescale)
+
+                    # compute the previous noisy sample x_t -> x_t-1
+                    step_output = scheduler.step(noise_pred, t, latents, **extra_step_kwargs, return_dict=True)
+                    latents = step_output.prev_sample
+
+                    if preview_callback is not None and (i + 1) % preview_steps == 0 and i != len(timesteps) - 1:
+                        # preview the predicted clean latents when the scheduler gives them, they are far less noisy
+                        denoised = getattr(step_output, "pred_original_sample", None)
+                        preview_callback(i, self.decode_latents_preview(denoised if denoised is not None else latents))
 
                 # call the callback, if provided
-                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % self.scheduler.order == 0):
+                if i == len(timesteps) - 1 or ((i + 1) > num_warmup_steps and (i + 1) % scheduler.order == 0):
                     progress_bar.update()
                     if callback is not None and i % callback_steps == 0:
-                        step_idx = i // getattr(self.scheduler, "order", 1)
+                        step_idx = i // getattr(scheduler, "order", 1)
                         callback(step_idx, t, latents)
 
         if not output_type == "latent":
-            # make sure the VAE is in float32 mode, as it overflows in float16
-            needs_upcasting = self.vae.dtype == torch.float16 and self.vae.config.force_upcast
-
-            if needs_upcasting:
-                self.upcast_vae()
-                latents = latents.to(next(iter(self.vae.post_quant_conv.parameters())).dtype)
-
-            image = self.vae.decode(latents / self.vae.config.scaling_factor, return_dict=False)[0]
-
-            # cast back to fp16 if needed
-            if needs_upcasting:
-                self.vae.to(dtype=torch.float16)
+            # the decode stage keeps its own float32 decoder, the VAE is never cast back and forth
+            with tracing.span("vae_decode", batch_size=latents.shape[0]):
+                image = self.vae_decode_stage.decode(latents / self.vae.config.scaling_factor)
         else:
             image = latents
             return StableDiffusionXLPipelineOutput(images=image)
 
-        image = self.image_processor.postprocess(image, output_type=output_type)
+        with tracing.span("postprocess", batch_size=image.shape[0]):
+            image = self.image_processor.postprocess(image, output_type=output_type)
 
         # Offload all models
         self.maybe_free_model_hooks()
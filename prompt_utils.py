@@ -0,0 +1,8 @@
+def check_trigger_word(pipe, prompt):
+    """Raise a `ValueError` unless `prompt` has the trigger word of `pipe` exactly once"""
+    image_token_id = pipe.tokenizer.convert_tokens_to_ids(pipe.trigger_word)
+    count = pipe.tokenizer.encode(prompt).count(image_token_id)
+    if count == 0:
+        raise ValueError(f"Cannot find the trigger word '{pipe.trigger_word}' in text prompt! Please add 'img' to your prompt.")
+    if count > 1:
+        raise ValueError(f"Cannot use multiple trigger words '{pipe.trigger_word}' in text prompt!")
@@ -0,0 +1,325 @@
+import asyncio
+import concurrent.futures
+import copy
+import queue
+import threading
+import time
+
+import torch
+
+from sampling_presets import get_sampling_preset
+from tracing import Histogram
+
+
+class GenerationJob:
+    """One click of a frontend: a single styled prompt, its identity and the sampling parameters.
+
+    `identity` is an `IdentityHandle` (see `load_identity`), `sketch_image` the doodle
+    for the T2I adapter or None. Jobs with the same `batch_key` run in one pipeline call.
+    `on_preview(step, images)` receives the previews of this job's images while it denoises.
+    `sampling_preset` names a preset of `sampling_presets.py`, None keeps the pipeline's scheduler.
+    Image `i` of the job is generated with the seed `seed + i`, so every image can be
+    reproduced on its own.
+    """
+
+    def __init__(
+        self,
+        prompt,
+        negative_prompt,
+        identity,
+        width,
+        height,
+        num_steps,
+        start_merge_step,
+        guidance_scale,
+        seed,
+        num_outputs=1,
+        sketch_image=None,
+        adapter_conditioning_scale=0.,
+        adapter_conditioning_factor=0.,
+        on_preview=None,
+        sampling_preset=None,
+    ):
+        self.prompt = prompt
+        self.negative_prompt = negative_prompt
+        self.identity = identity
+        self.width = width
+        self.height = height
+        self.num_steps = num_steps
+        self.start_merge_step = start_merge_step
+        self.guidance_scale = guidance_scale
+        self.seed = seed
+        self.num_outputs = num_outputs
+        self.sketch_image = sketch_image
+        self.adapter_conditioning_scale = adapter_conditioning_scale
+        self.adapter_conditioning_factor = adapter_conditioning_factor
+        self.on_preview = on_preview
+        self.sampling_preset = sampling_preset
+
+    @property
+    def num_pixels(self):
+        return self.width * self.height * self.num_outputs
+
+    def split(self, max_outputs):
+        """Sub-jobs of at most `max_outputs` images each, image `i` keeps the seed `seed + i` whatever the split"""
+        jobs = []
+        for start in range(0, self.num_outputs, max_outputs):
+            job = copy.copy(self)
+            job.seed = self.seed + start
+            job.num_outputs = min(max_outputs, self.num_outputs - start)
+            jobs.append(job)
+        return jobs
+
+    def batch_key(self):
+        # NOTE: everything the pipeline takes as a single value for the whole batch. prompts,
+        # negative prompts (i.e. the style), seeds, identities and sketches are per prompt.
+        use_adapter = self.sketch_image is not None
+        return (
+            self.width,
+            self.height,
+            self.num_steps,
+            self.start_merge_step,
+            self.guidance_scale,
+            self.sampling_preset,
+            self.num_outputs,
+            self.identity.num_id_images,
+            use_adapter,
+            self.adapter_conditioning_scale if use_adapter else None,
+            self.adapter_conditioning_factor if use_adapter else None,
+        )
+
+
+def run_pipeline_batch(pipe, jobs, device, preview_steps=5):
+    """Run compatible jobs as one pipeline call, returns the list of images of every job"""
+    first = jobs[0]
+
+    def preview_callback(step, images):
+        for i, job in enumerate(jobs):
+            if job.on_preview is not None:
+                job.on_preview(step, images[i * first.num_outputs:(i + 1) * first.num_outputs])
+
+    # one generator per image, so an image only depends on its own job and not on the batch it ran in
+    generator = [
+        torch.Generator(device=device).manual_seed(job.seed + i)
+        for job in jobs for i in range(job.num_outputs)
+    ]
+    use_adapter = first.sketch_image is not None
+    # a scheduler of its own for every batch, `pipe.scheduler` is shared and never swapped
+    scheduler = None
+    if first.sampling_preset is not None:
+        scheduler = get_sampling_preset(first.sampling_preset).make_scheduler(pipe.scheduler.config)
+    images = pipe(
+        prompt=[job.prompt for job in jobs],
+        width=first.width,
+        height=first.height,
+        negative_prompt=[job.negative_prompt for job in jobs],
+        num_images_per_prompt=first.num_outputs,
+        num_inference_steps=first.num_steps,
+        start_merge_step=first.start_merge_step,
+        generator=generator,
+        guidance_scale=first.guidance_scale,
+        identity=[job.identity for job in jobs],
+        image=[job.sketch_image for job in jobs] if use_adapter else None,
+        adapter_conditioning_scale=first.adapter_conditioning_scale if use_adapter else 0.,
+        adapter_conditioning_factor=first.adapter_conditioning_factor if use_adapter else 0.,
+        preview_callback=preview_callback if any(job.on_preview is not None for job in jobs) else None,
+        preview_steps=preview_steps,
+        scheduler=scheduler,
+    ).images
+    # images come out prompt major, `num_outputs` consecutive images per job
+    return [images[i * first.num_outputs:(i + 1) * first.num_outputs] for i in range(len(jobs))]
+
+
+class _Entry:
+    def __init__(self, job):
+        self.job = job
+        self.key = job.batch_key()
+        self.future = concurrent.futures.Future()
+        self.enqueued_at = time.monotonic()
+
+
+class MicroBatchScheduler:
+    """Groups concurrent generation jobs into micro-batches and runs them one batch at a time.
+
+    `run_batch(jobs)` is called with up to `max_batch_size` jobs of the same `batch_key` and
+    must return one result per job, e.g. `functools.partial(run_pipeline_batch, pipe, device=...)`
+    or any stub. The first job of a batch waits at most `batch_window` seconds for others to
+    join it, jobs queued while a batch is running are grouped for the next one.
+
+    With `max_batch_pixels` a batch never holds more output pixels (width x height x images)
+    than that, the memory budget of the UNet and VAE. `submit`, `generate` and `stream` split
+    a job with more images than fit into sub-jobs and put their images back together.
+
+    The scheduler runs its own event loop in a daemon thread started on the first submit, so
+    `submit` can be awaited from any event loop and `generate` called from any thread.
+    """
+
+    def __init__(self, run_batch, max_batch_size=4, batch_window=0.05, max_batch_pixels=None):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_batch_pixels = max_batch_pixels
+        self.wait_time = Histogram((0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300))
+        self.batch_size = Histogram(range(1, max_batch_size + 1))
+        self.max_queue_depth = 0
+        self._pending = []
+        # the batch the worker has taken out of `_pending` and waits for
+        self._running = []
+        self._queued = 0
+        self._loop = None
+        self._thread = None
+        self._queue = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="photomaker-batch")
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self):
+        return self._queued
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._run_loop, name="photomaker-scheduler", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+        # NOTE: the running batch is not waited for, its results are dropped when it finishes
+        error = RuntimeError("The request scheduler was stopped")
+        for entry in self._running + self._pending:
+            if not entry.future.done():
+                entry.future.set_exception(error)
+        while not self._queue.empty():
+            self._queue.get_nowait().future.set_exception(error)
+        self._running = []
+        self._pending = []
+        self._queued = 0
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        # created here so that it belongs to the scheduler's loop on every python version
+        self._queue = asyncio.Queue()
+        worker = self._loop.create_task(self._worker())
+        self._loop.run_forever()
+        # stopped: let the worker unwind instead of leaving a pending task to the garbage collector
+        worker.cancel()
+        self._loop.run_until_complete(asyncio.gather(worker, return_exceptions=True))
+        self._loop.close()
+
+    def max_outputs(self, width, height):
+        """Images of `width` x `height` pixels that fit in one batch"""
+        if self.max_batch_pixels is None:
+            return float("inf")
+        return max(1, self.max_batch_pixels // (width * height))
+
+    def split(self, job):
+        max_outputs = self.max_outputs(job.width, job.height)
+        return [job] if job.num_outputs <= max_outputs else job.split(max_outputs)
+
+    def _batch_limit(self, entry):
+        # jobs of one batch key have the same resolution and number of images
+        if self.max_batch_pixels is None:
+            return self.max_batch_size
+        return min(self.max_batch_size, max(1, self.max_batch_pixels // entry.job.num_pixels))
+
+    def submit_threadsafe(self, job):
+        """Queue `job` as it is, without splitting it, and return a `concurrent.futures.Future` of its result"""
+        self.start()
+        entry = _Entry(job)
+        with self._lock:
+            self._queued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self._queued)
+        self._loop.call_soon_threadsafe(lambda: self._queue.put_nowait(entry))
+        return entry.future
+
+    async def submit(self, job):
+        results = await asyncio.gather(
+            *(asyncio.wrap_future(self.submit_threadsafe(sub_job)) for sub_job in self.split(job))
+        )
+        return [image for result in results for image in result]
+
+    def generate(self, job, timeout=None):
+        """Blocking version of `submit` for synchronous callers"""
+        futures = [self.submit_threadsafe(sub_job) for sub_job in self.split(job)]
+        return [image for future in futures for image in future.result(timeout=timeout)]
+
+    def stream(self, job, poll_interval=0.1):
+        """Blocking generator of `(images, done)`: the previews of `job` while it runs, then its result"""
+        sub_jobs = self.split(job)
+        previews = queue.Queue()
+        # the latest previews of every sub-job, replaced by its images once it is done
+        latest = [[] for _ in sub_jobs]
+        for index, sub_job in enumerate(sub_jobs):
+            sub_job.on_preview = lambda step, images, index=index: previews.put((index, images))
+        futures = [self.submit_threadsafe(sub_job) for sub_job in sub_jobs]
+        while not all(future.done() for future in futures):
+            try:
+                index, images = previews.get(timeout=poll_interval)
+            except queue.Empty:
+                continue
+            latest[index] = images
+            for i, future in enumerate(futures):
+                if future.done() and future.exception() is None:
+                    latest[i] = future.result()
+            yield [image for images in latest for image in images], False
+        yield [image for future in futures for image in future.result()], True
+
+    def _next_batch(self):
+        key = self._pending[0].key
+        batch = [entry for entry in self._pending if entry.key == key][:self._batch_limit(self._pending[0])]
+        self._pending = [entry for entry in self._pending if entry not in batch]
+        return batch
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._pending:
+                self._pending.append(await self._queue.get())
+
+            # give the oldest job `batch_window` seconds to collect compatible jobs
+            key = self._pending[0].key
+            deadline = self._pending[0].enqueued_at + self.batch_window
+            while sum(entry.key == key for entry in self._pending) < self._batch_limit(self._pending[0]):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    self._pending.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            while not self._queue.empty():
+                self._pending.append(self._queue.get_nowait())
+
+            batch = self._running = self._next_batch()
+            started_at = time.monotonic()
+            for entry in batch:
+                self.wait_time.observe(started_at - entry.enqueued_at)
+            self.batch_size.observe(len(batch))
+            print(f"[Debug] Running a batch of {len(batch)} job(s), {self._queued - len(batch)} left in the queue")
+
+            try:
+                results = await loop.run_in_executor(self._executor, self.run_batch, [entry.job for entry in batch])
+            except Exception as e:
+                for entry in batch:
+                    entry.future.set_exception(e)
+            else:
+                for entry, result in zip(batch, results):
+                    entry.future.set_result(result)
+            self._running = []
+            with self._lock:
+                self._queued -= len(batch)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+            "wait_time": self.wait_time.snapshot(),
+            "batch_size": self.batch_size.snapshot(),
+        }
@@ -1,32 +1,46 @@
-from app import (
-    pipe, 
-    device, 
-    face_detector, 
-    apply_style, 
-    styles, 
-    aspect_ratios,
-    analyze_faces, 
-    torch, 
-    np, 
-    load_image,
-    TF
-)
+import torch
+import torchvision.transforms.functional as TF
+
+from diffusers.utils import load_image
+
+from identity_cache import load_identity
+from prompt_utils import check_trigger_word
+from runtime import get_runtime
+from sampling_presets import adapter_factor, get_sampling_preset, merge_step
+from style_template import styles, apply_style, DEFAULT_NEGATIVE_PROMPT
+from aspect_ratio_template import aspect_ratios
+
+# NOTE: nothing is loaded until the first generation, so this module can be imported as a library
+runtime = get_runtime()
 
 def generate_image_no_gradio(
     image_paths, 
     prompt, 
-    negative_prompt="nsfw, lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry",
+    negative_prompt=DEFAULT_NEGATIVE_PROMPT,
     aspect_ratio_name="", 
     style_name="Photographic (Default)", 
-    num_steps=50, 
+    num_steps=None, 
     style_strength_ratio=20, 
     guidance_scale=5.0, 
     seed=0,
     use_doodle=False,
     sketch_path=None,
     adapter_conditioning_scale=0.7,
-    adapter_conditioning_factor=0.8
+    adapter_conditioning_factor=0.8,
+    sampling_preset=None
 ):
+    pipe = runtime.pipe
+    face_detector = runtime.face_detector
+    identity_cache = runtime.identity_cache
+
+    # a preset of sampling_presets.py gets a scheduler of its own for this call, pipe.scheduler stays as it is
+    scheduler = None
+    if sampling_preset is not None:
+        preset = get_sampling_preset(sampling_preset)
+        scheduler = preset.make_scheduler(pipe.scheduler.config)
+        num_steps = num_steps or preset.num_steps
+    num_steps = num_steps or 50
+
     # Process sketch if doodle is enabled
     if use_doodle and sketch_path:
         sketch_image = load_image(sketch_path)
@@ -34,72 +48,62 @@ def generate_image_no_gradio(
         sketch_image = a.convert("RGB")
         sketch_image = TF.to_tensor(sketch_image) > 0.5  # Inversion 
         sketch_image = TF.to_pil_image(sketch_image.to(torch.float32))
+        # the same fraction of the steps, at least one step, whatever the number of steps
+        adapter_conditioning_factor = adapter_factor(adapter_conditioning_factor, num_steps)
     else:
         adapter_conditioning_scale = 0.
         adapter_conditioning_factor = 0.
         sketch_image = None
 
-    # Check for trigger word
-    image_token_id = pipe.tokenizer.convert_tokens_to_ids(pipe.trigger_word)
-    input_ids = pipe.tokenizer.encode(prompt)
-    if image_token_id not in input_ids:
-        raise ValueError(f"Cannot find the trigger word '{pipe.trigger_word}' in text prompt! Please add 'img' to your prompt.")
+    # A list of prompts is generated as one batch, one image per prompt
+    prompts = [prompt] if isinstance(prompt, str) else list(prompt)
+    seeds = list(seed) if isinstance(seed, (list, tuple)) else [seed] * len(prompts)
+    if len(seeds) != len(prompts):
+        raise ValueError(f"Got {len(seeds)} seeds for {len(prompts)} prompts, pass one seed per prompt.")
 
-    if input_ids.count(image_token_id) > 1:
-        raise ValueError(f"Cannot use multiple trigger words '{pipe.trigger_word}' in text prompt!")
+    # Check for trigger word
+    for one_prompt in prompts:
+        check_trigger_word(pipe, one_prompt)
 
     # Determine output dimensions by the aspect ratio
     output_w, output_h = aspect_ratios["Instagram (1:1)"]
     print(f"[Debug] Generate image using aspect ratio [{aspect_ratio_name}] => {output_w} x {output_h}")
 
     # Apply the style template
-    prompt, negative_prompt = apply_style(style_name, prompt, negative_prompt)
-
-    input_id_images = []
-    for img_path in image_paths:
-        input_id_images.append(load_image(img_path))
-    
-    id_embed_list = []
+    styled = [apply_style(style_name, one_prompt, negative_prompt) for one_prompt in prompts]
+    prompt = [p for p, _ in styled]
+    negative_prompt = [n for _, n in styled]
 
-    for img in input_id_images:
-        img = np.array(img)
-        img = img[:, :, ::-1]  # RGB to BGR
-        faces = analyze_faces(face_detector, img)
-        if len(faces) > 0:
-            id_embed_list.append(torch.from_numpy((faces[0]['embedding'])))
-
-    if len(id_embed_list) == 0:
-        raise ValueError("No face detected, please update the input face image(s)")
-    
-    id_embeds = torch.stack(id_embed_list)
+    # the IdentityHandle (pixel values, ArcFace embeddings, ID tokens) is reused when the same photos were seen before
+    identity = load_identity(pipe, face_detector, image_paths, identity_cache)
+    print(f"[Debug] Identity cache: {identity_cache.stats()}")
 
-    generator = torch.Generator(device=device).manual_seed(seed)
+    # one generator per prompt so every image matches the one generated on its own with the same seed
+    generator = [torch.Generator(device=runtime.device).manual_seed(s) for s in seeds]
 
     print("Start inference...")
-    print(f"[Debug] Seed: {seed}")
+    print(f"[Debug] Seed: {seeds}")
     print(f"[Debug] Prompt: {prompt}")
     print(f"[Debug] Neg Prompt: {negative_prompt}")
     
-    start_merge_step = int(float(style_strength_ratio) / 100 * num_steps)
-    if start_merge_step > 30:
-        start_merge_step = 30
-    print(f"[Debug] Start merge step: {start_merge_step}")
+    start_merge_step = merge_step(style_strength_ratio, num_steps, sampling_preset)
+    print(f"[Debug] Sampler: {sampling_preset or 'pipeline default'}, {num_steps} steps, start merge step: {start_merge_step}")
     
     images = pipe(
         prompt=prompt,
         width=output_w,
         height=output_h,
-        input_id_images=input_id_images,
         negative_prompt=negative_prompt,
         num_images_per_prompt=1,  # You can adjust this as needed
         num_inference_steps=num_steps,
         start_merge_step=start_merge_step,
         generator=generator,
         guidance_scale=guidance_scale,
-        id_embeds=id_embeds,
+        identity=identity,
         image=sketch_image,
         adapter_conditioning_scale=adapter_conditioning_scale,
         adapter_conditioning_factor=adapter_conditioning_factor,
+        scheduler=scheduler,
     ).images
     
     return images
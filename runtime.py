@@ -0,0 +1,309 @@
+import os
+import sys
+import threading
+import time
+
+import torch
+from diffusers import EulerDiscreteScheduler, T2IAdapter
+from huggingface_hub import hf_hub_download, try_to_load_from_cache
+
+from pipeline_t2i_adapter import PhotoMakerStableDiffusionXLAdapterPipeline
+from face_utils import FaceAnalysis2
+from fused_snapshot import FusedSnapshot, fingerprint, snapshot_key
+from identity_cache import IdentityCache, model_fingerprint
+from request_queue import MicroBatchScheduler, run_pipeline_batch
+from style_template import styles, apply_style, DEFAULT_NEGATIVE_PROMPT
+
+PHOTOMAKER_REPO = "TencentARC/PhotoMaker-V2"
+PHOTOMAKER_FILENAME = "photomaker-v2.bin"
+# the insightface model pack of the face detector, its ArcFace embeddings are part of every identity
+FACE_ANALYSIS_MODEL = "buffalo_l"
+
+
+def get_default_device():
+    try:
+        if torch.cuda.is_available():
+            return "cuda"
+        elif sys.platform == "darwin" and torch.backends.mps.is_available():
+            return "mps"
+        else:
+            return "cpu"
+    except:
+        return "cpu"
+
+
+class PhotoMakerRuntime:
+    """Loads the face analysis models, the PhotoMaker pipeline and the identity cache on first use.
+
+    Creating a runtime is free: nothing is downloaded or moved to the device until one of
+    `face_detector`, `pipe` or `identity_cache` is accessed. Every component can point at a
+    local path instead of a hub repo. The time spent loading each component is kept in
+    `load_times`, and a warning is printed when the total exceeds `cold_start_budget` seconds.
+    `request_scheduler` groups concurrent frontend requests into batches of up to
+    `max_batch_size` jobs collected within `batch_window` seconds, jobs with an `on_preview`
+    callback get a preview every `preview_steps` denoising steps. A batch holds at most
+    `max_batch_pixels` output pixels, requests for more images are split into sub-batches.
+    With `snapshot_dir` the UNet with the PhotoMaker LoRA fused in and the ID encoder are
+    saved there on the first start and loaded directly on the next ones, see `fused_snapshot.py`.
+    """
+
+    def __init__(
+        self,
+        base_model_path='SG161222/RealVisXL_V4.0',
+        adapter_path="TencentARC/t2i-adapter-sketch-sdxl-1.0",
+        photomaker_ckpt=None,
+        device=None,
+        torch_dtype=torch.float16,
+        identity_cache_bytes=1024 ** 3,
+        identity_cache_dir=None,
+        identity_cache_entries=None,
+        cold_start_budget=None,
+        max_batch_size=4,
+        batch_window=0.05,
+        max_batch_pixels=4 * 1024 * 1024,
+        preview_steps=5,
+        snapshot_dir=None,
+    ):
+        self.base_model_path = base_model_path
+        self.adapter_path = adapter_path
+        self.photomaker_ckpt = photomaker_ckpt
+        self.device = device or get_default_device()
+        self.torch_dtype = torch_dtype
+        self.identity_cache_bytes = identity_cache_bytes
+        self.identity_cache_dir = identity_cache_dir
+        self.identity_cache_entries = identity_cache_entries
+        self.cold_start_budget = cold_start_budget
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self.max_batch_pixels = max_batch_pixels
+        self.preview_steps = preview_steps
+        self.snapshot_dir = snapshot_dir
+        self.load_times = {}
+
+        self._face_detector = None
+        self._pipe = None
+        self._identity_cache = None
+        self._request_scheduler = None
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_env(cls):
+        """Build a runtime configured by the `PHOTOMAKER_*` environment variables"""
+        budget = os.environ.get("PHOTOMAKER_COLD_START_BUDGET")
+        identity_cache_entries = os.environ.get("PHOTOMAKER_IDENTITY_CACHE_ENTRIES")
+        return cls(
+            base_model_path=os.environ.get("PHOTOMAKER_BASE_MODEL", 'SG161222/RealVisXL_V4.0'),
+            adapter_path=os.environ.get("PHOTOMAKER_ADAPTER", "TencentARC/t2i-adapter-sketch-sdxl-1.0"),
+            photomaker_ckpt=os.environ.get("PHOTOMAKER_CKPT"),
+            device=os.environ.get("PHOTOMAKER_DEVICE"),
+            identity_cache_bytes=int(os.environ.get("PHOTOMAKER_IDENTITY_CACHE_BYTES", 1024 ** 3)),
+            identity_cache_dir=os.environ.get("PHOTOMAKER_IDENTITY_CACHE_DIR"),
+            identity_cache_entries=int(identity_cache_entries) if identity_cache_entries else None,
+            cold_start_budget=float(budget) if budget else None,
+            max_batch_size=int(os.environ.get("PHOTOMAKER_MAX_BATCH_SIZE", 4)),
+            batch_window=float(os.environ.get("PHOTOMAKER_BATCH_WINDOW", 0.05)),
+            max_batch_pixels=int(os.environ.get("PHOTOMAKER_MAX_BATCH_PIXELS", 4 * 1024 * 1024)),
+            preview_steps=int(os.environ.get("PHOTOMAKER_PREVIEW_STEPS", 5)),
+            snapshot_dir=os.environ.get("PHOTOMAKER_SNAPSHOT_DIR"),
+        )
+
+    @property
+    def cold_start_time(self):
+        return sum(self.load_times.values())
+
+    def _record(self, name, start):
+        self.load_times[name] = time.perf_counter() - start
+        print(f"[Debug] Loaded {name} in {self.load_times[name]:.2f}s")
+        if self.cold_start_budget is not None and self.cold_start_time > self.cold_start_budget:
+            print(
+                f"[Warning] Cold start took {self.cold_start_time:.2f}s, "
+                f"over the budget of {self.cold_start_budget:.2f}s: {self.load_times}"
+            )
+
+    @property
+    def face_detector(self):
+        with self._lock:
+            if self._face_detector is None:
+                start = time.perf_counter()
+                face_detector = FaceAnalysis2(name=FACE_ANALYSIS_MODEL, providers=['CPUExecutionProvider', 'CUDAExecutionProvider'], allowed_modules=['detection', 'recognition'])
+                face_detector.prepare(ctx_id=0, det_size=(640, 640))
+                self._face_detector = face_detector
+                self._record("face_detector", start)
+            return self._face_detector
+
+    @property
+    def pipe(self):
+        with self._lock:
+            if self._pipe is None:
+                self._pipe = self._load_pipe()
+            return self._pipe
+
+    @property
+    def identity_cache(self):
+        with self._lock:
+            if self._identity_cache is None:
+                # identities are keyed by the content of the uploaded photos, set the dir to keep them across restarts.
+                # on disk they are kept per model, a new checkpoint or dtype starts from an empty store
+                self._identity_cache = IdentityCache(
+                    max_bytes=self.identity_cache_bytes,
+                    cache_dir=self.identity_cache_dir,
+                    max_entries=self.identity_cache_entries,
+                    fingerprint=self.identity_fingerprint() if self.identity_cache_dir is not None else None,
+                )
+            return self._identity_cache
+
+    def identity_fingerprint(self):
+        """`model_fingerprint` of the PhotoMaker checkpoint, the dtype and the face detector"""
+        return model_fingerprint(fingerprint(self.photomaker_ckpt_file()), self.torch_dtype, FACE_ANALYSIS_MODEL)
+
+    def photomaker_ckpt_file(self):
+        """Local path of the PhotoMaker checkpoint, the hub is only asked when it is not in the local cache"""
+        if self.photomaker_ckpt is not None:
+            return self.photomaker_ckpt
+        cached = try_to_load_from_cache(PHOTOMAKER_REPO, PHOTOMAKER_FILENAME, repo_type="model")
+        if isinstance(cached, str):
+            return cached
+        return hf_hub_download(repo_id=PHOTOMAKER_REPO, filename=PHOTOMAKER_FILENAME, repo_type="model")
+
+    def base_model_dir(self):
+        """Local directory of the base model, the hub is only asked when it is not in the local cache"""
+        if os.path.isdir(self.base_model_path):
+            return self.base_model_path
+        try:
+            return PhotoMakerStableDiffusionXLAdapterPipeline.download(
+                self.base_model_path, use_safetensors=True, variant="fp16", local_files_only=True
+            )
+        except OSError:
+            return PhotoMakerStableDiffusionXLAdapterPipeline.download(
+                self.base_model_path, use_safetensors=True, variant="fp16"
+            )
+
+    @property
+    def request_scheduler(self):
+        with self._lock:
+            if self._request_scheduler is None:
+                self._request_scheduler = MicroBatchScheduler(
+                    self.run_batch,
+                    max_batch_size=self.max_batch_size,
+                    batch_window=self.batch_window,
+                    max_batch_pixels=self.max_batch_pixels,
+                )
+            return self._request_scheduler
+
+    def run_batch(self, jobs):
+        """Run a list of compatible `GenerationJob`s as one pipeline call"""
+        return run_pipeline_batch(self.pipe, jobs, self.device, preview_steps=self.preview_steps)
+
+    def _load_pipe(self):
+        device = self.device
+        torch_dtype = self.torch_dtype
+
+        start = time.perf_counter()
+        photomaker_ckpt = self.photomaker_ckpt_file()
+        self._record("photomaker_ckpt", start)
+
+        # load adapter
+        start = time.perf_counter()
+        adapter = T2IAdapter.from_pretrained(
+            self.adapter_path, torch_dtype=torch_dtype, variant="fp16"
+        ).to(device)
+        self._record("adapter", start)
+
+        base_model_path = self.base_model_path
+        snapshot = None
+        if self.snapshot_dir is not None:
+            start = time.perf_counter()
+            # the snapshot is keyed by the files of the base model, so resolve a hub id to its local copy
+            base_model_path = self.base_model_dir()
+            snapshot = FusedSnapshot(self.snapshot_dir, snapshot_key(base_model_path, photomaker_ckpt, torch_dtype))
+            self._record("snapshot_key", start)
+
+        start = time.perf_counter()
+        unet_kwargs = {}
+        if snapshot is not None and snapshot.exists():
+            unet_kwargs["unet"] = snapshot.load_unet(torch_dtype)
+        pipe = PhotoMakerStableDiffusionXLAdapterPipeline.from_pretrained(
+            base_model_path,
+            adapter=adapter,
+            torch_dtype=torch_dtype,
+            use_safetensors=True,
+            variant="fp16",
+            **unet_kwargs,
+        ).to(device)
+        # one latent at a time like vae slicing, with a float32 decoder kept next to the fp16 vae
+        pipe.vae_decode_stage.chunk_size = 1
+        self._record("base_model", start)
+
+        if "unet" in unet_kwargs:
+            # fast path: the LoRA is already fused into the snapshot's unet
+            start = time.perf_counter()
+            pipe.load_photomaker_snapshot(snapshot.id_encoder_file, trigger_word="img")
+            pipe.scheduler = EulerDiscreteScheduler.from_config(pipe.scheduler.config)
+            self._record("photomaker_snapshot", start)
+            return pipe
+
+        start = time.perf_counter()
+        pipe.load_photomaker_adapter(
+            os.path.dirname(photomaker_ckpt),
+            subfolder="",
+            weight_name=os.path.basename(photomaker_ckpt),
+            trigger_word="img",
+            pm_version="v2",
+        )
+        pipe.id_encoder.to(device)
+
+        pipe.scheduler = EulerDiscreteScheduler.from_config(pipe.scheduler.config)
+        # pipe.set_adapters(["photomaker"], adapter_weights=[1.0])
+        pipe.fuse_lora()
+        pipe.to(device)
+        self._record("photomaker", start)
+
+        if snapshot is not None:
+            start = time.perf_counter()
+            # the fused weights stay in the unet, only the peft layers are removed
+            pipe.unload_lora_weights()
+            snapshot.save(pipe, self.base_model_path, photomaker_ckpt)
+            self._record("snapshot_save", start)
+        return pipe
+
+    def warmup_styles(self, negative_prompt=DEFAULT_NEGATIVE_PROMPT):
+        """Encode the negative prompt of every style template ahead of the first request"""
+        start = time.perf_counter()
+        negative_prompts = [apply_style(style_name, "", negative_prompt)[1] for style_name in styles]
+        self.pipe.warmup_text_embeddings(negative_prompts)
+        self._record("style_embeddings", start)
+
+    def warmup(self):
+        """Load every component now instead of on the first request"""
+        self.face_detector
+        self.pipe
+        self.identity_cache
+        self.warmup_styles()
+        print(f"[Debug] Cold start finished in {self.cold_start_time:.2f}s: {self.load_times}")
+        return self.load_times
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+
+def get_runtime():
+    """The process-wide runtime shared by app.py, run.py and gradio_run.py"""
+    global _runtime
+    with _runtime_lock:
+        if _runtime is None:
+            _runtime = PhotoMakerRuntime.from_env()
+        return _runtime
+
+
+def warmup_enabled():
+    """Whether the entry points load everything before serving, `PHOTOMAKER_WARMUP=0` defers it to the first request"""
+    return os.environ.get("PHOTOMAKER_WARMUP", "1").lower() not in ("0", "false", "no")
+
+
+def set_runtime(runtime):
+    """Replace the shared runtime, e.g. with one configured for local checkpoints"""
+    global _runtime
+    with _runtime_lock:
+        _runtime = runtime
+    return runtime
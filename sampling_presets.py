@@ -0,0 +1,107 @@
+"""
+Sampling presets: a scheduler and a step count that can be picked per request.
+
+    preset = get_sampling_preset("dpm++ 2m karras")
+    images = pipe(..., num_inference_steps=preset.num_steps, scheduler=preset.make_scheduler(pipe.scheduler.config),
+                  start_merge_step=merge_step(style_strength_ratio, preset.num_steps, preset.name))
+
+Every call gets a new scheduler built from the config of `pipe.scheduler`, which stays as it is.
+Schedulers keep their timesteps and solver history on the instance, so a shared one must not be
+reconfigured while another request denoises with it.
+
+PhotoMaker merges the ID embedding into the prompt after `start_merge_step` and the T2I adapter
+runs for the first `adapter_conditioning_factor` of the steps. Both are fractions of the trajectory,
+`merge_step` and `adapter_factor` turn them into step numbers that keep their meaning at 6 steps as
+well as at 50.
+"""
+
+from diffusers import (
+    DPMSolverMultistepScheduler,
+    EulerAncestralDiscreteScheduler,
+    EulerDiscreteScheduler,
+    UniPCMultistepScheduler,
+)
+
+# NOTE: the original cap of `start_merge_step`, 30 steps, is kept for calls without a preset,
+# presets scale it with their steps as the same fraction of the 50 steps it was meant for
+MAX_MERGE_STEP = 30
+MAX_MERGE_FRACTION = MAX_MERGE_STEP / 50
+
+
+class SamplingPreset:
+    """A scheduler class, the config values it overrides and the number of steps it is meant for"""
+
+    def __init__(self, name, scheduler_class, num_steps, description="", **scheduler_kwargs):
+        self.name = name
+        self.scheduler_class = scheduler_class
+        self.num_steps = num_steps
+        self.description = description
+        self.scheduler_kwargs = scheduler_kwargs
+
+    def make_scheduler(self, config):
+        """A new scheduler for one call, from the config of the pipeline's scheduler with this preset's overrides"""
+        return self.scheduler_class.from_config(config, **self.scheduler_kwargs)
+
+
+SAMPLING_PRESETS = {
+    preset.name: preset
+    for preset in [
+        SamplingPreset(
+            "euler", EulerDiscreteScheduler, 50,
+            description="the default sampler of PhotoMaker",
+        ),
+        SamplingPreset(
+            "euler ancestral", EulerAncestralDiscreteScheduler, 30,
+            description="adds fresh noise every step, more varied and less literal",
+        ),
+        SamplingPreset(
+            "dpm++ 2m karras", DPMSolverMultistepScheduler, 25,
+            description="second order multistep solver, close to euler at half the steps",
+            algorithm_type="dpmsolver++", solver_order=2, use_karras_sigmas=True,
+        ),
+        SamplingPreset(
+            "unipc", UniPCMultistepScheduler, 20,
+            description="predictor-corrector multistep solver, good at 15-25 steps",
+        ),
+        SamplingPreset(
+            "fast", DPMSolverMultistepScheduler, 8,
+            description="few steps: trailing timesteps start from pure noise, drafts in a fraction of the time",
+            algorithm_type="dpmsolver++", solver_order=2, timestep_spacing="trailing",
+        ),
+    ]
+}
+DEFAULT_SAMPLING_PRESET = "euler"
+
+
+def get_sampling_preset(name):
+    if name not in SAMPLING_PRESETS:
+        raise ValueError(f"Unknown sampling preset {name!r}, choose one of {list(SAMPLING_PRESETS)}")
+    return SAMPLING_PRESETS[name]
+
+
+def merge_step(style_strength_ratio, num_steps, sampling_preset=None):
+    """
+    `start_merge_step` for `num_steps` steps: the steps before it only see the text prompt.
+
+    Without a `sampling_preset` it is capped at `MAX_MERGE_STEP` like it always was, with one the
+    cap is `MAX_MERGE_FRACTION` of the steps, so a preset with few steps still merges the identity.
+    """
+    # int() of the same product as before, so the default 50 steps give the same step as ever
+    start_merge_step = int(float(style_strength_ratio) / 100 * num_steps)
+    if sampling_preset is None:
+        return min(start_merge_step, MAX_MERGE_STEP)
+    return min(start_merge_step, int(MAX_MERGE_FRACTION * num_steps))
+
+
+def adapter_factor(adapter_conditioning_factor, num_steps):
+    """
+    `adapter_conditioning_factor` for `num_steps` steps.
+
+    The pipeline runs the adapter for `int(num_steps * factor)` steps, which is 0 for 0.2 of 4 steps.
+    The factor returned gives the nearest number of steps instead, and at least one for a factor above 0.
+    """
+    if adapter_conditioning_factor <= 0:
+        return 0.
+    adapter_steps = min(num_steps, max(1, round(adapter_conditioning_factor * num_steps)))
+    # half a step above, so int() in the pipeline lands on `adapter_steps` whatever the float rounding
+    return (adapter_steps + 0.5) / num_steps
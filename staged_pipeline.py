@@ -0,0 +1,198 @@
+import queue
+import threading
+import time
+
+import torch
+from diffusers.utils import load_image
+
+from identity_cache import detect_id_embeds, hash_identity_images
+from sampling_presets import get_sampling_preset
+import tracing
+
+# marks the end of the job stream, it is passed from stage to stage after the last job
+_DONE = object()
+
+
+class Stage:
+    """One step of a `StagedPipeline`: `fn(job)` runs on `workers` threads and returns the job for the next stage.
+
+    `queue_size` bounds the number of jobs waiting for this stage, a full queue blocks the stage before it.
+    """
+
+    def __init__(self, name, fn, workers=1, queue_size=2):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue_size = queue_size
+
+
+class StagedPipeline:
+    """Runs jobs through a chain of stages connected by bounded queues.
+
+    Every stage has its own worker threads, so while the GPU denoises job N the CPU
+    stages already load and preprocess job N+1 and encode the images of job N-1.
+    Jobs are dicts that every stage reads from and adds to. A job whose stage raised
+    gets an `error` and skips the remaining stages, `timings` holds the seconds each
+    stage spent on it. Jobs come out in the order they finish.
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.busy = {stage.name: 0.0 for stage in self.stages}
+        self.processed = {stage.name: 0 for stage in self.stages}
+        self.wall_time = 0.0
+        self._lock = threading.Lock()
+
+    def _work(self, stage, in_queue, out_queue, remaining):
+        while True:
+            job = in_queue.get()
+            if job is _DONE:
+                # put it back for the other workers of this stage, the last one passes it on
+                in_queue.put(_DONE)
+                with self._lock:
+                    remaining[stage.name] -= 1
+                    last = remaining[stage.name] == 0
+                if last:
+                    out_queue.put(_DONE)
+                return
+            if "error" not in job:
+                start = time.perf_counter()
+                try:
+                    with tracing.span(f"stage.{stage.name}"):
+                        job = stage.fn(job)
+                except Exception as e:
+                    job["error"] = f"{stage.name}: {e!r}"
+                elapsed = time.perf_counter() - start
+                job.setdefault("timings", {})[stage.name] = elapsed
+                with self._lock:
+                    self.busy[stage.name] += elapsed
+                    self.processed[stage.name] += 1
+            out_queue.put(job)
+
+    def _feed(self, jobs, first_queue):
+        try:
+            for job in jobs:
+                first_queue.put(job)
+        finally:
+            first_queue.put(_DONE)
+
+    def run(self, jobs):
+        """Generator of the finished jobs of `jobs`, any iterable of dicts"""
+        queues = [queue.Queue(maxsize=stage.queue_size) for stage in self.stages] + [queue.Queue()]
+        remaining = {stage.name: stage.workers for stage in self.stages}
+        threads = [threading.Thread(target=self._feed, args=(jobs, queues[0]), name="staged-feed", daemon=True)]
+        for i, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], queues[i + 1], remaining),
+                    name=f"staged-{stage.name}-{worker}",
+                    daemon=True,
+                ))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        while True:
+            job = queues[-1].get()
+            if job is _DONE:
+                break
+            yield job
+        for thread in threads:
+            thread.join()
+        self.wall_time += time.perf_counter() - start
+
+    def stats(self):
+        """Busy seconds and utilization of every stage, the stage closest to 1.0 bounds the throughput"""
+        return {
+            "wall_time": self.wall_time,
+            "stages": {
+                stage.name: {
+                    "workers": stage.workers,
+                    "jobs": self.processed[stage.name],
+                    "busy": self.busy[stage.name],
+                    "utilization": self.busy[stage.name] / (stage.workers * self.wall_time) if self.wall_time else 0.0,
+                }
+                for stage in self.stages
+            },
+        }
+
+
+def _as_list(value):
+    return value if isinstance(value, list) else [value]
+
+
+def photomaker_stages(runtime, prefetch_workers=2, save_workers=2, queue_size=2):
+    """
+    The stages of a PhotoMaker batch job: prefetch -> preprocess -> denoise -> decode -> save.
+
+    A job is a dict with `image_paths`, `prompt`, `negative_prompt`, `seed`, `width`, `height`,
+    `num_steps`, `start_merge_step`, `guidance_scale`, `output_path` and optionally
+    `sampling_preset`, the name of a preset of sampling_presets.py. Prompts are used as
+    they are, apply the style before. `prompt`, `negative_prompt`, `seed` and `output_path`
+    can also be lists to denoise several prompts of the same person as one batch. Only `denoise` and `decode` use the GPU, they run on
+    one worker each, and so does `preprocess` because face analysis sets the detection size
+    on the shared detector.
+    """
+    pipe = runtime.pipe
+    face_detector = runtime.face_detector
+    identity_cache = runtime.identity_cache
+
+    def prefetch(job):
+        # known identities skip loading and preprocessing their photos
+        job["identity_key"] = hash_identity_images(job["image_paths"])
+        job["identity"] = identity_cache.get(job["identity_key"])
+        if job["identity"] is None:
+            with tracing.span("image_load", num_images=len(job["image_paths"])):
+                job["id_images"] = [load_image(path) for path in job["image_paths"]]
+        return job
+
+    def preprocess(job):
+        if job["identity"] is None:
+            job["id_embeds"] = detect_id_embeds(face_detector, job["id_images"])
+            job["id_pixel_values"] = pipe.preprocess_id_images(job.pop("id_images"))
+        return job
+
+    def denoise(job):
+        if job["identity"] is None:
+            identity = pipe.create_identity(
+                list(job.pop("id_pixel_values")), job.pop("id_embeds"), key=job["identity_key"]
+            )
+            job["identity"] = identity_cache.put(job["identity_key"], identity)
+        scheduler = None
+        if job.get("sampling_preset") is not None:
+            scheduler = get_sampling_preset(job["sampling_preset"]).make_scheduler(pipe.scheduler.config)
+        job["latents"] = pipe(
+            prompt=job["prompt"],
+            negative_prompt=job["negative_prompt"],
+            width=job["width"],
+            height=job["height"],
+            num_inference_steps=job["num_steps"],
+            start_merge_step=job["start_merge_step"],
+            guidance_scale=job["guidance_scale"],
+            generator=[torch.Generator(device=runtime.device).manual_seed(seed) for seed in _as_list(job["seed"])],
+            identity=job.pop("identity"),
+            output_type="latent",
+            scheduler=scheduler,
+        ).images
+        return job
+
+    def decode(job):
+        image = pipe.vae_decode_stage.decode(job.pop("latents") / pipe.vae.config.scaling_factor)
+        job["images"] = pipe.image_processor.postprocess(image, output_type="pil")
+        return job
+
+    def save(job):
+        # NOTE: PIL releases the GIL while it compresses, so threads are enough for the PNG encoding
+        for image, output_path in zip(job.pop("images"), _as_list(job["output_path"])):
+            with tracing.span("png_encode"):
+                image.save(output_path)
+        return job
+
+    return [
+        Stage("prefetch", prefetch, workers=prefetch_workers, queue_size=queue_size),
+        Stage("preprocess", preprocess, workers=1, queue_size=queue_size),
+        Stage("denoise", denoise, workers=1, queue_size=queue_size),
+        Stage("decode", decode, workers=1, queue_size=queue_size),
+        Stage("save", save, workers=save_workers, queue_size=queue_size),
+    ]
@@ -56,4 +56,12 @@ style_list = [
     }
 ]
 
-styles = {k["name"]: (k["prompt"], k["negative_prompt"]) for k in style_list}
\ No newline at end of file
+styles = {k["name"]: (k["prompt"], k["negative_prompt"]) for k in style_list}
+
+DEFAULT_STYLE_NAME = "Photographic (Default)"
+DEFAULT_NEGATIVE_PROMPT = "nsfw, lowres, bad anatomy, bad hands, text, error, missing fingers, extra digit, fewer digits, cropped, worst quality, low quality, normal quality, jpeg artifacts, signature, watermark, username, blurry"
+
+
+def apply_style(style_name: str, positive: str, negative: str = "") -> tuple[str, str]:
+    p, n = styles.get(style_name, styles[DEFAULT_STYLE_NAME])
+    return p.replace("{prompt}", positive), n + ' ' + negative
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+# the modules of this repo live at the top level, not in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def tiny_pipe():
+    """A `build_tiny_pipeline` shared by the tests that only read from it"""
+    from tiny_models import build_tiny_pipeline
+
+    pipe = build_tiny_pipeline()
+    pipe.set_progress_bar_config(disable=True)
+    return pipe
@@ -0,0 +1,138 @@
+import csv
+import json
+import os
+
+import pytest
+from PIL import Image
+
+from batch_run import batch_jobs, read_manifest, read_progress, resolution, run_manifest
+from sampling_presets import get_sampling_preset
+from style_template import DEFAULT_NEGATIVE_PROMPT, DEFAULT_STYLE_NAME
+
+
+def _write_jsonl(path, rows):
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+def _write_photos(directory, names):
+    for i, name in enumerate(names):
+        Image.new("RGB", (64, 64), (40 * i, 120, 200)).save(os.path.join(directory, name))
+
+
+@pytest.fixture(scope="module")
+def tiny_runtime():
+    from tiny_models import TinyPhotoMakerRuntime
+
+    runtime = TinyPhotoMakerRuntime()
+    runtime.pipe.set_progress_bar_config(disable=True)
+    return runtime
+
+
+def test_read_manifest_csv_fills_in_defaults(tmp_path):
+    manifest = tmp_path / "jobs.csv"
+    with open(manifest, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["id", "images", "prompt", "seed", "steps", "style", "sampler"])
+        writer.writeheader()
+        writer.writerow({"id": "a", "images": "me/1.jpg; me/2.jpg", "prompt": "a man img", "seed": "7", "steps": "12"})
+        writer.writerow({"id": "", "images": "you.jpg", "prompt": "a woman img", "style": "Digital Art", "sampler": "dpm++ 2m karras"})
+
+    first, second = read_manifest(str(manifest))
+
+    assert first["id"] == "a"
+    assert first["images"] == [str(tmp_path / "me" / "1.jpg"), str(tmp_path / "me" / "2.jpg")]
+    assert (first["seed"], first["steps"], first["sampler"]) == (7, 12, "euler")
+    assert (first["style"], first["negative_prompt"]) == (DEFAULT_STYLE_NAME, DEFAULT_NEGATIVE_PROMPT)
+    assert (first["style_strength_ratio"], first["guidance_scale"]) == (20.0, 5.0)
+    # an empty id is the row index, empty steps are the sampler's
+    assert second["id"] == "1"
+    assert second["style"] == "Digital Art"
+    assert (second["seed"], second["steps"]) == (0, get_sampling_preset("dpm++ 2m karras").num_steps)
+
+
+def test_read_manifest_jsonl_takes_image_lists(tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    _write_jsonl(manifest, [{"images": ["me.jpg", "/photos/me.jpg"], "prompt": "a man img", "seed": 3, "guidance_scale": 2}])
+    with open(manifest, "a") as f:
+        f.write("\n")
+
+    (row,) = read_manifest(str(manifest))
+
+    assert row["id"] == "0"
+    assert row["images"] == [str(tmp_path / "me.jpg"), "/photos/me.jpg"]
+    assert (row["seed"], row["guidance_scale"], row["aspect_ratio"]) == (3, 2.0, "Instagram (1:1)")
+
+
+def test_read_progress_skips_errors_and_a_torn_last_line(tmp_path):
+    progress_file = tmp_path / "progress.jsonl"
+    assert read_progress(str(progress_file)) == set()
+    with open(progress_file, "w") as f:
+        f.write(json.dumps({"id": "0", "output": "0.png"}) + "\n")
+        f.write(json.dumps({"id": "1", "error": "denoise: boom"}) + "\n")
+        f.write('{"id": "2", "outp')
+
+    assert read_progress(str(progress_file)) == {"0"}
+
+
+def test_batch_jobs_groups_rows_of_one_person_and_resolution(tmp_path):
+    manifest = tmp_path / "jobs.jsonl"
+    rows = [
+        {"id": "a1", "images": ["a.jpg"], "prompt": "a man img", "seed": 1},
+        {"id": "b1", "images": ["b.jpg"], "prompt": "a woman img", "seed": 2},
+        {"id": "a2", "images": ["a.jpg"], "prompt": "a man img in space", "seed": 3},
+        {"id": "a3", "images": ["a.jpg"], "prompt": "a man img", "seed": 4},
+        {"id": "a4", "images": ["a.jpg"], "prompt": "a man img", "seed": 5, "aspect_ratio": "Widescreen TV / Landscape (16:9)"},
+        {"id": "a5", "images": ["a.jpg"], "prompt": "a man img", "seed": 6, "steps": 30},
+    ]
+    _write_jsonl(manifest, rows)
+
+    jobs = list(batch_jobs(read_manifest(str(manifest)), "out", batch_size=2, scale=0.25))
+
+    batches = sorted([row["id"] for row in job["rows"]] for job in jobs)
+    assert batches == [["a1", "a2"], ["a3"], ["a4"], ["a5"], ["b1"]]
+    for job in jobs:
+        assert len({(row["aspect_ratio"], row["steps"], tuple(row["images"])) for row in job["rows"]}) == 1
+        assert (job["width"], job["height"]) == resolution(job["rows"][0]["aspect_ratio"], 0.25)
+        assert job["output_path"] == [os.path.join("out", f"{row['id']}.png") for row in job["rows"]]
+        assert job["seed"] == [row["seed"] for row in job["rows"]]
+    # the rows of one person are consecutive, so its identity is computed once
+    people = [job["image_paths"][0] for job in jobs]
+    assert people == sorted(people)
+
+
+def test_run_manifest_records_failures_and_resumes(tiny_runtime, tmp_path):
+    _write_photos(tmp_path, ["me.png"])
+    manifest = tmp_path / "jobs.jsonl"
+    _write_jsonl(manifest, [
+        {"id": "ok", "images": ["me.png"], "prompt": "a man img", "steps": 2},
+        {"id": "no-trigger", "images": ["me.png"], "prompt": "a man", "steps": 2},
+        {"id": "missing", "images": ["nobody.png"], "prompt": "a man img", "steps": 2},
+        {"id": "ok-too", "images": ["me.png"], "prompt": "a man img on a boat", "steps": 2, "seed": 1},
+    ])
+    output_dir = tmp_path / "out"
+
+    summary = run_manifest(tiny_runtime, str(manifest), str(output_dir), batch_size=2, scale=0.0625, save_workers=1)
+
+    assert (summary["rows"], summary["skipped"], summary["finished"], summary["failed"]) == (4, 0, 2, 2)
+    records = {record["id"]: record for record in map(json.loads, open(output_dir / "progress.jsonl"))}
+    assert "trigger word" in records["no-trigger"]["error"]
+    assert records["missing"]["error"]
+    assert records["ok"]["batch_size"] == records["ok-too"]["batch_size"] == 2
+    assert (records["ok"]["width"], records["ok"]["height"]) == (64, 64)
+    assert os.path.exists(output_dir / "ok.png") and os.path.exists(output_dir / "ok-too.png")
+
+    # a run killed while writing a record: the torn line is ignored and its row runs again
+    with open(output_dir / "progress.jsonl", "a") as f:
+        f.write('{"id": "ok-to')
+    os.remove(output_dir / "ok-too.png")
+    with open(output_dir / "progress.jsonl") as f:
+        lines = f.readlines()
+    with open(output_dir / "progress.jsonl", "w") as f:
+        f.writelines(line for line in lines if not line.startswith('{"id": "ok-too"'))
+
+    summary = run_manifest(tiny_runtime, str(manifest), str(output_dir), batch_size=2, scale=0.0625, save_workers=1)
+
+    # only the failed rows and the lost one run again
+    assert (summary["skipped"], summary["finished"], summary["failed"]) == (1, 1, 2)
+    assert os.path.exists(output_dir / "ok-too.png")
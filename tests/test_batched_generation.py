@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from identity_cache import detect_id_embeds
+from tiny_models import StubFaceAnalysis
+
+PROMPTS = ["a photo of a man img", "a man img in the snow", "a portrait of a man img, oil painting"]
+SEEDS = [0, 1, 2]
+
+
+def _identity(pipe, seed):
+    rng = np.random.default_rng(seed)
+    images = [Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)) for _ in range(2)]
+    return pipe.create_identity(images, detect_id_embeds(StubFaceAnalysis(), images))
+
+
+def _generate(pipe, prompts, seeds, identity):
+    return pipe(
+        prompt=prompts,
+        negative_prompt=["blurry"] * len(prompts),
+        width=64,
+        height=64,
+        num_inference_steps=3,
+        start_merge_step=1,
+        generator=[torch.Generator().manual_seed(seed) for seed in seeds],
+        identity=identity,
+        output_type="latent",
+    ).images
+
+
+@pytest.mark.parametrize("per_prompt_identities", [False, True])
+def test_a_batch_matches_one_call_per_prompt(tiny_pipe, per_prompt_identities):
+    if per_prompt_identities:
+        identities = [_identity(tiny_pipe, seed) for seed in SEEDS]
+    else:
+        identities = [_identity(tiny_pipe, 0)] * len(PROMPTS)
+
+    with torch.no_grad():
+        batched = _generate(tiny_pipe, PROMPTS, SEEDS, identities if per_prompt_identities else identities[0])
+        sequential = torch.cat([
+            _generate(tiny_pipe, [prompt], [seed], identity)
+            for prompt, seed, identity in zip(PROMPTS, SEEDS, identities)
+        ])
+
+    assert batched.shape == sequential.shape == (len(PROMPTS), 4, 8, 8)
+    torch.testing.assert_close(batched, sequential, rtol=1e-4, atol=1e-4)
+
+
+def test_identities_must_match_the_prompts(tiny_pipe):
+    identities = [_identity(tiny_pipe, 0)] * 2
+    with pytest.raises(ValueError, match="2 identities for 3 prompts"):
+        _generate(tiny_pipe, PROMPTS, SEEDS, identities)
@@ -0,0 +1,68 @@
+import os
+
+import pytest
+import torch
+
+from checkpoint_loader import build_empty, convert_checkpoint, load_module_weights, load_tensors, split_checkpoint_paths
+from tiny_models import build_tiny_id_encoder
+
+
+@pytest.fixture(scope="module")
+def checkpoint(tmp_path_factory):
+    torch.manual_seed(0)
+    state_dict = {
+        "id_encoder": build_tiny_id_encoder().state_dict(),
+        "lora_weights": {"unet.down.lora_A.weight": torch.randn(4, 32), "unet.down.lora_B.weight": torch.randn(32, 4)},
+    }
+    # tensors sharing storage must survive the safetensors conversion
+    state_dict["lora_weights"]["unet.up.lora_A.weight"] = state_dict["lora_weights"]["unet.down.lora_A.weight"]
+    model_file = str(tmp_path_factory.mktemp("checkpoint") / "photomaker-tiny.bin")
+    torch.save(state_dict, model_file)
+    return model_file
+
+
+@pytest.fixture(scope="module")
+def split_files(checkpoint, tmp_path_factory):
+    paths = split_checkpoint_paths(checkpoint, str(tmp_path_factory.mktemp("split")))
+    return convert_checkpoint(checkpoint, paths)
+
+
+def test_split_load_matches_torch_load(checkpoint, split_files):
+    expected = torch.load(checkpoint, map_location="cpu", weights_only=True)
+
+    id_encoder = build_empty(build_tiny_id_encoder)
+    id_encoder = load_module_weights(id_encoder, split_files["id_encoder"], "cpu", torch.float32)
+    state_dict = id_encoder.state_dict()
+
+    assert state_dict.keys() == expected["id_encoder"].keys()
+    for key, tensor in expected["id_encoder"].items():
+        torch.testing.assert_close(state_dict[key], tensor, rtol=0, atol=0, msg=key)
+    lora_weights = load_tensors(split_files["lora_weights"])
+    assert lora_weights.keys() == expected["lora_weights"].keys()
+    for key, tensor in expected["lora_weights"].items():
+        torch.testing.assert_close(lora_weights[key], tensor, rtol=0, atol=0, msg=key)
+
+
+def test_split_load_casts_floating_tensors(split_files):
+    id_encoder = load_module_weights(build_empty(build_tiny_id_encoder), split_files["id_encoder"], "cpu", torch.float16)
+
+    assert {tensor.dtype for tensor in id_encoder.state_dict().values() if tensor.is_floating_point()} == {torch.float16}
+    assert not any(tensor.is_meta for tensor in id_encoder.state_dict().values())
+
+
+def test_split_load_rejects_another_model(split_files):
+    id_encoder = build_empty(lambda: torch.nn.Linear(2, 2))
+
+    with pytest.raises(RuntimeError, match="missing keys"):
+        load_module_weights(id_encoder, split_files["id_encoder"], "cpu", torch.float32)
+
+
+def test_split_paths_follow_the_checkpoint_file(tmp_path):
+    model_file = str(tmp_path / "photomaker.bin")
+    torch.save({"id_encoder": {}, "lora_weights": {}}, model_file)
+    paths = split_checkpoint_paths(model_file, str(tmp_path))
+
+    assert split_checkpoint_paths(model_file, str(tmp_path)) == paths
+    stat = os.stat(model_file)
+    os.utime(model_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    assert split_checkpoint_paths(model_file, str(tmp_path)) != paths
@@ -0,0 +1,96 @@
+import pytest
+import torch
+from peft import LoraConfig
+from peft.utils import get_peft_model_state_dict
+
+from checkpoint_loader import build_empty, load_module_weights
+from fused_snapshot import FusedSnapshot, snapshot_key
+from pipeline_t2i_adapter import PhotoMakerStableDiffusionXLAdapterPipeline
+from runtime import PhotoMakerRuntime
+from tiny_models import build_tiny_id_encoder, build_tiny_pipeline, build_tiny_unet
+
+
+def _tiny_lora():
+    # non-zero LoRA weights for the attention projections of the tiny UNet, in the format of `load_lora_weights`
+    torch.manual_seed(1)
+    unet = build_tiny_unet()
+    unet.add_adapter(LoraConfig(r=4, lora_alpha=4, target_modules=["to_q", "to_k", "to_v", "to_out.0"], init_lora_weights=False))
+    return {f"unet.{key}": value for key, value in get_peft_model_state_dict(unet).items()}
+
+
+def _fused_weights(unet):
+    # the base layers of the PEFT wrappers hold the fused weights, under their names before the LoRA was loaded
+    return {
+        key.replace(".base_layer", ""): value.detach().clone()
+        for key, value in unet.state_dict().items()
+        if "lora_" not in key
+    }
+
+
+@pytest.fixture(scope="module")
+def fused_pipe(tmp_path_factory):
+    pipe = build_tiny_pipeline()
+    base_weights = {key: value.clone() for key, value in pipe.unet.state_dict().items()}
+    pipe.load_lora_weights(_tiny_lora(), adapter_name="photomaker")
+    pipe.fuse_lora()
+    fused_weights = _fused_weights(pipe.unet)
+    # like `PhotoMakerRuntime._load_pipe`: the fused weights must stay in the unet once the PEFT layers are gone
+    pipe.unload_lora_weights()
+    snapshot = FusedSnapshot(str(tmp_path_factory.mktemp("snapshots")), "tiny")
+    snapshot.save(pipe, "tiny-base", "tiny-photomaker.bin")
+    return snapshot, pipe, base_weights, fused_weights
+
+
+def test_snapshot_unet_matches_fuse_lora(fused_pipe):
+    snapshot, _, base_weights, fused_weights = fused_pipe
+
+    unet_weights = snapshot.load_unet(torch.float32).state_dict()
+
+    assert snapshot.exists()
+    assert unet_weights.keys() == fused_weights.keys() == base_weights.keys()
+    for key, tensor in fused_weights.items():
+        torch.testing.assert_close(unet_weights[key], tensor, rtol=0, atol=0, msg=key)
+    assert any(not torch.equal(fused_weights[key], base_weights[key]) for key in base_weights)
+
+
+def test_snapshot_id_encoder_matches_the_pipeline(fused_pipe):
+    snapshot, pipe, _, _ = fused_pipe
+
+    # `load_photomaker_snapshot` builds the full-size encoder, the tiny one is loaded the same way
+    id_encoder = load_module_weights(build_empty(build_tiny_id_encoder), snapshot.id_encoder_file, "cpu", torch.float32)
+
+    for key, tensor in pipe.id_encoder.state_dict().items():
+        torch.testing.assert_close(id_encoder.state_dict()[key], tensor, rtol=0, atol=0, msg=key)
+
+
+def test_snapshot_key_follows_its_inputs(tmp_path):
+    base = tmp_path / "base"
+    base.mkdir()
+    (base / "model_index.json").write_text("{}")
+    ckpt = tmp_path / "photomaker.bin"
+    ckpt.write_bytes(b"v2")
+    key = snapshot_key(str(base), str(ckpt), torch.float16)
+
+    assert snapshot_key(str(base), str(ckpt), torch.float16) == key
+    assert snapshot_key(str(base), str(ckpt), torch.bfloat16) != key
+    (base / "unet.safetensors").write_bytes(b"weights")
+    assert snapshot_key(str(base), str(ckpt), torch.float16) != key
+
+
+@pytest.mark.parametrize("cached", [True, False])
+def test_base_model_dir_asks_the_hub_only_on_a_cache_miss(monkeypatch, tmp_path, cached):
+    calls = []
+
+    def download(pretrained_model_name, **kwargs):
+        calls.append(kwargs.get("local_files_only", False))
+        if kwargs.get("local_files_only") and not cached:
+            raise FileNotFoundError(pretrained_model_name)
+        return str(tmp_path)
+
+    monkeypatch.setattr(PhotoMakerStableDiffusionXLAdapterPipeline, "download", download)
+    runtime = PhotoMakerRuntime(base_model_path="some/sdxl-model")
+
+    assert runtime.base_model_dir() == str(tmp_path)
+    assert calls == ([True] if cached else [True, False])
+    assert PhotoMakerRuntime(base_model_path=str(tmp_path)).base_model_dir() == str(tmp_path)
+    assert len(calls) == (1 if cached else 2)
@@ -0,0 +1,33 @@
+import pytest
+import torch
+
+from tiny_models import CROSS_ATTENTION_DIM, build_tiny_id_encoder
+
+
+@pytest.mark.parametrize("num_id_images", [1, 3])
+def test_encode_identity_and_fuse_match_the_forward(num_id_images):
+    torch.manual_seed(0)
+    id_encoder = build_tiny_id_encoder().eval()
+    generator = torch.Generator().manual_seed(1)
+    id_pixel_values = torch.randn(1, num_id_images, 3, 224, 224, generator=generator)
+    id_embeds = torch.randn(1, num_id_images, 512, generator=generator)
+    prompt_embeds = torch.randn(4, 1, 77, CROSS_ATTENTION_DIM, generator=generator)
+    class_tokens_mask = torch.zeros(1, 77, dtype=torch.bool)
+    class_tokens_mask[:, 5:5 + num_id_images * id_encoder.num_tokens] = True
+
+    with torch.no_grad():
+        # the forward writes into the prompt embeddings, every call gets its own copy
+        monolithic = [id_encoder(id_pixel_values, embeds.clone(), class_tokens_mask, id_embeds) for embeds in prompt_embeds]
+        id_tokens = id_encoder.encode_identity(id_pixel_values, id_embeds)
+        split = [id_encoder.fuse(embeds.clone(), class_tokens_mask, id_tokens) for embeds in prompt_embeds]
+        precomputed = [
+            id_encoder(None, embeds.clone(), class_tokens_mask, None, id_tokens=id_tokens) for embeds in prompt_embeds
+        ]
+
+    assert id_tokens.shape == (1, num_id_images, id_encoder.num_tokens, CROSS_ATTENTION_DIM)
+    for embeds, a, b, c in zip(prompt_embeds, monolithic, split, precomputed):
+        torch.testing.assert_close(b, a, rtol=1e-5, atol=1e-5)
+        torch.testing.assert_close(c, a, rtol=1e-5, atol=1e-5)
+        # only the class tokens are fused with the identity
+        torch.testing.assert_close(a[~class_tokens_mask], embeds[~class_tokens_mask])
+        assert not torch.allclose(a[class_tokens_mask], embeds[class_tokens_mask])
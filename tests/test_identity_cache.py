@@ -0,0 +1,92 @@
+import os
+
+import numpy as np
+import torch
+from PIL import Image
+
+from identity_cache import IdentityCache, hash_identity_images, load_identity, model_fingerprint
+from identity_handle import IdentityHandle
+from tiny_models import StubFaceAnalysis, TinyPhotoMakerRuntime
+
+
+def _handle(value, num_id_images=1):
+    return IdentityHandle(
+        id_embeds=torch.full((num_id_images, 512), float(value)),
+        id_tokens=torch.full((1, num_id_images, 2, 64), float(value)),
+    )
+
+
+def test_hit_and_miss():
+    cache = IdentityCache()
+    assert cache.get("a") is None
+    entry = cache.put("a", _handle(1))
+    assert entry.key == "a"
+    assert cache.get("a") is entry
+    assert "a" in cache and "b" not in cache
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (1, 1, 1, entry.nbytes)
+
+
+def test_evicts_the_least_recently_used_entry_by_count():
+    cache = IdentityCache(max_entries=2)
+    cache.put("a", _handle(1))
+    cache.put("b", _handle(2))
+    cache.get("a")
+    cache.put("c", _handle(3))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_evicts_the_least_recently_used_entries_by_bytes():
+    nbytes = _handle(0).nbytes
+    cache = IdentityCache(max_bytes=int(2.5 * nbytes))
+    for key in "abc":
+        cache.put(key, _handle(ord(key)))
+    assert len(cache) == 2 and cache.get("a") is None
+    assert cache.current_bytes == 2 * nbytes
+
+    # an entry larger than the budget is still kept on its own
+    big = cache.put("big", _handle(0, num_id_images=4))
+    assert len(cache) == 1 and cache.get("big") is big
+    assert cache.current_bytes == big.nbytes
+
+
+def test_disk_round_trip(tmp_path):
+    cache = IdentityCache(cache_dir=str(tmp_path), max_entries=1, fingerprint="model-a")
+    cache.put("a", _handle(1, num_id_images=2))
+    cache.put("b", _handle(2))
+    assert os.path.exists(tmp_path / "model-a" / "a.safetensors")
+
+    # evicted from memory, read back from disk
+    entry = cache.get("a")
+    assert entry.key == "a" and entry.num_id_images == 2
+    torch.testing.assert_close(entry.id_tokens, _handle(1, num_id_images=2).id_tokens)
+
+    # a new process with the same model sees both, one with another model sees none
+    restarted = IdentityCache(cache_dir=str(tmp_path), fingerprint="model-a")
+    torch.testing.assert_close(restarted.get("b").id_embeds, _handle(2).id_embeds)
+    other_model = IdentityCache(cache_dir=str(tmp_path), fingerprint="model-b")
+    assert other_model.get("a") is None and "b" not in other_model
+
+
+def test_runtime_keeps_identities_per_model(tmp_path):
+    float32 = TinyPhotoMakerRuntime(identity_cache_dir=str(tmp_path))
+    float16 = TinyPhotoMakerRuntime(identity_cache_dir=str(tmp_path), torch_dtype=torch.float16)
+    other_seed = TinyPhotoMakerRuntime(identity_cache_dir=str(tmp_path), seed=1)
+    dirs = {runtime.identity_cache.cache_dir for runtime in (float32, float16, other_seed)}
+    assert len(dirs) == 3
+    assert float32.identity_cache.fingerprint == model_fingerprint("tiny", 0, torch.float32, "stub")
+    assert TinyPhotoMakerRuntime().identity_cache.cache_dir is None
+
+
+def test_load_identity_computes_once(tiny_pipe):
+    rng = np.random.default_rng(0)
+    images = [Image.fromarray(rng.integers(0, 256, (64, 64, 3), dtype=np.uint8)) for _ in range(2)]
+    cache = IdentityCache()
+    first = load_identity(tiny_pipe, StubFaceAnalysis(), images, cache)
+    second = load_identity(tiny_pipe, StubFaceAnalysis(), list(images), cache)
+    assert second is first and first.key == hash_identity_images(images)
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+    # the order of the photos is part of the key
+    assert hash_identity_images(images[::-1]) != first.key
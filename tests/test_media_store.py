@@ -0,0 +1,52 @@
+import os
+import threading
+import time
+
+from PIL import Image
+
+from media_store import MediaStore
+
+
+def _wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_close_keeps_the_request_until_its_outputs_are_written(tmp_path, monkeypatch):
+    store = MediaStore(root=str(tmp_path), retention_seconds=0)
+    unblock = threading.Event()
+    write = MediaStore._write
+
+    def slow_write(image, path):
+        unblock.wait(5)
+        return write(image, path)
+
+    monkeypatch.setattr(store, "_write", slow_write)
+    media = store.open_request()
+    paths = media.save_outputs([Image.new("RGB", (8, 8)), Image.new("RGB", (8, 8))])
+    media.close()
+
+    # every request has expired, but the one with writes in flight is still open
+    assert store.gc() == 0
+    assert os.path.isdir(media.dir)
+
+    unblock.set()
+    assert media.wait(timeout=5) == paths
+    assert all(os.path.exists(path) for path in paths)
+    assert _wait_until(lambda: media.request_id not in store._open)
+    assert store.gc() == 1
+    assert not os.path.exists(media.dir)
+
+
+def test_close_without_outputs_releases_at_once(tmp_path):
+    store = MediaStore(root=str(tmp_path), retention_seconds=0)
+    media = store.open_request()
+    media.add_uploads([Image.new("RGB", (8, 8))])
+    media.upload_paths()
+    media.close()
+
+    assert media.uploads == []
+    assert media.request_id not in store._open
+    assert store.gc() == 1
@@ -0,0 +1,50 @@
+import pytest
+import torch
+
+from module.resampler import FacePerceiverResampler, PerceiverAttention
+
+
+def _pair(module_class, **kwargs):
+    torch.manual_seed(0)
+    math_module = module_class(attention_backend="math", **kwargs).eval()
+    sdpa_module = module_class(attention_backend="sdpa", **kwargs).eval()
+    sdpa_module.load_state_dict(math_module.state_dict())
+    return math_module, sdpa_module
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+@pytest.mark.parametrize("dim,dim_head,heads", [(64, 16, 4), (2048, 128, 16)])
+def test_sdpa_matches_math_path(batch_size, dim, dim_head, heads):
+    # the second size is one layer of the v2 QFormer perceiver: 2 ID tokens and 257 CLIP tokens
+    math_attn, sdpa_attn = _pair(PerceiverAttention, dim=dim, dim_head=dim_head, heads=heads)
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(batch_size, 257, dim, generator=generator)
+    latents = torch.randn(batch_size, 2, dim, generator=generator)
+    with torch.no_grad():
+        torch.testing.assert_close(sdpa_attn(x, latents), math_attn(x, latents), rtol=1e-4, atol=1e-4)
+
+
+def test_sdpa_matches_math_path_in_bfloat16():
+    math_attn, sdpa_attn = _pair(PerceiverAttention, dim=256, dim_head=64, heads=4)
+    math_attn, sdpa_attn = math_attn.to(torch.bfloat16), sdpa_attn.to(torch.bfloat16)
+    generator = torch.Generator().manual_seed(1)
+    x = torch.randn(2, 257, 256, generator=generator).to(torch.bfloat16)
+    latents = torch.randn(2, 2, 256, generator=generator).to(torch.bfloat16)
+    with torch.no_grad():
+        torch.testing.assert_close(sdpa_attn(x, latents), math_attn(x, latents), rtol=2e-2, atol=2e-2)
+
+
+def test_resampler_backends_match():
+    math_resampler, sdpa_resampler = _pair(
+        FacePerceiverResampler, dim=64, depth=2, dim_head=16, heads=4, embedding_dim=96, output_dim=64
+    )
+    generator = torch.Generator().manual_seed(1)
+    latents = torch.randn(2, 4, 64, generator=generator)
+    x = torch.randn(2, 257, 96, generator=generator)
+    with torch.no_grad():
+        torch.testing.assert_close(sdpa_resampler(latents, x), math_resampler(latents, x), rtol=1e-4, atol=1e-4)
+
+
+def test_unknown_backend_is_rejected():
+    with pytest.raises(ValueError):
+        PerceiverAttention(dim=64, attention_backend="flash")
@@ -0,0 +1,74 @@
+import pytest
+import torch
+
+PROMPT = "a photo of a man img, wearing a red scarf"
+
+
+def encode_separately(pipe, prompt, negative_prompt, num_images_per_prompt, num_id_images):
+    """The prompt encoding `__call__` did before `encode_prompt_single_pass`"""
+    prompt_embeds, _, pooled_prompt_embeds, _, class_tokens_mask = pipe.encode_prompt_with_trigger_word(
+        prompt=prompt,
+        device=pipe.device,
+        num_id_images=num_id_images,
+        num_images_per_prompt=num_images_per_prompt,
+        do_classifier_free_guidance=True,
+        negative_prompt=negative_prompt,
+    )
+    prompt_text_only = pipe._remove_trigger_word([prompt])[0]
+    (
+        prompt_embeds_text_only,
+        negative_prompt_embeds,
+        pooled_prompt_embeds_text_only,
+        negative_pooled_prompt_embeds,
+    ) = pipe.encode_prompt(
+        prompt=prompt_text_only,
+        device=pipe.device,
+        num_images_per_prompt=num_images_per_prompt,
+        do_classifier_free_guidance=True,
+        negative_prompt=negative_prompt,
+    )
+    return (
+        prompt_embeds,
+        pooled_prompt_embeds,
+        class_tokens_mask,
+        prompt_embeds_text_only,
+        pooled_prompt_embeds_text_only,
+        negative_prompt_embeds,
+        negative_pooled_prompt_embeds,
+    )
+
+
+@pytest.mark.parametrize("negative_prompt", [None, "blurry, lowres"])
+@pytest.mark.parametrize("num_images_per_prompt", [1, 2])
+@pytest.mark.parametrize("num_id_images", [1, 3])
+def test_single_pass_matches_separate_calls(tiny_pipe, monkeypatch, negative_prompt, num_images_per_prompt, num_id_images):
+    # compare the encoders themselves, not what the other path left in the cache
+    monkeypatch.setattr(tiny_pipe, "text_embedding_cache", None)
+
+    with torch.no_grad():
+        expected = encode_separately(tiny_pipe, PROMPT, negative_prompt, num_images_per_prompt, num_id_images)
+        actual = tiny_pipe.encode_prompt_single_pass(
+            prompt=PROMPT,
+            device=tiny_pipe.device,
+            num_images_per_prompt=num_images_per_prompt,
+            do_classifier_free_guidance=True,
+            negative_prompt=negative_prompt,
+            num_id_images=num_id_images,
+        )
+
+    names = [
+        "prompt_embeds",
+        "pooled_prompt_embeds",
+        "class_tokens_mask",
+        "prompt_embeds_text_only",
+        "pooled_prompt_embeds_text_only",
+        "negative_prompt_embeds",
+        "negative_pooled_prompt_embeds",
+    ]
+    for name, a, e in zip(names, actual, expected):
+        assert a.shape == e.shape, name
+        if name == "class_tokens_mask":
+            assert torch.equal(a, e), name
+        else:
+            torch.testing.assert_close(a, e, rtol=1e-5, atol=1e-5, msg=name)
+    assert actual[2].any()
@@ -0,0 +1,11 @@
+import pytest
+
+from prompt_utils import check_trigger_word
+
+
+def test_check_trigger_word(tiny_pipe):
+    check_trigger_word(tiny_pipe, "a photo of a man img")
+    with pytest.raises(ValueError, match="Cannot find the trigger word"):
+        check_trigger_word(tiny_pipe, "a photo of a man")
+    with pytest.raises(ValueError, match="multiple trigger words"):
+        check_trigger_word(tiny_pipe, "a man img and a woman img")
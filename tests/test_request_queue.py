@@ -0,0 +1,135 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from request_queue import GenerationJob, MicroBatchScheduler
+
+
+def _job(prompt="a man img", width=64, height=64, num_steps=4, seed=0, num_outputs=1):
+    return GenerationJob(
+        prompt=prompt,
+        negative_prompt="",
+        identity=SimpleNamespace(num_id_images=1),
+        width=width,
+        height=height,
+        num_steps=num_steps,
+        start_merge_step=1,
+        guidance_scale=5.0,
+        seed=seed,
+        num_outputs=num_outputs,
+    )
+
+
+class StubPipeline:
+    """Records every batch and returns one image name per seed of every job"""
+
+    def __init__(self, block=None):
+        self.batches = []
+        self.started = threading.Event()
+        self.block = block
+
+    def __call__(self, jobs):
+        self.batches.append([job.prompt for job in jobs])
+        self.started.set()
+        if self.block is not None:
+            self.block.wait(5)
+        return [[f"{job.prompt}/{job.seed + i}" for i in range(job.num_outputs)] for job in jobs]
+
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+
+    def make(run_batch, **kwargs):
+        scheduler = MicroBatchScheduler(run_batch, **kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.stop()
+
+
+def test_jobs_are_grouped_by_batch_key(make_scheduler):
+    stub = StubPipeline()
+    scheduler = make_scheduler(stub, max_batch_size=4, batch_window=0.2)
+    futures = [
+        scheduler.submit_threadsafe(_job("a")),
+        scheduler.submit_threadsafe(_job("other steps", num_steps=8)),
+        scheduler.submit_threadsafe(_job("b")),
+        scheduler.submit_threadsafe(_job("c")),
+    ]
+    results = [future.result(timeout=5) for future in futures]
+
+    assert stub.batches == [["a", "b", "c"], ["other steps"]]
+    assert results == [["a/0"], ["other steps/0"], ["b/0"], ["c/0"]]
+    assert scheduler.queue_depth == 0 and scheduler.stats()["batch_size"]["count"] == 2
+
+
+def test_batches_are_capped_by_size(make_scheduler):
+    stub = StubPipeline()
+    scheduler = make_scheduler(stub, max_batch_size=2, batch_window=0.2)
+    futures = [scheduler.submit_threadsafe(_job(str(i))) for i in range(5)]
+    for future in futures:
+        future.result(timeout=5)
+    assert stub.batches == [["0", "1"], ["2", "3"], ["4"]]
+
+
+def test_the_batch_window_bounds_the_wait(make_scheduler):
+    stub = StubPipeline()
+    scheduler = make_scheduler(stub, max_batch_size=4, batch_window=0.05)
+    first = scheduler.submit_threadsafe(_job("early"))
+    first.result(timeout=5)
+    time.sleep(0.1)
+    scheduler.submit_threadsafe(_job("late")).result(timeout=5)
+    # the early job did not wait for the late one
+    assert stub.batches == [["early"], ["late"]]
+    assert scheduler.wait_time.snapshot()["count"] == 2
+
+
+def test_jobs_over_the_pixel_budget_are_split(make_scheduler):
+    stub = StubPipeline()
+    scheduler = make_scheduler(stub, max_batch_size=4, batch_window=0.2, max_batch_pixels=2 * 64 * 64)
+    assert scheduler.max_outputs(64, 64) == 2
+    assert scheduler.max_outputs(256, 256) == 1
+
+    job = _job("many", seed=10, num_outputs=5)
+    assert [(sub_job.seed, sub_job.num_outputs) for sub_job in scheduler.split(job)] == [(10, 2), (12, 2), (14, 1)]
+    # every image keeps its seed whatever the split, and they come back in order
+    assert scheduler.generate(job, timeout=5) == [f"many/{seed}" for seed in range(10, 15)]
+    # two sub-jobs of 2 images are already the whole budget, so they never share a batch
+    assert all(len(batch) == 1 for batch in stub.batches)
+
+
+def test_a_failing_batch_fails_all_its_jobs(make_scheduler):
+    def run_batch(jobs):
+        raise RuntimeError("out of memory")
+
+    scheduler = make_scheduler(run_batch, batch_window=0.2)
+    futures = [scheduler.submit_threadsafe(_job(str(i))) for i in range(2)]
+    for future in futures:
+        with pytest.raises(RuntimeError, match="out of memory"):
+            future.result(timeout=5)
+    assert scheduler.queue_depth == 0
+
+
+def test_stop_while_a_batch_is_running(make_scheduler):
+    block = threading.Event()
+    stub = StubPipeline(block=block)
+    scheduler = make_scheduler(stub, max_batch_size=1, batch_window=0.01)
+    running = scheduler.submit_threadsafe(_job("running"))
+    assert stub.started.wait(5)
+    queued = scheduler.submit_threadsafe(_job("queued"))
+
+    scheduler.stop()
+    # neither the running nor the queued job leaves its caller waiting
+    for future in (running, queued):
+        with pytest.raises(RuntimeError, match="stopped"):
+            future.result(timeout=5)
+    assert scheduler.queue_depth == 0
+
+    # the dropped batch finishes in the background, the next submit starts a new loop
+    block.set()
+    assert scheduler.submit_threadsafe(_job("after")).result(timeout=5) == ["after/0"]
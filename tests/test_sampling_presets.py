@@ -0,0 +1,62 @@
+import pytest
+from diffusers import DPMSolverMultistepScheduler, EulerDiscreteScheduler
+
+from sampling_presets import SAMPLING_PRESETS, adapter_factor, get_sampling_preset, merge_step
+
+
+@pytest.mark.parametrize(
+    "style_strength_ratio, num_steps, expected",
+    [
+        (20, 20, 4), (20, 30, 6), (20, 50, 10),
+        # the original code: int(ratio / 100 * steps), at most 30
+        (100, 20, 20), (100, 30, 30), (100, 50, 30), (100, 80, 30), (50, 100, 30),
+    ],
+)
+def test_merge_step_without_a_preset_keeps_the_cap_of_30_steps(style_strength_ratio, num_steps, expected):
+    assert merge_step(style_strength_ratio, num_steps) == expected
+
+
+@pytest.mark.parametrize(
+    "style_strength_ratio, num_steps, expected",
+    [
+        (20, 20, 4), (20, 30, 6), (20, 50, 10),
+        # the cap is 30 of 50 steps, as a fraction of the preset's steps
+        (100, 20, 12), (100, 30, 18), (100, 50, 30), (100, 80, 48), (50, 100, 50),
+        (20, 8, 1),
+    ],
+)
+def test_merge_step_with_a_preset_scales_the_cap(style_strength_ratio, num_steps, expected):
+    assert merge_step(style_strength_ratio, num_steps, "euler") == expected
+
+
+@pytest.mark.parametrize("num_steps, expected_steps", [(20, 16), (30, 24), (50, 40)])
+def test_adapter_factor_keeps_the_default_adapter_steps(num_steps, expected_steps):
+    factor = adapter_factor(0.8, num_steps)
+
+    # the pipeline runs the adapter for int(num_steps * factor) steps, like it did with 0.8
+    assert int(num_steps * factor) == int(num_steps * 0.8) == expected_steps
+
+
+@pytest.mark.parametrize(
+    "adapter_conditioning_factor, num_steps, expected_steps",
+    [(0.2, 4, 1), (0.05, 8, 1), (0.7, 20, 14), (0.85, 30, 26), (1.0, 30, 30), (0.0, 30, 0)],
+)
+def test_adapter_factor_rounds_to_the_nearest_step(adapter_conditioning_factor, num_steps, expected_steps):
+    assert int(num_steps * adapter_factor(adapter_conditioning_factor, num_steps)) == expected_steps
+
+
+def test_get_sampling_preset():
+    preset = get_sampling_preset("dpm++ 2m karras")
+    config = EulerDiscreteScheduler().config
+
+    scheduler = preset.make_scheduler(config)
+
+    assert preset is SAMPLING_PRESETS["dpm++ 2m karras"]
+    assert isinstance(scheduler, DPMSolverMultistepScheduler)
+    assert scheduler.config.use_karras_sigmas
+    assert preset.make_scheduler(config) is not scheduler
+
+
+def test_get_sampling_preset_rejects_an_unknown_name():
+    with pytest.raises(ValueError, match="Unknown sampling preset 'dpm\\+\\+ 3m'"):
+        get_sampling_preset("dpm++ 3m")
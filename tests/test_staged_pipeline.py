@@ -0,0 +1,79 @@
+import threading
+import time
+
+from staged_pipeline import Stage, StagedPipeline
+
+
+def _recorder(name, calls, sleep=0.0, fail=()):
+    def fn(job):
+        if sleep:
+            time.sleep(sleep)
+        with calls["lock"]:
+            calls.setdefault(name, []).append(job["index"])
+        if job["index"] in fail:
+            raise RuntimeError(f"job {job['index']} failed")
+        job[name] = True
+        return job
+    return fn
+
+
+def _staged_threads():
+    return [thread for thread in threading.enumerate() if thread.name.startswith("staged-")]
+
+
+def test_single_worker_stages_keep_the_job_order():
+    calls = {"lock": threading.Lock()}
+    pipeline = StagedPipeline([Stage(name, _recorder(name, calls), queue_size=1) for name in ("load", "denoise", "save")])
+
+    finished = list(pipeline.run({"index": index} for index in range(20)))
+
+    assert [job["index"] for job in finished] == list(range(20))
+    for name in ("load", "denoise", "save"):
+        assert calls[name] == list(range(20))
+        assert pipeline.processed[name] == 20
+    assert all(set(job["timings"]) == {"load", "denoise", "save"} for job in finished)
+
+
+def test_a_failed_job_skips_the_remaining_stages():
+    calls = {"lock": threading.Lock()}
+    pipeline = StagedPipeline([
+        Stage("load", _recorder("load", calls), workers=2),
+        Stage("denoise", _recorder("denoise", calls, fail={3, 7})),
+        Stage("save", _recorder("save", calls), workers=2),
+    ])
+
+    finished = {job["index"]: job for job in pipeline.run({"index": index} for index in range(10))}
+
+    assert sorted(finished) == list(range(10))
+    for index in (3, 7):
+        job = finished[index]
+        assert job["error"] == f"denoise: RuntimeError('job {index} failed')"
+        assert "save" not in job and set(job["timings"]) == {"load", "denoise"}
+    assert sorted(calls["save"]) == [index for index in range(10) if index not in (3, 7)]
+    assert not any("error" in job for index, job in finished.items() if index not in (3, 7))
+
+
+def test_several_workers_per_stage_shut_down_after_the_last_job():
+    calls = {"lock": threading.Lock()}
+    pipeline = StagedPipeline([
+        Stage("load", _recorder("load", calls, sleep=0.002), workers=3, queue_size=2),
+        Stage("denoise", _recorder("denoise", calls, sleep=0.001), workers=2, queue_size=1),
+        Stage("save", _recorder("save", calls, sleep=0.002), workers=4, queue_size=2),
+    ])
+
+    for _ in range(2):
+        finished = list(pipeline.run({"index": index} for index in range(25)))
+        # every job comes out exactly once, and every stage ran it once
+        assert sorted(job["index"] for job in finished) == list(range(25))
+        assert not _staged_threads()
+    for name in ("load", "denoise", "save"):
+        assert sorted(calls[name]) == sorted(list(range(25)) * 2)
+    stats = pipeline.stats()
+    assert stats["wall_time"] > 0
+    assert all(stage["jobs"] == 50 for stage in stats["stages"].values())
+
+
+def test_no_jobs():
+    pipeline = StagedPipeline([Stage("load", lambda job: job, workers=2), Stage("save", lambda job: job, workers=2)])
+    assert list(pipeline.run([])) == []
+    assert not _staged_threads()
@@ -0,0 +1,37 @@
+import torch
+from transformers import CLIPTextModel
+
+from tiny_models import build_tiny_pipeline
+
+
+def test_cache_serves_repeated_prompts():
+    pipe = build_tiny_pipeline()
+    pipe.warmup_text_embeddings(["blurry, ugly"])
+    hits = pipe.text_embedding_cache.hits
+    pipe.warmup_text_embeddings(["blurry, ugly"])
+    # one hit per text encoder
+    assert pipe.text_embedding_cache.hits == hits + 2
+
+
+def test_replacing_an_encoder_clears_the_cache():
+    pipe = build_tiny_pipeline()
+    pipe.warmup_text_embeddings(["blurry, ugly"])
+    assert len(pipe.text_embedding_cache) == 2
+
+    torch.manual_seed(1)
+    pipe.text_encoder = CLIPTextModel(pipe.text_encoder.config)
+    assert len(pipe.text_embedding_cache) == 0
+
+    # the new encoder's embeddings are computed, not served from the old one
+    input_ids = pipe.tokenizer(["blurry, ugly"], padding="max_length", max_length=77, return_tensors="pt").input_ids
+    with torch.no_grad():
+        cached, _ = pipe._encode_text_input_ids(input_ids, pipe.tokenizer, pipe.text_encoder, "cpu")
+        expected = pipe.text_encoder(input_ids, output_hidden_states=True).hidden_states[-2]
+    torch.testing.assert_close(cached, expected)
+
+
+def test_setting_the_same_encoder_keeps_the_cache():
+    pipe = build_tiny_pipeline()
+    pipe.warmup_text_embeddings(["blurry, ugly"])
+    pipe.text_encoder = pipe.text_encoder
+    assert len(pipe.text_embedding_cache) == 2
@@ -0,0 +1,85 @@
+import copy
+
+import pytest
+import torch
+from diffusers import AutoencoderKL
+
+from tiny_models import build_tiny_vae
+from vae_decoder import VaeDecodeStage
+
+
+@pytest.fixture(scope="module")
+def vae():
+    torch.manual_seed(0)
+    return build_tiny_vae().eval()
+
+
+@pytest.fixture(scope="module")
+def latents():
+    return torch.randn(3, 4, 24, 40, generator=torch.Generator().manual_seed(1))
+
+
+def _reference_tiled(vae, latents, tile_sample_size):
+    # diffusers' own tiled decode with the same tile size, on a copy so the shared fixture keeps its defaults
+    vae = copy.deepcopy(vae)
+    vae.enable_tiling()
+    vae.tile_sample_min_size = tile_sample_size
+    vae.tile_latent_min_size = tile_sample_size // 2 ** (len(vae.config.block_out_channels) - 1)
+    return vae.tiled_decode(latents).sample
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("chunk_size", [1, 2, 3])
+def test_chunked_decode_matches_vae_decode(vae, latents, chunk_size):
+    stage = VaeDecodeStage(vae, chunk_size=chunk_size, tiling=False)
+
+    # batch size changes the conv kernels' summation order, so only float noise is allowed
+    torch.testing.assert_close(stage.decode(latents), vae.decode(latents).sample, atol=1e-4, rtol=1e-4)
+
+
+@torch.no_grad()
+def test_tiled_decode_matches_diffusers_tiled_decode(vae, latents):
+    stage = VaeDecodeStage(vae, chunk_size=2, tiling=True, tile_sample_size=128)
+
+    torch.testing.assert_close(stage.decode(latents), _reference_tiled(vae, latents, 128), atol=1e-4, rtol=1e-4)
+
+
+@torch.no_grad()
+def test_tile_size_follows_the_vae_scale_factor(latents):
+    # three blocks scale latents by 4, not 8
+    torch.manual_seed(0)
+    vae = AutoencoderKL(
+        block_out_channels=(32, 32, 32),
+        down_block_types=("DownEncoderBlock2D",) * 3,
+        up_block_types=("UpDecoderBlock2D",) * 3,
+        layers_per_block=1,
+        latent_channels=4,
+        sample_size=64,
+    ).eval()
+    stage = VaeDecodeStage(vae, tiling=True, tile_sample_size=64)
+
+    assert stage.scale_factor == 4
+    torch.testing.assert_close(stage.decode(latents), _reference_tiled(vae, latents, 64), atol=1e-4, rtol=1e-4)
+
+
+@torch.no_grad()
+def test_float16_vae_decodes_with_a_float32_copy(vae, latents):
+    half_vae = copy.deepcopy(vae).half()
+    half_vae.register_to_config(force_upcast=True)
+    stage = VaeDecodeStage(half_vae, tiling=False)
+
+    latents = latents.half()
+    image = stage.decode(latents)
+
+    assert stage.dtype == torch.float32
+    assert half_vae.decoder.conv_in.weight.dtype == torch.float16
+    torch.testing.assert_close(image, copy.deepcopy(half_vae).float().decode(latents.float()).sample, atol=1e-4, rtol=1e-4)
+
+
+def test_auto_tiling_only_for_latents_larger_than_a_tile(vae):
+    stage = VaeDecodeStage(vae, tile_sample_size=256)
+
+    assert not stage.use_tiling(torch.zeros(1, 4, 32, 32))
+    assert stage.use_tiling(torch.zeros(1, 4, 32, 33))
+    # with the VAE's own tile size (1024 px) no aspect-ratio template is ever tiled
+    assert not VaeDecodeStage(vae).use_tiling(torch.zeros(1, 4, 128, 128))
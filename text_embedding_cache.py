@@ -0,0 +1,55 @@
+import threading
+from collections import OrderedDict
+
+
+class TextEmbeddingCache:
+    """LRU of text encoder outputs for single tokenized prompts.
+
+    Keys are built by the pipeline from the text encoder slot, the hidden layer that
+    is read out, the LoRA scale and the exact token ids, values are the
+    `(hidden_states, pooled)` pair of that one prompt. The default negative prompt
+    and the style templates repeat across almost every request, so they are encoded
+    once and served from here afterwards.
+    """
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+        }
@@ -0,0 +1,111 @@
+"""
+A theme pack: one identity rendered in several dream world themes and seasons in one go, for
+comics, calendars and sticker sets.
+
+    entries = pack_entries(theme_registry, ["Comic book", "Seasons Calendar"], "a child img")
+    jobs = pack_jobs(entries, identity, seed=42)
+    for index, images, error in render_pack(runtime.request_scheduler, jobs):
+        ...
+
+The identity is encoded once and shared by every job. All jobs are queued at once, so the
+runtime's scheduler denoises the themes with the same steps, merge step, guidance and
+resolution as one batch, and every theme comes back as soon as its batch is done.
+"""
+
+import concurrent.futures
+
+from request_queue import GenerationJob
+from sampling_presets import merge_step
+from style_template import apply_style
+
+
+class PackEntry:
+    """One image set of a pack: a theme, its season if it has some, and the filled in prompt"""
+
+    def __init__(self, theme, season, prompt):
+        self.theme = theme
+        self.season = season
+        self.prompt = prompt
+
+    @property
+    def label(self):
+        return f"{self.theme.name} - {self.season}" if self.season else self.theme.name
+
+
+def pack_entries(registry, theme_names, custom_prompt, seasons=None):
+    """
+    The entries of a pack, one per theme and one per season of a theme with seasons.
+
+    `seasons` keeps only these seasons of the themes that have them, a theme none of whose
+    seasons is listed gets all of them. Unknown theme names are skipped.
+    """
+    entries = []
+    for name in theme_names:
+        theme = registry.get(name)
+        if theme is None:
+            print(f"[Debug] Skipping unknown theme {name!r}")
+            continue
+        theme_seasons = theme.seasons
+        if seasons and any(season in theme_seasons for season in seasons):
+            theme_seasons = [season for season in theme_seasons if season in seasons]
+        for season in theme_seasons or [None]:
+            entries.append(PackEntry(theme, season, theme.render(custom_prompt, season)))
+    return entries
+
+
+def pack_jobs(entries, identity, seed, num_outputs=1, width=1024, height=1024):
+    """
+    One `GenerationJob` per entry, all with the same `identity`.
+
+    Entry `i` gets the seeds `seed + i * num_outputs` to `seed + (i + 1) * num_outputs - 1`,
+    so a pack is reproducible from its first seed and no two images share one.
+    """
+    jobs = []
+    for i, entry in enumerate(entries):
+        theme = entry.theme
+        prompt, negative_prompt = apply_style(theme["style_name"], entry.prompt, theme["negative_prompt"])
+        jobs.append(GenerationJob(
+            prompt=prompt,
+            negative_prompt=negative_prompt,
+            identity=identity,
+            width=width,
+            height=height,
+            num_steps=int(theme["num_steps"]),
+            start_merge_step=merge_step(theme["style_strength_ratio"], int(theme["num_steps"])),
+            guidance_scale=float(theme["guidance_scale"]),
+            seed=seed + i * num_outputs,
+            num_outputs=num_outputs,
+        ))
+    return jobs
+
+
+def render_pack(scheduler, jobs):
+    """
+    Blocking generator of `(index, images, error)` for every job of `jobs`, in the order they finish.
+
+    The jobs are queued sorted by their batch key, the scheduler batches the ones that match
+    (up to its batch size and pixel budget). `error` is the exception of a failed job and
+    `images` is None then, the other jobs of the pack still run.
+    """
+    order = sorted(range(len(jobs)), key=lambda i: jobs[i].batch_key())
+    futures = {}
+    for index in order:
+        for sub_job in scheduler.split(jobs[index]):
+            futures[scheduler.submit_threadsafe(sub_job)] = index
+
+    # a job split into sub-jobs is done when all of its sub-jobs are, their images stay in seed order
+    sub_futures = {}
+    for future, index in futures.items():
+        sub_futures.setdefault(index, []).append(future)
+    remaining = {index: len(futures_) for index, futures_ in sub_futures.items()}
+
+    for future in concurrent.futures.as_completed(futures):
+        index = futures[future]
+        remaining[index] -= 1
+        if remaining[index]:
+            continue
+        errors = [f.exception() for f in sub_futures[index] if f.exception() is not None]
+        if errors:
+            yield index, None, errors[0]
+        else:
+            yield index, [image for f in sub_futures[index] for image in f.result()], None
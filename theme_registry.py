@@ -0,0 +1,96 @@
+import json
+import os
+import threading
+
+import tracing
+
+PROMPT_PLACEHOLDER = "{prompt}"
+SEASON_PLACEHOLDER = "[season]"
+
+
+class Theme:
+    """One theme preset, its prompt template split on the placeholders once when it is loaded"""
+
+    def __init__(self, data):
+        self.data = data
+        self.name = data["name"]
+        self.seasons = data.get("seasons", [])
+        # [[literal, literal, ...], ...]: split on {prompt}, then every piece on [season]
+        self._pieces = [piece.split(SEASON_PLACEHOLDER) for piece in data["prompt"].split(PROMPT_PLACEHOLDER)]
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def render(self, custom_prompt=None, season=None):
+        """The prompt with `{prompt}` replaced by `custom_prompt` and `[season]` by `season`, missing ones stay as they are"""
+        season_text = season or SEASON_PLACEHOLDER
+        prompt_text = custom_prompt or PROMPT_PLACEHOLDER
+        if season:
+            # NOTE: the custom prompt is inserted first, a [season] typed into it is filled in too
+            prompt_text = prompt_text.replace(SEASON_PLACEHOLDER, season)
+        return prompt_text.join(season_text.join(parts) for parts in self._pieces)
+
+
+class ThemeRegistry:
+    """The theme presets of a JSON file, indexed by name.
+
+    The file is parsed once and again only when its mtime or size changes, so the UI can
+    look themes up on every change event with one `os.stat`. A file that cannot be parsed
+    (e.g. while it is being written) keeps the themes of the last good version.
+    """
+
+    def __init__(self, path, key="dream_world_themes"):
+        self.path = path
+        self.key = key
+        self._signature = None
+        self._themes = {}
+        self._names = []
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            if self._signature is None:
+                raise
+            return
+        signature = (stat.st_mtime_ns, stat.st_size)
+        if signature == self._signature:
+            return
+        with self._lock:
+            if signature == self._signature:
+                return
+            try:
+                with tracing.span("theme_load"), open(self.path, "r") as f:
+                    entries = json.load(f)[self.key]
+            except (json.JSONDecodeError, KeyError) as e:
+                if self._signature is None:
+                    raise
+                print(f"[Debug] Keeping the previous themes, cannot load {self.path}: {e!r}")
+                return
+            themes = {}
+            for entry in entries:
+                # the first theme of a name wins, like the linear scan this replaces
+                themes.setdefault(entry["name"], Theme(entry))
+            self._themes = themes
+            self._names = [entry["name"] for entry in entries]
+            self._signature = signature
+            print(f"[Debug] Loaded {len(themes)} themes from {self.path}")
+
+    def names(self):
+        self._refresh()
+        return list(self._names)
+
+    def get(self, name):
+        self._refresh()
+        return self._themes.get(name)
+
+    def __len__(self):
+        self._refresh()
+        return len(self._themes)
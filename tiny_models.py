@@ -0,0 +1,189 @@
+"""
+Tiny randomly initialized stand-ins for every model of the PhotoMaker pipeline, small enough to
+run end to end on CPU in seconds. The images are noise, they are meant for testing the plumbing
+(batch runs, caches, schedulers) and for benchmarking it, not the models.
+"""
+
+import json
+import os
+import tempfile
+import time
+import zlib
+
+import numpy as np
+import torch
+from diffusers import AutoencoderKL, EulerDiscreteScheduler, T2IAdapter, UNet2DConditionModel
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTextModelWithProjection, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+from identity_cache import model_fingerprint
+from module.model_v2 import PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken
+from pipeline_t2i_adapter import PhotoMakerStableDiffusionXLAdapterPipeline
+from runtime import PhotoMakerRuntime
+
+# NOTE: the two text encoders are concatenated, so the UNet cross attention dim is twice TEXT_HIDDEN_SIZE
+TEXT_HIDDEN_SIZE = 32
+CROSS_ATTENTION_DIM = 2 * TEXT_HIDDEN_SIZE
+TEXT_PROJECTION_DIM = 32
+ADDITION_TIME_EMBED_DIM = 8
+
+TINY_VISION_CONFIG = {
+    "hidden_size": 32,
+    "intermediate_size": 37,
+    "num_attention_heads": 4,
+    "num_hidden_layers": 2,
+    "patch_size": 32,
+    "image_size": 224,
+    "projection_dim": 32,
+}
+
+
+def build_tiny_tokenizer():
+    """A character level CLIP tokenizer: every byte is a token and there are no merges"""
+    tokenizer_dir = tempfile.mkdtemp(prefix="photomaker-tiny-tokenizer-")
+    characters = list(bytes_to_unicode().values())
+    tokens = characters + [c + "</w>" for c in characters] + ["<|startoftext|>", "<|endoftext|>"]
+    with open(os.path.join(tokenizer_dir, "vocab.json"), "w") as f:
+        json.dump({token: i for i, token in enumerate(tokens)}, f)
+    with open(os.path.join(tokenizer_dir, "merges.txt"), "w") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(
+        os.path.join(tokenizer_dir, "vocab.json"), os.path.join(tokenizer_dir, "merges.txt"), model_max_length=77
+    )
+
+
+def _text_config(tokenizer):
+    return CLIPTextConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=TEXT_HIDDEN_SIZE,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        max_position_embeddings=tokenizer.model_max_length,
+        projection_dim=TEXT_PROJECTION_DIM,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+    )
+
+
+def build_tiny_unet():
+    # the SDXL layout in two blocks: text_time added embeddings, a cross attention block with 2 transformer layers
+    return UNet2DConditionModel(
+        block_out_channels=(32, 64),
+        layers_per_block=2,
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        attention_head_dim=(2, 4),
+        use_linear_projection=True,
+        addition_embed_type="text_time",
+        addition_time_embed_dim=ADDITION_TIME_EMBED_DIM,
+        transformer_layers_per_block=(1, 2),
+        projection_class_embeddings_input_dim=6 * ADDITION_TIME_EMBED_DIM + TEXT_PROJECTION_DIM,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+    )
+
+
+def build_tiny_vae():
+    # four blocks like the SDXL VAE, so latents are 1/8 of the image and every aspect ratio keeps its latent shape
+    return AutoencoderKL(
+        block_out_channels=(32, 32, 32, 32),
+        in_channels=3,
+        out_channels=3,
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        layers_per_block=1,
+        latent_channels=4,
+        sample_size=1024,
+    )
+
+
+def build_tiny_adapter():
+    # one feature map per UNet down block, at half the latent resolution like the UNet's second block
+    return T2IAdapter(in_channels=3, channels=[32, 64], num_res_blocks=2, downscale_factor=16, adapter_type="full_adapter_xl")
+
+
+def build_tiny_id_encoder(attention_backend="auto"):
+    return PhotoMakerIDEncoder_CLIPInsightfaceExtendtoken(
+        attention_backend=attention_backend,
+        vision_config=TINY_VISION_CONFIG,
+        cross_attention_dim=CROSS_ATTENTION_DIM,
+        perceiver_dim_head=32,
+    )
+
+
+def build_tiny_pipeline(device="cpu", torch_dtype=torch.float32, seed=0, attention_backend="auto"):
+    """A `PhotoMakerStableDiffusionXLAdapterPipeline` with tiny random models and the trigger word `img`"""
+    torch.manual_seed(seed)
+    tokenizer = build_tiny_tokenizer()
+    tokenizer_2 = build_tiny_tokenizer()
+    pipe = PhotoMakerStableDiffusionXLAdapterPipeline(
+        vae=build_tiny_vae(),
+        text_encoder=CLIPTextModel(_text_config(tokenizer)),
+        text_encoder_2=CLIPTextModelWithProjection(_text_config(tokenizer_2)),
+        tokenizer=tokenizer,
+        tokenizer_2=tokenizer_2,
+        unet=build_tiny_unet(),
+        adapter=build_tiny_adapter(),
+        scheduler=EulerDiscreteScheduler(
+            beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear", timestep_spacing="leading", steps_offset=1
+        ),
+    )
+    pipe = pipe.to(device, dtype=torch_dtype)
+    # the ID encoder is not a registered component, `pipe.to` does not move it
+    id_encoder = build_tiny_id_encoder(attention_backend=attention_backend).to(device, dtype=torch_dtype)
+    pipe.set_id_encoder(id_encoder, trigger_word="img")
+    return pipe
+
+
+class _StubDetector:
+    input_size = None
+
+    def detect(self, img, max_num=0, metric="default"):
+        # one face in the middle of every image
+        h, w = img.shape[:2]
+        return np.array([[w * 0.25, h * 0.25, w * 0.75, h * 0.75, 0.99]], dtype=np.float32), None
+
+
+class _StubRecognizer:
+    def get(self, img, face):
+        # the same photo always gets the same embedding, different photos get different ones
+        rng = np.random.default_rng(zlib.crc32(np.ascontiguousarray(img).tobytes()))
+        face["embedding"] = rng.standard_normal(512).astype(np.float32)
+        return face["embedding"]
+
+
+class StubFaceAnalysis:
+    """Takes the place of `FaceAnalysis2` in `analyze_faces`, without the insightface models"""
+
+    def __init__(self):
+        self.det_model = _StubDetector()
+        self.models = {"detection": self.det_model, "recognition": _StubRecognizer()}
+
+
+class TinyPhotoMakerRuntime(PhotoMakerRuntime):
+    """A runtime with `build_tiny_pipeline` and `StubFaceAnalysis`, nothing is downloaded"""
+
+    def __init__(self, device="cpu", torch_dtype=torch.float32, seed=0, **kwargs):
+        super().__init__(device=device, torch_dtype=torch_dtype, **kwargs)
+        self.seed = seed
+
+    @property
+    def face_detector(self):
+        with self._lock:
+            if self._face_detector is None:
+                self._face_detector = StubFaceAnalysis()
+            return self._face_detector
+
+    def identity_fingerprint(self):
+        # there is no checkpoint file, the random weights follow from the seed
+        return model_fingerprint("tiny", self.seed, self.torch_dtype, "stub")
+
+    def _load_pipe(self):
+        start = time.perf_counter()
+        pipe = build_tiny_pipeline(device=self.device, torch_dtype=self.torch_dtype, seed=self.seed)
+        self._record("tiny_pipeline", start)
+        return pipe
@@ -0,0 +1,216 @@
+"""
+Tracing spans around the stages of a generation, off by default.
+
+    import tracing
+    tracing.enable()                          # or PHOTOMAKER_TRACE=1
+    with tracing.span("vae_decode", batch_size=4):
+        ...
+    tracing.save_chrome_trace("trace.json")   # open in chrome://tracing or ui.perfetto.dev
+    print(tracing.prometheus_text())
+
+While tracing is disabled `span` returns one shared object that does nothing, so the spans can
+stay in the hot paths. CUDA kernels run asynchronously: enable with `cuda_sync=True` to wait for
+them at the end of every span, otherwise GPU spans only measure the kernel launches.
+"""
+
+import collections
+import json
+import os
+import threading
+import time
+
+import torch
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus style: `counts[i]` is the number of observations <= `buckets[i]`"""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            for i, upper in enumerate(self.buckets):
+                if value <= upper:
+                    self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "buckets": dict(zip(self.buckets, self.counts)),
+                "count": self.count,
+                "sum": self.sum,
+            }
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("tracer", "name", "args", "start")
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        if self.tracer.cuda_sync and torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.tracer.record(self.name, self.start, time.perf_counter_ns(), self.args)
+        return False
+
+
+class Tracer:
+    """Keeps the last `max_events` spans for the Chrome trace and a duration histogram and count per span name"""
+
+    def __init__(self, max_events=100_000, buckets=DEFAULT_BUCKETS):
+        self.enabled = False
+        self.cuda_sync = False
+        self.buckets = buckets
+        self.events = collections.deque(maxlen=max_events)
+        self.histograms = {}
+        self.counters = collections.Counter()
+        self.thread_names = {}
+        self.origin = time.perf_counter_ns()
+        self._lock = threading.Lock()
+
+    def record(self, name, start, end, args=None):
+        thread = threading.current_thread()
+        with self._lock:
+            self.events.append((name, start, end, thread.ident, args))
+            self.thread_names.setdefault(thread.ident, thread.name)
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram(self.buckets)
+        histogram.observe((end - start) / 1e9)
+
+    def count(self, name, value=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += value
+
+    def reset(self):
+        with self._lock:
+            self.events.clear()
+            self.histograms = {}
+            self.counters.clear()
+            self.origin = time.perf_counter_ns()
+
+    def chrome_trace(self):
+        """The spans as Chrome trace events, one complete ("X") event per span, times in microseconds"""
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+            thread_names = dict(self.thread_names)
+        trace_events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}}
+            for tid, name in thread_names.items()
+        ]
+        for name, start, end, tid, args in events:
+            trace_events.append({
+                "name": name,
+                "ph": "X",
+                "ts": (start - self.origin) / 1000,
+                "dur": (end - start) / 1000,
+                "pid": pid,
+                "tid": tid,
+                "args": args or {},
+            })
+        return {"traceEvents": trace_events, "displayTimeUnit": "ms"}
+
+    def prometheus_text(self, prefix="photomaker"):
+        """The span histograms and the counters in the Prometheus text exposition format"""
+        with self._lock:
+            histograms = dict(self.histograms)
+            counters = dict(self.counters)
+        lines = [
+            f"# HELP {prefix}_span_seconds Time spent in each traced stage.",
+            f"# TYPE {prefix}_span_seconds histogram",
+        ]
+        for name, histogram in sorted(histograms.items()):
+            snapshot = histogram.snapshot()
+            for upper, count in snapshot["buckets"].items():
+                lines.append(f'{prefix}_span_seconds_bucket{{span="{name}",le="{upper}"}} {count}')
+            lines.append(f'{prefix}_span_seconds_bucket{{span="{name}",le="+Inf"}} {snapshot["count"]}')
+            lines.append(f'{prefix}_span_seconds_sum{{span="{name}"}} {snapshot["sum"]}')
+            lines.append(f'{prefix}_span_seconds_count{{span="{name}"}} {snapshot["count"]}')
+        lines += [
+            f"# HELP {prefix}_events_total Events counted while tracing.",
+            f"# TYPE {prefix}_events_total counter",
+        ]
+        for name, value in sorted(counters.items()):
+            lines.append(f'{prefix}_events_total{{event="{name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+# NOTE: one tracer per process, the module level functions below are what the pipeline calls
+tracer = Tracer()
+
+
+def enable(cuda_sync=False):
+    tracer.cuda_sync = cuda_sync
+    tracer.enabled = True
+
+
+def disable():
+    tracer.enabled = False
+
+
+def is_enabled():
+    return tracer.enabled
+
+
+def reset():
+    tracer.reset()
+
+
+def span(name, **args):
+    """Context manager timing its block as `name`, `args` show up in the Chrome trace"""
+    if not tracer.enabled:
+        return _NULL_SPAN
+    return _Span(tracer, name, args)
+
+
+def count(name, value=1):
+    tracer.count(name, value)
+
+
+def chrome_trace():
+    return tracer.chrome_trace()
+
+
+def save_chrome_trace(path):
+    with open(path, "w") as f:
+        json.dump(tracer.chrome_trace(), f)
+    return path
+
+
+def prometheus_text(prefix="photomaker"):
+    return tracer.prometheus_text(prefix)
+
+
+if os.environ.get("PHOTOMAKER_TRACE", "").lower() in ("1", "true", "cuda"):
+    enable(cuda_sync=os.environ["PHOTOMAKER_TRACE"].lower() == "cuda")
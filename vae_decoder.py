@@ -0,0 +1,102 @@
+import copy
+
+import torch
+
+
+class VaeDecodeStage:
+    """Turns latents into images with a persistent copy of the VAE decoder in a safe dtype.
+
+    The SDXL VAE overflows in float16, diffusers works around it by casting the whole VAE
+    to float32 before every decode and back to float16 after it. Here `post_quant_conv`
+    and `decoder` are copied once to `dtype` (float32 when the VAE asks for upcasting,
+    otherwise the VAE itself is used) and kept next to the float16 VAE.
+
+    Latents are decoded `chunk_size` at a time. With `tiling` the decoder runs on
+    overlapping tiles of `tile_sample_size` pixels that are blended like
+    `AutoencoderKL.tiled_decode`, which bounds the activation memory of large images.
+    `tiling="auto"` only tiles latents larger than one tile.
+    """
+
+    def __init__(self, vae, chunk_size=1, tiling="auto", tile_sample_size=None, tile_overlap_factor=None, dtype=None):
+        self.vae = vae
+        self.chunk_size = chunk_size
+        self.tiling = tiling
+        self.tile_sample_size = tile_sample_size or vae.tile_sample_min_size
+        self.tile_overlap_factor = tile_overlap_factor or vae.tile_overlap_factor
+        if dtype is None:
+            needs_upcasting = vae.dtype == torch.float16 and vae.config.force_upcast
+            dtype = torch.float32 if needs_upcasting else vae.dtype
+        self.dtype = dtype
+        # pixels per latent, like the pipeline's `vae_scale_factor`
+        self.scale_factor = 2 ** (len(vae.config.block_out_channels) - 1)
+        self._post_quant_conv = None
+        self._decoder = None
+
+    def _modules(self, device):
+        if self.dtype == self.vae.dtype:
+            return self.vae.post_quant_conv, self.vae.decoder
+        if self._decoder is None:
+            # NOTE: only the decoder half is copied, the encoder is never used to generate
+            self._decoder = copy.deepcopy(self.vae.decoder).to(device=device, dtype=self.dtype).requires_grad_(False)
+            if self.vae.post_quant_conv is not None:
+                self._post_quant_conv = copy.deepcopy(self.vae.post_quant_conv).to(device=device, dtype=self.dtype)
+                self._post_quant_conv.requires_grad_(False)
+        elif next(self._decoder.parameters()).device != torch.device(device):
+            # follow the pipeline when it is moved to another device
+            self._decoder.to(device)
+            if self._post_quant_conv is not None:
+                self._post_quant_conv.to(device)
+        return self._post_quant_conv, self._decoder
+
+    def _decode_tile(self, z, post_quant_conv, decoder):
+        if post_quant_conv is not None:
+            z = post_quant_conv(z)
+        return decoder(z)
+
+    def _decode_tiled(self, z, post_quant_conv, decoder):
+        tile_latent_size = self.tile_sample_size // self.scale_factor
+        overlap_size = int(tile_latent_size * (1 - self.tile_overlap_factor))
+        blend_extent = int(self.tile_sample_size * self.tile_overlap_factor)
+        row_limit = self.tile_sample_size - blend_extent
+
+        rows = []
+        for i in range(0, z.shape[2], overlap_size):
+            row = []
+            for j in range(0, z.shape[3], overlap_size):
+                tile = z[:, :, i:i + tile_latent_size, j:j + tile_latent_size]
+                row.append(self._decode_tile(tile, post_quant_conv, decoder))
+            rows.append(row)
+
+        result_rows = []
+        for i, row in enumerate(rows):
+            result_row = []
+            for j, tile in enumerate(row):
+                # blend the tile above and the tile to the left with the current one
+                if i > 0:
+                    tile = self.vae.blend_v(rows[i - 1][j], tile, blend_extent)
+                if j > 0:
+                    tile = self.vae.blend_h(row[j - 1], tile, blend_extent)
+                result_row.append(tile[:, :, :row_limit, :row_limit])
+            result_rows.append(torch.cat(result_row, dim=3))
+        return torch.cat(result_rows, dim=2)
+
+    def use_tiling(self, latents):
+        if self.tiling == "auto":
+            tile_latent_size = self.tile_sample_size // self.scale_factor
+            return latents.shape[-2] > tile_latent_size or latents.shape[-1] > tile_latent_size
+        return bool(self.tiling)
+
+    @torch.no_grad()
+    def decode(self, latents):
+        """Decode unscaled latents ([b, 4, h / scale_factor, w / scale_factor]) to images in [-1, 1], in the dtype of the decoder"""
+        post_quant_conv, decoder = self._modules(latents.device)
+        tiled = self.use_tiling(latents)
+        images = []
+        for chunk in latents.split(self.chunk_size):
+            chunk = chunk.to(self.dtype)
+            if tiled:
+                image = self._decode_tiled(chunk, post_quant_conv, decoder)
+            else:
+                image = self._decode_tile(chunk, post_quant_conv, decoder)
+            images.append(image)
+        return torch.cat(images)